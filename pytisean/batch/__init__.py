@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+from .batch import multichannel, sweep, load_journal, CostModel, \
+    run_scheduled, get_analysis
@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+""" Batch runs of the analysis functions
+"""
+
+import hashlib
+import importlib
+import inspect
+import itertools
+import json
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    FIRST_COMPLETED, wait
+
+import numpy as np
+
+from ..nativetools import read_data, column_indexes, is_binary, \
+    load_binary, data_hash, SharedArray
+
+__author__ = "Gaby Launay"
+__copyright__ = "Gaby Launay 2017"
+__credits__ = "Rainer Hegger, Holger Kantz and Thomas Schreiber"
+__license__ = "MIT"
+__version__ = "0.1"
+__email__ = "gaby.launay@tutanota.com"
+__status__ = "Development"
+
+
+def _stack(results):
+    """
+    Stack the results of several channels along a first axis (arrays of
+    the same shape, or tuples of them), or return them as a list.
+    """
+    first = results[0]
+    if isinstance(first, tuple):
+        return tuple(_stack([res[i] for res in results])
+                     for i in range(len(first)))
+    if isinstance(first, (np.ndarray, float, int)):
+        shapes = set(np.shape(res) for res in results)
+        if len(shapes) == 1:
+            return np.stack(results)
+    return results
+
+
+def multichannel(analysis, data, channels=None, nmb_data_to_use=None,
+                 ignored_row=0, nmb_proc=1, **kwargs):
+    """
+    Run an analysis on several channels (columns) of a data set.
+
+    Each channel is extracted (and serialized for TISEAN) only once, and
+    channels are processed in parallel.
+
+    Parameters
+    ----------
+    analysis : function
+        Analysis function (ex: 'corr', 'mutual', 'false_nearest',
+        'lyap_r', 'histogram'), called with the channel data as first
+        argument.
+    data : array or string
+        (N, C) data, can de an array or a filename (text, '.npy' or
+        '.npz' file).
+    channels : integer, string or list of integers
+        Channels (columns) to analyse, starting from 1
+        (ex: [1, 2, 5] or '1,2,5', default to all).
+    nmb_data_to_use : integer
+        Number of data points to use (default to everything).
+    ignored_row : integer
+        Number of file rows to ignore if 'time_serie' is a file path
+        (Default to 0).
+    nmb_proc : integer
+        Number of channels analysed at the same time (default to 1).
+    kwargs :
+        Additional arguments for 'analysis'.
+
+    Returns
+    -------
+    res : array, tuple of arrays or list
+        Results for each channel, stacked along a first (channel) axis
+        when they have the same shape (a list otherwise).
+    """
+    if channels is None:
+        if is_binary(data):
+            data = load_binary(data)
+        if isinstance(data, str):
+            data = np.loadtxt(data, comments='#', skiprows=ignored_row,
+                              ndmin=2)
+            ignored_row = 0
+        nmb_cols = 1 if np.ndim(data) == 1 else np.shape(data)[1]
+        channels = list(range(1, nmb_cols + 1))
+    cols = [col + 1 for col in column_indexes(channels)]
+    x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                  ignored_row=ignored_row, col_to_read=cols)
+    x = x.reshape(len(x), -1)
+
+    def run(i):
+        # contiguous copy of the channel, serialized only once by
+        # the analysis
+        return analysis(np.ascontiguousarray(x[:, i]), **kwargs)
+
+    if nmb_proc > 1:
+        with ThreadPoolExecutor(nmb_proc) as pool:
+            results = list(pool.map(run, range(len(cols))))
+    else:
+        results = [run(i) for i in range(len(cols))]
+    return _stack(results)
+
+
+def _input_hash(data):
+    """Return a hash of the input content (array or file)."""
+    if isinstance(data, SharedArray):
+        data = data.array
+    if isinstance(data, str):
+        sha = hashlib.sha1()
+        with open(data, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+    return data_hash(np.asarray(data))
+
+
+def _write_atomic(path, obj):
+    """Write a pickled object, so that 'path' is either absent or
+    complete (even if the process dies while writing)."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # make the renaming durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def load_journal(journal_dir):
+    """
+    Load the records of a sweep journal (see 'sweep').
+
+    Returns
+    -------
+    records : dictionary
+        Records (dictionaries with 'function', 'params', 'input_hash' and
+        'result'), with their keys as keys.
+    """
+    records = {}
+    if not os.path.isdir(journal_dir):
+        return records
+    for name in os.listdir(journal_dir):
+        if not name.endswith('.pkl'):
+            continue
+        try:
+            with open(os.path.join(journal_dir, name), 'rb') as f:
+                records[name[:-4]] = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            # should not happen with atomic writes, just recompute
+            continue
+    return records
+
+
+def sweep(func, inputs, grid, journal_dir, nmb_proc=1, verbose=0):
+    """
+    Run an analysis over a grid of parameters and several inputs, with
+    checkpointing.
+
+    Each result is written to a journal (a directory of records, written
+    atomically) as soon as it is computed. Running again the same sweep
+    (e.g. after a crash) only computes the missing results.
+
+    Parameters
+    ----------
+    func : function
+        Analysis (ex: 'lyap_k').
+    inputs : list of arrays or strings
+        Inputs (arrays or filenames), given as first argument to 'func'.
+    grid : dictionary or list of dictionaries
+        Parameters, as a dictionary of lists of values (all the
+        combinations are run) or as a list of dictionaries of arguments.
+    journal_dir : string
+        Journal directory.
+    nmb_proc : integer
+        Number of analyses run at the same time (default to 1).
+    verbose : integer
+        Verbosity level (defaul to 0 for no messages).
+
+    Returns
+    -------
+    res : list of dictionaries
+        For each input and parameters set: 'input' (input index),
+        'params' (parameters) and 'result'.
+    """
+    if isinstance(grid, dict):
+        names = sorted(grid)
+        grid = [dict(zip(names, values))
+                for values in itertools.product(*[grid[name]
+                                                  for name in names])]
+    if not os.path.isdir(journal_dir):
+        os.makedirs(journal_dir)
+    func_name = "{}.{}".format(func.__module__, func.__name__)
+    hashes = [_input_hash(data) for data in inputs]
+    # cells of the sweep
+    cells = []
+    for i, input_hash in enumerate(hashes):
+        for params in grid:
+            key = hashlib.sha1(json.dumps([func_name, params, input_hash],
+                                          sort_keys=True, default=repr)
+                               .encode()).hexdigest()
+            cells.append((key, i, params))
+    # replay the journal
+    done = load_journal(journal_dir)
+    todo = [cell for cell in cells if cell[0] not in done]
+    if verbose:
+        print("{} results in the journal, {} to compute"
+              .format(len(cells) - len(todo), len(todo)))
+
+    def run(cell):
+        key, i, params = cell
+        record = {'function': func_name, 'params': params,
+                  'input_hash': hashes[i],
+                  'result': func(inputs[i], **params)}
+        _write_atomic(os.path.join(journal_dir, key + '.pkl'), record)
+        if verbose:
+            print("done: input {} with {}".format(i, params))
+        return key, record
+
+    if nmb_proc > 1:
+        with ThreadPoolExecutor(nmb_proc) as pool:
+            done.update(pool.map(run, todo))
+    else:
+        done.update(run(cell) for cell in todo)
+    return [{'input': i, 'params': params, 'result': done[key]['result']}
+            for key, i, params in cells]
+
+
+def _log(n):
+    return np.log2(max(n, 2))
+
+
+def _dim(args):
+    """Largest embedding dimension of the arguments."""
+    dims = [args.get(name) for name in ['max_dim', 'dim', 'dimension']]
+    dims = [dim for dim in dims if isinstance(dim, (int, float))]
+    return max(dims) if dims else 1
+
+
+# Work (arbitrary units) of the analyses, as a function of the number of
+# points and of the arguments
+COST_FORMULAS = {
+    'histogram': lambda n, a: n,
+    'corr': lambda n, a: n*a['nmb_corr'],
+    'mutual': lambda n, a: n*(a['max_delay'] + 1),
+    'delay': lambda n, a: n*a['dimension'],
+    'pca': lambda n, a: n*a['dim']**2,
+    'd2': lambda n, a: n*min(n, a['max_nmb_pair'] or n)*a['max_dim'],
+    'false_nearest': lambda n, a: n*_log(n)*(a['max_dim'] - a['min_dim']
+                                             + 1)*a['max_dim'],
+    'lyap_k': lambda n, a: n*_log(n)*(a['max_dim'] - a['min_dim'] + 1)
+    * a['nmb_scales']*a['nmb_it'],
+    'lyap_r': lambda n, a: n*_log(n)*a['dim']*a['nmb_it'],
+    'lyap_spec': lambda n, a: n*_log(n)*a['dim']**2*(a['nmb_it'] or 1)
+    * a['nmb_neigh'],
+    'ghkss': lambda n, a: n*_log(n)*a['dim']**3*a['nmb_it']
+    * a['min_nmb_neigh'],
+    'lazy': lambda n, a: n*_log(n)*a['dim']*a['nmb_it'],
+    'recurr': lambda n, a: n*_log(n)*a['dim'],
+    'stp': lambda n, a: n*a['time_steps']*a['dim'],
+    'surrogates': lambda n, a: n*_log(n)*(a['nmb_it'] or 1)*a['nmb_surr'],
+    'lzo_test': lambda n, a: n*_log(n)*a['dim']*a['min_nmb_neigh'],
+}
+
+
+def _nmb_points(data, nmb_data_to_use=None):
+    """Number of points of an input (array, binary or text file)."""
+    if nmb_data_to_use is not None:
+        return nmb_data_to_use
+    if is_binary(data):
+        data = load_binary(data)
+    if isinstance(data, str):
+        with open(data, 'rb') as f:
+            return sum(block.count(b'\n')
+                       for block in iter(lambda: f.read(2**20), b''))
+    return len(np.asarray(data)) if np.ndim(data) > 0 else 1
+
+
+# Subpackages searched for analysis functions given without their module
+ANALYSIS_MODULES = ['dimension', 'embedding', 'generators', 'lineartools',
+                    'lyapunov', 'noise_reduction', 'prediction',
+                    'stationarity', 'surrogates', 'utilities']
+
+
+def get_analysis(name):
+    """Return the pytisean function named 'name' (ex: 'embedding.mutual'
+    or 'mutual')."""
+    if '.' in name:
+        module, func = name.rsplit('.', 1)
+        return getattr(importlib.import_module('pytisean.' + module), func)
+    for module in ANALYSIS_MODULES:
+        module = importlib.import_module('pytisean.' + module)
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise ValueError("Unknown analysis: '{}'".format(name))
+
+
+def _function(func):
+    """Return the function (and its name) of a job."""
+    if isinstance(func, str):
+        return get_analysis(func), func.split('.')[-1]
+    return func, func.__name__
+
+
+class CostModel(object):
+    """
+    Estimate the duration and memory of analysis jobs.
+
+    Durations are a work estimate (see 'COST_FORMULAS', from the number of
+    points and the arguments) times a per-analysis coefficient, calibrated
+    from the timings of the past runs.
+
+    Parameters
+    ----------
+    path : string
+        JSON file where to load and save the calibration (default to no
+        persistence).
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        # seconds per work unit
+        self.coefs = {'default': 1e-7}
+        # number of points of the input files (counted once)
+        self._nmb_points = {}
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.coefs.update(json.load(f))
+
+    @staticmethod
+    def _arguments(func, params):
+        """Job arguments, with the function defaults."""
+        args = {}
+        try:
+            for name, par in inspect.signature(func).parameters.items():
+                if par.default is not inspect.Parameter.empty:
+                    args[name] = par.default
+        except (TypeError, ValueError):
+            pass
+        args.update(params)
+        return args
+
+    def nmb_points(self, job):
+        """Number of points of a job input (cached for files)."""
+        func, _ = _function(job['function'])
+        args = self._arguments(func, job.get('params', {}))
+        data = job['input']
+        if not isinstance(data, str) or not os.path.isfile(data):
+            return _nmb_points(data, args.get('nmb_data_to_use'))
+        stat = os.stat(data)
+        key = (os.path.abspath(data), stat.st_size, stat.st_mtime_ns,
+               args.get('nmb_data_to_use'))
+        if key not in self._nmb_points:
+            self._nmb_points[key] = _nmb_points(data,
+                                                args.get('nmb_data_to_use'))
+        return self._nmb_points[key]
+
+    def work(self, job, nmb_pts=None):
+        """Work (arbitrary units) of a job."""
+        func, name = _function(job['function'])
+        args = self._arguments(func, job.get('params', {}))
+        if nmb_pts is None:
+            nmb_pts = self.nmb_points(job)
+        if name in COST_FORMULAS:
+            try:
+                return float(COST_FORMULAS[name](nmb_pts, args))
+            except (KeyError, TypeError):
+                pass
+        return float(nmb_pts*_dim(args))
+
+    def estimate(self, job, work=None):
+        """Estimated duration (in seconds) of a job."""
+        _, name = _function(job['function'])
+        work = self.work(job) if work is None else work
+        return work*self.coefs.get(name, self.coefs['default'])
+
+    def memory(self, job, nmb_pts=None):
+        """Estimated memory (in bytes) of a job."""
+        func, _ = _function(job['function'])
+        args = self._arguments(func, job.get('params', {}))
+        if nmb_pts is None:
+            nmb_pts = self.nmb_points(job)
+        # data, embedding and neighbor index (and text copies)
+        return 8*nmb_pts*(3*_dim(args) + 4)
+
+    def update(self, job, duration, work=None, alpha=0.3):
+        """Calibrate the model with the measured duration of a job."""
+        _, name = _function(job['function'])
+        work = self.work(job) if work is None else work
+        if work <= 0:
+            return
+        coef = duration/work
+        if name in self.coefs:
+            coef = (1 - alpha)*self.coefs[name] + alpha*coef
+        self.coefs[name] = coef
+
+    def save(self):
+        """Save the calibration (if a path was given)."""
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.coefs, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def _run_timed(runner, job):
+    start = time.time()
+    res = runner(job)
+    return res, time.time() - start
+
+
+def _call_job(job):
+    """Default job runner: 'function(input, **params)'."""
+    func, _ = _function(job['function'])
+    return func(job['input'], **job.get('params', {}))
+
+
+def run_scheduled(jobs, nmb_proc=1, max_memory=None, cost_model=None,
+                  runner=None, use_processes=False, is_failed=None,
+                  verbose=0):
+    """
+    Run heterogeneous jobs, longest expected first.
+
+    Parameters
+    ----------
+    jobs : list of dictionaries
+        Jobs, with 'function' (function or name, ex: 'd2' or
+        'dimension.d2'), 'input' (array or filename) and 'params'
+        (dictionary of arguments).
+    nmb_proc : integer
+        Number of jobs run at the same time (default to 1).
+    max_memory : number
+        Maximal estimated memory (in bytes) of the jobs run at the same
+        time (default to no limit). Jobs that do not fit wait, while
+        smaller jobs are run.
+    cost_model : CostModel object
+        Model used to estimate the jobs durations and memory, calibrated
+        (and saved) with the measured durations (default to a new
+        CostModel).
+    runner : function
+        Function running a job (default to calling
+        'function(input, **params)').
+    use_processes : boolean
+        If 'True', use processes instead of threads (jobs and runner should
+        then be picklable).
+    is_failed : function
+        Function of a job result returning 'True' if the job failed
+        (failed jobs durations are not used to calibrate the cost model).
+        Default to no failed jobs (a runner exception is raised).
+    verbose : integer
+        Verbosity level (defaul to 0 for no messages).
+
+    Returns
+    -------
+    res : list
+        Results of the jobs (in the jobs order).
+    durations : list of numbers
+        Durations of the jobs (in seconds).
+    """
+    if nmb_proc < 1:
+        raise ValueError("'nmb_proc' should be at least 1")
+    if cost_model is None:
+        cost_model = CostModel()
+    if runner is None:
+        runner = _call_job
+    # (inputs are only read once to get their number of points)
+    points = [cost_model.nmb_points(job) for job in jobs]
+    works = [cost_model.work(job, nmb_pts)
+             for job, nmb_pts in zip(jobs, points)]
+    estimates = [cost_model.estimate(job, work)
+                 for job, work in zip(jobs, works)]
+    memories = [cost_model.memory(job, nmb_pts)
+                for job, nmb_pts in zip(jobs, points)]
+    # longest expected first
+    queue = sorted(range(len(jobs)), key=lambda i: -estimates[i])
+    res = [None]*len(jobs)
+    durations = [None]*len(jobs)
+    running = {}
+    used_memory = 0
+    executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor(nmb_proc) as pool:
+        while queue or running:
+            # fill the free slots, with the jobs fitting in memory
+            for i in list(queue):
+                if len(running) >= nmb_proc:
+                    break
+                if max_memory is not None and running \
+                        and used_memory + memories[i] > max_memory:
+                    continue
+                queue.remove(i)
+                used_memory += memories[i]
+                running[pool.submit(_run_timed, runner, jobs[i])] = i
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                used_memory -= memories[i]
+                res[i], durations[i] = future.result()
+                if is_failed is None or not is_failed(res[i]):
+                    cost_model.update(jobs[i], durations[i],
+                                      work=works[i])
+                if verbose:
+                    print("job {}: {:.2f}s (expected {:.2f}s)"
+                          .format(i, durations[i], estimates[i]))
+    cost_model.save()
+    return res, durations
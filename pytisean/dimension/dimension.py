@@ -4,7 +4,7 @@
 """ TISEAN dimension estimator tools wrappers
 """
 
-from ..tiseanwrapper import tisean
+from ..tiseanwrapper import tisean, input_extent
 
 __author__ = "Gaby Launay"
 __copyright__ = "Gaby Launay 2017"
@@ -18,7 +18,8 @@ __status__ = "Development"
 def d2(data, delay=1, nmb_comp=1, max_dim=10, theiler_wind=0,
        min_len_scale=None, max_len_scale=None, nmb_eps=100,
        max_nmb_pair=1000, normalized_data=False, nmb_data_to_use=None,
-       ignored_row=0, col_to_read=1, output_file=None, verbose=0):
+       ignored_row=0, col_to_read=1, output_file=None, verbose=0,
+       full_output=False, dtype=None):
     """
     Estimate the correlation sum, the correlation sum slope and the
     correlation entropie, used to get the correlation dimension.
@@ -60,6 +61,13 @@ def d2(data, delay=1, nmb_comp=1, max_dim=10, theiler_wind=0,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    full_output : boolean
+        If 'True', return TiseanResult objects (see
+        'tiseanwrapper.TiseanResult'), separating the blocks of each
+        embedding dimension (ex: 'c2.block(dim=3)').
+    dtype : data-type
+        Type the TISEAN input is written with (ex: np.float32 to only
+        write 9 significant digits, default to the data type).
 
     Returns
     -------
@@ -84,7 +92,10 @@ def d2(data, delay=1, nmb_comp=1, max_dim=10, theiler_wind=0,
         args += " -E"
     args = args.split(" ")
     # run command
-    res, msg = tisean('d2', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read, nmb_comp)
+    res, msg = tisean('d2', args, input_data=data, output_file=output_file,
+                      output_file_ext=['.c2', '.d2', '.h2'],
+                      full_output=full_output, dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
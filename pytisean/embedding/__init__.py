@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 #!/usr/env python3
-from .embedding import delay, mutual, poincare, extrema, upo, upoembed, false_nearest
+from .embedding import delay, mutual, poincare, extrema, upo, upoembed, false_nearest, \
+    select_embedding
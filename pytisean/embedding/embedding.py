@@ -4,7 +4,13 @@
 """ TISEAN embedding tools wrappers
 """
 
-from ..tiseanwrapper import tisean
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ..nativetools import read_data, data_interval, digitize, \
+    embedding_index
+from ..tiseanwrapper import tisean, input_extent, write_output
 
 __author__ = "Gaby Launay"
 __copyright__ = "Gaby Launay 2017"
@@ -17,7 +23,7 @@ __status__ = "Development"
 
 def delay(data, dimension=2, vector_format=None, vector_delay=1, delays=None,
           nmb_data_to_use=None, ignored_row=0, ignored_col=1, col_to_read=1,
-          output_file=None, verbose=0):
+          output_file=None, verbose=0, dtype=None):
     """
     Produces delay vectors either from a scalar or
     from a multivariate time series.
@@ -51,6 +57,9 @@ def delay(data, dimension=2, vector_format=None, vector_delay=1, delays=None,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    dtype : data-type
+        Type the TISEAN input is written with (ex: np.float32 to only
+        write 9 significant digits, default to the data type).
 
     Returns
     -------
@@ -69,7 +78,9 @@ def delay(data, dimension=2, vector_format=None, vector_delay=1, delays=None,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
-    res, msg = tisean('delay', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row)
+    res, msg = tisean('delay', args, input_data=data, output_file=output_file,
+                      dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
@@ -77,7 +88,8 @@ def delay(data, dimension=2, vector_format=None, vector_delay=1, delays=None,
 
 
 def mutual(data, max_delay=20, box_nmb=16, nmb_data_to_use=None,
-           ignored_row=0, col_to_read=1, output_file=None, verbose=0):
+           ignored_row=0, col_to_read=1, output_file=None, verbose=0,
+           native=False, full_output=False, dtype=None):
     """
     Estimates the time delayed mutual information of the data.
 
@@ -105,6 +117,17 @@ def mutual(data, max_delay=20, box_nmb=16, nmb_data_to_use=None,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    native : boolean
+        If 'True', use the native implementation instead of the TISEAN
+        binary (default to 'False'), only returning the mutual information.
+    full_output : boolean
+        If 'True', return a TiseanResult object (see
+        'tiseanwrapper.TiseanResult'), keeping the values written in the
+        TISEAN output comments (ex: 'res.shannon').
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used), also used to write the TISEAN input (default to no
+        conversion).
 
     Returns
     -------
@@ -115,6 +138,14 @@ def mutual(data, max_delay=20, box_nmb=16, nmb_data_to_use=None,
     mutual_info : list of [tau, mu] tuples
         delays and associated mutual information.
     """
+    if native:
+        x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                      ignored_row=ignored_row, col_to_read=col_to_read,
+                      dtype=dtype)
+        res = _mutual_native(digitize(x, box_nmb), box_nmb, max_delay)
+        if output_file is not None:
+            write_output(output_file, res)
+        return res
     # prepare arguments
     args = "-b{} -D{} -x{} -c{} -V{}" \
            .format(box_nmb, max_delay, ignored_row, col_to_read, verbose)
@@ -122,7 +153,9 @@ def mutual(data, max_delay=20, box_nmb=16, nmb_data_to_use=None,
         args += "-l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
-    res, msg = tisean('mutual', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read)
+    res, msg = tisean('mutual', args, input_data=data, output_file=output_file,
+                      full_output=full_output, dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
@@ -177,8 +210,9 @@ def poincare(data, dim=2, delay=1, cross_comp=None, cross_dir=0,
         args += " -a{}".format(cross_pos)
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read)
     res, msg = tisean('poincare', args, input_data=data,
-                      output_file=output_file)
+                      output_file=output_file, **extent)
     # return
     if msg != "":
         print(msg)
@@ -234,8 +268,9 @@ def extrema(data, nmb_comp=2, comp=1, extrema="maxima",
         args += " -z"
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read, nmb_comp)
     res, msg = tisean('extrema', args, input_data=data,
-                      output_file=output_file)
+                      output_file=output_file, **extent)
     # return
     if msg != "":
         print(msg)
@@ -252,7 +287,8 @@ def upoembed():
 
 def false_nearest(data, min_dim=1, max_dim=5, comp_nmb=1, delay=1, ratio=2.0,
                   theiler_wind=0, nmb_data_to_use=None, ignored_row=0,
-                  col_to_read=1, output_file=None, verbose=0):
+                  col_to_read=1, output_file=None, verbose=0, native=False,
+                  dtype=None):
     """
     Compute the false nearests fraction.
 
@@ -285,6 +321,13 @@ def false_nearest(data, min_dim=1, max_dim=5, comp_nmb=1, delay=1, ratio=2.0,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    native : boolean
+        If 'True', use the native implementation instead of the TISEAN
+        binary (default to 'False'), for one component only.
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used), also used to write the TISEAN input (default to no
+        conversion).
 
     Returns
     -------
@@ -304,6 +347,19 @@ def false_nearest(data, min_dim=1, max_dim=5, comp_nmb=1, delay=1, ratio=2.0,
     statistics is so small, that the whole statistics is meanlingless.
     Be aware of this!
     """
+    if native:
+        if comp_nmb != 1:
+            raise ValueError("Native implementation only handles one"
+                             " component")
+        x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                      ignored_row=ignored_row, col_to_read=col_to_read,
+                      dtype=dtype)
+        res = np.array([_false_nearest_native(x, dim, delay, ratio,
+                                              theiler_wind)
+                        for dim in range(min_dim, max_dim + 1)])
+        if output_file is not None:
+            write_output(output_file, res)
+        return res
     # prepare arguments
     args = "-x{} -c{} -m{} -M{},{} -d{} -f{} -t{} -V{}" \
            .format(ignored_row, col_to_read, min_dim, comp_nmb, max_dim,
@@ -312,9 +368,205 @@ def false_nearest(data, min_dim=1, max_dim=5, comp_nmb=1, delay=1, ratio=2.0,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read, comp_nmb)
     res, msg = tisean('false_nearest', args, input_data=data,
-                      output_file=output_file)
+                      output_file=output_file, dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
     return res
+
+
+def _mutual_native(boxes, box_nmb, max_delay):
+    """
+    Native version of 'mutual', from the box indexes of the data
+    (see 'nativetools.digitize').
+    """
+    res = np.empty((max_delay + 1, 2))
+    res[:, 0] = np.arange(max_delay + 1)
+    for tau in range(max_delay + 1):
+        keys = boxes[:len(boxes) - tau]*box_nmb + boxes[tau:]
+        joint = np.bincount(keys, minlength=box_nmb**2)/len(keys)
+        joint = joint.reshape(box_nmb, box_nmb)
+        marg_1 = joint.sum(axis=1)
+        marg_2 = joint.sum(axis=0)
+        i, j = np.nonzero(joint)
+        res[tau, 1] = np.sum(joint[i, j]*np.log(joint[i, j]
+                                                / marg_1[i]/marg_2[j]))
+    return res
+
+
+def _autocorrelation(x, max_delay):
+    """Autocorrelation of a time serie up to 'max_delay', using FFT."""
+    x = x - np.mean(x)
+    size = 1
+    while size < 2*len(x):
+        size *= 2
+    spec = np.fft.rfft(x, size)
+    acf = np.fft.irfft(spec*np.conj(spec), size)[:max_delay + 1]
+    res = np.empty((max_delay + 1, 2))
+    res[:, 0] = np.arange(max_delay + 1)
+    res[:, 1] = acf/acf[0]
+    return res
+
+
+def _false_nearest_native(x, dim, delay=1, ratio=2.0, theiler_wind=0):
+    """
+    Native version of 'false_nearest' for one dimension.
+
+    Returns
+    -------
+    res : list
+        [dimension, false neighbors fraction, average neighborhood size,
+        average squared neighborhood size]
+    """
+    # vectors having a next coordinate (their index is cached, and only
+    # reused by later calls with the same data, dimension and delay)
+    nmb_vec = len(x) - dim*delay
+    emb, index = embedding_index(x[:nmb_vec + (dim - 1)*delay], dim, delay)
+
+    def exclude(qind, nind):
+        return np.abs(qind - nind) <= theiler_wind
+
+    # initial radius: median neighbor distance of a few points
+    # (searched with the index, starting from a small radius)
+    sample = np.linspace(0, nmb_vec - 1, min(nmb_vec, 100)).astype(int)
+    eps = data_interval(x)/nmb_vec**(1/min(dim, 2))
+    if eps > 0:
+        _, dist = index.query_knn(
+            emb[sample], 1, eps, factor=2.,
+            exclude=lambda qind, nind: exclude(sample[qind], nind))
+        eps = np.median(dist[:, 0])
+    if not np.isfinite(eps) or eps == 0:
+        eps = data_interval(x)/nmb_vec
+
+    nind, dist = index.query_knn(emb, 1, eps, exclude=exclude)
+    nind, dist = nind[:, 0], dist[:, 0]
+    # only neighbors closer than std/ratio are considered
+    # (statistics are accumulated in float64, even for float32 data)
+    filt = (dist > 0) & (dist < np.std(x, dtype=np.float64)/ratio)
+    nmb_pts = np.sum(filt)
+    if nmb_pts == 0:
+        return [dim, np.nan, np.nan, np.nan]
+    qind = np.arange(nmb_vec)[filt]
+    nind, dist = nind[filt], dist[filt]
+    next_dist = np.abs(x[qind + dim*delay] - x[nind + dim*delay])
+    false = np.sum(next_dist/dist > ratio)
+    dist = dist.astype(np.float64)
+    return [dim, false/nmb_pts, np.mean(dist), np.mean(dist**2)]
+
+
+def _first_minimum(curve):
+    """Return the index of the first local minimum of a curve."""
+    ind = np.nonzero((curve[1:-1] <= curve[:-2])
+                     & (curve[1:-1] <= curve[2:]))[0]
+    return ind[0] + 1 if len(ind) > 0 else int(np.argmin(curve))
+
+
+def select_embedding(data, max_delay=50, max_dim=10, delays=None,
+                     box_nmb=16, fnn_threshold=0.01, ratio=10.0,
+                     theiler_wind=0, nmb_proc=1, nmb_data_to_use=None,
+                     ignored_row=0, col_to_read=1, dtype=None):
+    """
+    Select the embedding delay and dimension.
+
+    The delay is the first minimum of the time delayed mutual information
+    (see 'mutual'). The dimension is the first one for which the false
+    nearest neighbors fraction (see 'false_nearest') drops below
+    'fnn_threshold'.
+    The data is read and digitized once. Each (delay, dimension) neighbor
+    index is built once and cached (see 'nativetools.embedding_index'),
+    so it is only reused by later searches on the same data.
+    For each candidate delay, the dimension is only increased until the
+    threshold is reached, and candidate delays are processed in parallel.
+
+    Parameters
+    ----------
+    data : array or string
+        data, can de an array or a filename.
+    max_delay : integer
+        Maximal delay for the mutual information and autocorrelation
+        (default to 50).
+    max_dim : integer
+        Maximal embedding dimension (default to 10).
+    delays : list of integers
+        Candidate delays for the false nearest neighbors (default to the
+        first minimum of the mutual information and the decorrelation
+        time, i.e. the first delay with an autocorrelation below 1/e).
+    box_nmb : integer
+        Number of boxes for the mutual information partition
+        (default to 16).
+    fnn_threshold : number
+        False nearest neighbors fraction to reach (default to 0.01).
+    ratio : number
+        Ratio factor for the false nearest neighbors (Default to 10.0,
+        'false_nearest' default of 2.0 being too permissive to get
+        fractions close to zero).
+    theiler_wind : integer
+        Theiler window (Default to 0)
+    nmb_proc : integer
+        Number of candidate delays processed at the same time
+        (default to 1).
+    nmb_data_to_use : integer
+        Number of data points to use (default to everything).
+    ignored_row : integer
+        Number of file rows to ignore if 'time_serie' is a file path
+        (Default to 0).
+    col_to_read : integer
+        Number of columns to be read if 'time_serie' is a file path
+        (Default to 1).
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used, default to no conversion).
+
+    Returns
+    -------
+    delay : integer
+        Selected delay.
+    dim : integer
+        Selected dimension (None if the threshold was not reached).
+    curves : dictionary
+        Supporting curves: 'mutual' ([tau, mu] array), 'autocorrelation'
+        ([tau, acf] array), 'decorrelation_time' (integer) and
+        'false_nearest' (dictionary of [dim, fraction, size, size^2]
+        arrays, with the candidate delays as keys).
+    """
+    x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                  ignored_row=ignored_row, col_to_read=col_to_read,
+                  dtype=dtype)
+    max_delay = min(max_delay, len(x) - 2)
+    mut = _mutual_native(digitize(x, box_nmb), box_nmb, max_delay)
+    acf = _autocorrelation(x, max_delay)
+    mi_delay = int(_first_minimum(mut[:, 1]))
+    below = np.nonzero(acf[:, 1] < 1./np.e)[0]
+    decorr_time = int(below[0]) if len(below) > 0 else max_delay
+    if delays is None:
+        delays = sorted(set([max(mi_delay, 1), max(decorr_time, 1)]))
+
+    def fnn_curve(delay):
+        curve = []
+        for dim in range(1, max_dim + 1):
+            if len(x) - dim*delay < 2*theiler_wind + 3:
+                break
+            curve.append(_false_nearest_native(x, dim, delay, ratio,
+                                               theiler_wind))
+            # prune the larger dimensions
+            if curve[-1][1] < fnn_threshold:
+                break
+        return np.array(curve)
+
+    if nmb_proc > 1:
+        with ThreadPoolExecutor(nmb_proc) as pool:
+            curves = list(pool.map(fnn_curve, delays))
+    else:
+        curves = [fnn_curve(delay) for delay in delays]
+    fnn = dict(zip(delays, curves))
+    # preferred delay: the mutual information one if it is a candidate
+    delay = max(mi_delay, 1) if max(mi_delay, 1) in fnn else delays[0]
+    dim = None
+    reached = [row[0] for row in fnn[delay] if row[1] < fnn_threshold]
+    if len(reached) > 0:
+        dim = int(reached[0])
+    curves = {"mutual": mut, "autocorrelation": acf,
+              "decorrelation_time": decorr_time, "false_nearest": fnn}
+    return delay, dim, curves
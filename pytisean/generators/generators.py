@@ -3,7 +3,7 @@
 
 """ TISEAN generators wrappers """
 
-from ..tiseanwrapper import tisean
+from ..tiseanwrapper import tisean, input_extent
 
 __author__ = "Gaby Launay"
 __copyright__ = "Gaby Launay 2017"
@@ -243,8 +243,9 @@ def makenoise(time_serie, noise_level=5, abs_noise_level=None,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row)
     res, msg = tisean('makenoise', args, input_data=time_serie,
-                      output_file=output_file)
+                      output_file=output_file, **extent)
     # return
     if msg != "":
         print(msg)
@@ -2,7 +2,7 @@
 TISEAN linear tools wrapper
 """
 
-from ..tiseanwrapper import tisean
+from ..tiseanwrapper import tisean, input_extent
 
 __author__ = "Gaby Launay"
 __copyright__ = "Gaby Launay 2017"
@@ -14,7 +14,8 @@ __status__ = "Development"
 
 
 def corr(data, nmb_corr=100, std_norm=True, nmb_data_to_use=None,
-         ignored_row=0, col_to_read=1, output_file=None, verbose=0):
+         ignored_row=0, col_to_read=1, output_file=None, verbose=0,
+         dtype=None):
     """
     Computes the autocorrelation of a scalar data set.
 
@@ -39,6 +40,9 @@ def corr(data, nmb_corr=100, std_norm=True, nmb_data_to_use=None,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    dtype : data-type
+        Type the TISEAN input is written with (ex: np.float32 to only
+        write 9 significant digits, default to the data type).
 
     Returns
     -------
@@ -54,7 +58,9 @@ def corr(data, nmb_corr=100, std_norm=True, nmb_data_to_use=None,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
-    res, msg = tisean('corr', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read)
+    res, msg = tisean('corr', args, input_data=data, output_file=output_file,
+                      dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
@@ -105,7 +111,9 @@ def ar_model(data, dim=1, order=5, it_steps=None, nmb_data_to_use=None,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
-    res, msg = tisean('ar-model', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read, dim)
+    res, msg = tisean('ar-model', args, input_data=data,
+                      output_file=output_file, **extent)
     # return
     if msg != "":
         print(msg)
@@ -215,7 +223,9 @@ def pca(data, dim=1, delay=1, output='eigenvalues', modes_to_keep=None,
         args += " -q{}".format(modes_to_keep)
     args = args.split(" ")
     # run command
-    res, msg = tisean('pca', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row)
+    res, msg = tisean('pca', args, input_data=data, output_file=output_file,
+                      **extent)
     # return
     if msg != "":
         print(msg)
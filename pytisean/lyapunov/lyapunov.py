@@ -4,7 +4,7 @@
 """ TISEAN Lyapunov exponents wrappers
 """
 
-from ..tiseanwrapper import tisean
+from ..tiseanwrapper import tisean, input_extent
 
 __copyright__ = "Gaby Launay 2017"
 __credits__ = "Rainer Hegger, Holger Kantz and Thomas Schreiber"
@@ -17,7 +17,8 @@ __status__ = "Development"
 def lyap_k(data, min_dim=2, max_dim=2, delay=1, min_neighbors=None,
            max_neighbors=None, nmb_scales=5, nmb_ref_points=None,
            nmb_it=50, theiler_window=0, nmb_data_to_use=None,
-           ignored_row=0, col_to_read=1, output_file=None, verbose=0):
+           ignored_row=0, col_to_read=1, output_file=None, verbose=0,
+           full_output=False, dtype=None):
     """
     Give an estimation of the largest Lyapunov exponent using the algorithm of
     Kantz.
@@ -63,6 +64,13 @@ def lyap_k(data, min_dim=2, max_dim=2, delay=1, min_neighbors=None,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    full_output : boolean
+        If 'True', return a TiseanResult object (see
+        'tiseanwrapper.TiseanResult'), separating the blocks of each
+        dimension and scale (ex: 'res.block(dim=3, epsilon=1e-3)').
+    dtype : data-type
+        Type the TISEAN input is written with (ex: np.float32 to only
+        write 9 significant digits, default to the data type).
 
     Returns
     -------
@@ -94,16 +102,21 @@ def lyap_k(data, min_dim=2, max_dim=2, delay=1, min_neighbors=None,
         args += " -n{}".format(nmb_ref_points)
     args = args.split(" ")
     # run command
-    res, msg = tisean('lyap_k', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read)
+    res, msg = tisean('lyap_k', args, input_data=data, output_file=output_file,
+                      full_output=full_output, dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
+    if full_output:
+        return res
     return res[:, 0], res[:, 1], res[:, 2]
 
 
 def lyap_r(data, dim=2, delay=1, ignor_window=0, min_neighbors=None,
            nmb_it=50, nmb_data_to_use=None,
-           ignored_row=0, col_to_read=1, output_file=None, verbose=0):
+           ignored_row=0, col_to_read=1, output_file=None, verbose=0,
+           full_output=False, dtype=None):
     """
     Give an estimation of the largest Lyapunov exponent using the algorithm of
     Rosenstein et al.
@@ -137,6 +150,13 @@ def lyap_r(data, dim=2, delay=1, ignor_window=0, min_neighbors=None,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    full_output : boolean
+        If 'True', return a TiseanResult object (see
+        'tiseanwrapper.TiseanResult'), keeping the TISEAN output
+        comments.
+    dtype : data-type
+        Type the TISEAN input is written with (ex: np.float32 to only
+        write 9 significant digits, default to the data type).
 
     Returns
     -------
@@ -159,17 +179,21 @@ def lyap_r(data, dim=2, delay=1, ignor_window=0, min_neighbors=None,
         args += " -r{}".format(min_neighbors)
     args = args.split(" ")
     # run command
-    res, msg = tisean('lyap_r', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read)
+    res, msg = tisean('lyap_r', args, input_data=data, output_file=output_file,
+                      full_output=full_output, dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
+    if full_output:
+        return res
     return res[:, 0], res[:, 1]
 
 
 def lyap_spec(data, dim=2, nmb_comp=1, nmb_it=None, min_neigh=None,
               incr_factor=1.2, nmb_neigh=30, inversion=False,
               nmb_data_to_use=None, ignored_row=0, col_to_read=1,
-              output_file=None, verbose=0):
+              output_file=None, verbose=0, full_output=False, dtype=None):
     """
     Give an estimation of the whole spectrum of Lyapunov exponents
     for a given, possibly multivariate, time series.
@@ -217,6 +241,13 @@ def lyap_spec(data, dim=2, nmb_comp=1, nmb_it=None, min_neigh=None,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    full_output : boolean
+        If 'True', return a TiseanResult object (see
+        'tiseanwrapper.TiseanResult'), keeping the values written in the
+        TISEAN output comments (ex: 'res.estimated_ky_dimension').
+    dtype : data-type
+        Type the TISEAN input is written with (ex: np.float32 to only
+        write 9 significant digits, default to the data type).
 
     Returns
     -------
@@ -244,9 +275,13 @@ def lyap_spec(data, dim=2, nmb_comp=1, nmb_it=None, min_neigh=None,
         args += " -I"
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read, nmb_comp)
     res, msg = tisean('lyap_spec', args, input_data=data,
-                      output_file=output_file)
+                      output_file=output_file, full_output=full_output,
+                      dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
+    if full_output:
+        return res
     return res[:, 0], res[:, 1]
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+from .nativetools import column_indexes, is_binary, load_binary, read_data, \
+    iter_chunks, float_dtype, data_interval, digitize, embed, \
+    NeighborIndex, data_hash, embedding_index, SharedArray
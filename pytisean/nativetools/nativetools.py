@@ -0,0 +1,785 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+""" Shared tools for the native (python) implementations of TISEAN routines
+"""
+
+import fcntl
+import glob
+import hashlib
+import itertools
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+__author__ = "Gaby Launay"
+__copyright__ = "Gaby Launay 2017"
+__credits__ = "Rainer Hegger, Holger Kantz and Thomas Schreiber"
+__license__ = "MIT"
+__version__ = "0.1"
+__email__ = "gaby.launay@tutanota.com"
+__status__ = "Development"
+
+
+def column_indexes(col_to_read, nmb_col_to_read=1):
+    """Return the (0-based) indexes of the columns to read."""
+    if isinstance(col_to_read, str):
+        cols = [int(col) for col in col_to_read.split(',')]
+    elif np.ndim(col_to_read) == 0:
+        cols = [int(col_to_read) + i for i in range(nmb_col_to_read)]
+    else:
+        cols = [int(col) for col in col_to_read]
+    return [col - 1 for col in cols]
+
+
+def load_binary(path):
+    """
+    Load a '.npy' (memory-mapped) or '.npz' (containing only one array)
+    file.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    with np.load(path) as f:
+        if len(f.files) != 1:
+            raise ValueError("'{}' should contain only one array"
+                             .format(path))
+        return f[f.files[0]]
+
+
+def is_binary(path):
+    """Test if a path is a binary ('.npy' or '.npz') data file."""
+    return isinstance(path, str) and path.endswith(('.npy', '.npz'))
+
+
+def read_data(data, nmb_data_to_use=None, ignored_row=0, col_to_read=1,
+              nmb_col_to_read=1, dtype=None, copy=False):
+    """
+    Read data the same way TISEAN routines do.
+
+    Parameters
+    ----------
+    data : array or string
+        data, can de an array (possibly memory-mapped) or a filename
+        (text, '.npy' or '.npz' file).
+    nmb_data_to_use : integer
+        Number of data points to use (default to everything).
+    ignored_row : integer
+        Number of rows to ignore (Default to 0).
+    col_to_read : integer, string or list of integers
+        Column(s) to read, starting from 1 (Default to 1).
+        Can be a TISEAN-like string (ex: '1,3').
+    nmb_col_to_read : integer
+        Number of successive columns to read, starting from 'col_to_read'
+        if it is an integer (Default to 1).
+    dtype : data-type
+        Type of the returned data (default to the array type, or to
+        float64 for text files).
+    copy : boolean
+        If 'True', 'x' never shares memory with 'data' (to be modified
+        in place), the data being only copied if 'x' is still a view of
+        it (default to 'False').
+
+    Returns
+    -------
+    x : array
+        Data, as a 1D array if only one column is read, or as a (n, c)
+        array otherwise.
+        If 'data' is an array (of type 'dtype') and 'copy' is 'False',
+        'x' is a view of it (no copy).
+    """
+    cols = column_indexes(col_to_read, nmb_col_to_read)
+    if is_binary(data):
+        data = load_binary(data)
+    if isinstance(data, SharedArray):
+        data = data.array
+    if isinstance(data, str):
+        x = np.loadtxt(data, comments='#', skiprows=ignored_row,
+                       usecols=cols, ndmin=2,
+                       dtype=float if dtype is None else dtype)
+    else:
+        x = source = np.asarray(data)
+        if x.ndim == 1:
+            x = x[:, np.newaxis]
+        x = x[ignored_row:]
+        if cols == list(range(cols[0], cols[0] + len(cols))):
+            x = x[:, cols[0]:cols[0] + len(cols)]
+        else:
+            x = x[:, cols]
+    if nmb_data_to_use is not None:
+        x = x[:nmb_data_to_use]
+    if dtype is not None:
+        # (only the used rows are converted)
+        x = x.astype(dtype, copy=False)
+    if copy and not isinstance(data, str) and np.may_share_memory(x, source):
+        x = x.copy()
+    if x.shape[1] == 1:
+        x = x[:, 0]
+    return x
+
+
+def iter_chunks(data, chunk_size=2**20, nmb_data_to_use=None, ignored_row=0,
+                col_to_read=1, nmb_col_to_read=1, dtype=None):
+    """
+    Read data by chunks, the same way TISEAN routines do.
+
+    Parameters
+    ----------
+    data : array, string or iterable
+        data, can de an array (possibly memory-mapped), a filename (text,
+        '.npy' or '.npz' file) or an iterable of arrays.
+    chunk_size : integer
+        Number of rows per chunk (default to 2^20), ignored for iterables.
+    nmb_data_to_use, ignored_row, col_to_read, nmb_col_to_read, dtype :
+        See 'read_data'.
+
+    Yields
+    ------
+    x : array
+        Chunks of data (see 'read_data').
+    """
+    remaining = np.inf if nmb_data_to_use is None else nmb_data_to_use
+    if isinstance(data, str) and not is_binary(data):
+        cols = column_indexes(col_to_read, nmb_col_to_read)
+        with open(data, 'r') as f:
+            for _ in range(ignored_row):
+                f.readline()
+            while remaining > 0:
+                lines = list(itertools.islice(f, chunk_size))
+                if len(lines) == 0:
+                    break
+                x = np.loadtxt(lines, comments='#', usecols=cols, ndmin=2,
+                               dtype=float if dtype is None else dtype)
+                x = x[:int(min(remaining, len(x)))]
+                remaining -= len(x)
+                yield x[:, 0] if x.shape[1] == 1 else x
+        return
+    if is_binary(data):
+        data = load_binary(data)
+    if isinstance(data, SharedArray):
+        data = data.array
+    if isinstance(data, np.ndarray):
+        x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                      ignored_row=ignored_row, col_to_read=col_to_read,
+                      nmb_col_to_read=nmb_col_to_read)
+        for start in range(0, len(x), chunk_size):
+            chunk = x[start:start + chunk_size]
+            yield chunk if dtype is None else chunk.astype(dtype, copy=False)
+        return
+    for chunk in data:
+        if remaining <= 0:
+            break
+        x = read_data(chunk, col_to_read=col_to_read,
+                      nmb_col_to_read=nmb_col_to_read, dtype=dtype)
+        x = x[:int(min(remaining, len(x)))]
+        remaining -= len(x)
+        yield x
+
+
+def float_dtype(dtype=None):
+    """
+    Return the floating point type of the native computations
+    (default to float64).
+    """
+    dtype = np.dtype(float if dtype is None else dtype)
+    if dtype.kind != 'f':
+        raise ValueError("'dtype' should be a floating point type")
+    return dtype
+
+
+def data_interval(x):
+    """Return the data interval (max - min over all the components)."""
+    return float(np.max(x) - np.min(x))
+
+
+def digitize(x, box_nmb, data_range=None):
+    """
+    Return the box index of each value for a fixed partition of
+    'data_range' (default to the data range) in 'box_nmb' boxes.
+    """
+    if data_range is None:
+        data_range = (np.min(x), np.max(x))
+    low, high = data_range
+    width = (high - low)/box_nmb
+    if width == 0:
+        width = 1.
+    ind = np.floor((np.asarray(x) - low)/width).astype(int)
+    return np.clip(ind, 0, box_nmb - 1)
+
+
+def embed(x, dim, delay=1):
+    """
+    Return the delay vectors of a time serie.
+
+    Parameters
+    ----------
+    x : array
+        Scalar (n) or multivariate (n, c) time serie.
+    dim : integer
+        Embedding dimension.
+    delay : integer
+        Embedding delay (default to 1).
+
+    Returns
+    -------
+    emb : array
+        (n - (dim - 1)*delay, dim*c) array of delay vectors
+        [x(t), x(t + delay), ..., x(t + (dim - 1)*delay)].
+        For scalar time series, this is a view on 'x' (no copy).
+    """
+    x = np.asarray(x)
+    nmb_vec = len(x) - (dim - 1)*delay
+    if nmb_vec <= 0:
+        raise ValueError("Not enough data for dimension {} and delay {}"
+                         .format(dim, delay))
+    if x.ndim == 1:
+        return np.lib.stride_tricks.as_strided(
+            x, shape=(nmb_vec, dim),
+            strides=(x.strides[0], delay*x.strides[0]),
+            writeable=False)
+    emb = np.lib.stride_tricks.as_strided(
+        x, shape=(nmb_vec, dim, x.shape[1]),
+        strides=(x.strides[0], delay*x.strides[0], x.strides[1]),
+        writeable=False)
+    return emb.reshape(nmb_vec, dim*x.shape[1])
+
+
+class NeighborIndex(object):
+    """
+    Box-assisted neighbor search (as used by TISEAN), with the maximum norm.
+
+    Points are sorted by boxes of size 'cell_size' in the plane of their
+    first two coordinates. A neighbor query only checks the points of the
+    surrounding boxes.
+    Added points are first kept unsorted (and checked one by one by the
+    queries), and inserted in the sorted boxes by batches.
+
+    Parameters
+    ----------
+    points : array
+        (n, d) array of points.
+    cell_size : number
+        Size of the boxes, should be of the order of the query radius.
+    """
+
+    def __init__(self, points, cell_size):
+        points = np.asarray(points)
+        if points.ndim == 1:
+            points = points[:, np.newaxis]
+        if cell_size <= 0:
+            raise ValueError("'cell_size' should be positive")
+        self.points = points
+        self.cell_size = float(cell_size)
+        self._keys = self._cell_keys(points)
+        self._order = np.argsort(self._keys, kind='stable')
+        self._sorted_keys = self._keys[self._order]
+        self._buffer = None
+        self._keys_buffer = None
+        self._set_bounds()
+
+    def __len__(self):
+        return len(self.points)
+
+    def _set_bounds(self):
+        """Store the coordinates bounds (to limit the search radius)."""
+        if len(self.points) == 0:
+            self._low = np.full(self.points.shape[1], np.inf)
+            self._high = np.full(self.points.shape[1], -np.inf)
+        else:
+            self._low = np.min(self.points, axis=0)
+            self._high = np.max(self.points, axis=0)
+
+    def _cells(self, points):
+        return np.floor(points[:, :2]/self.cell_size).astype(np.int64)
+
+    @staticmethod
+    def _combine(cells):
+        if cells.shape[1] == 1:
+            return cells[:, 0]
+        return cells[:, 0]*2**32 + cells[:, 1]
+
+    def _cell_keys(self, points):
+        return self._combine(self._cells(points))
+
+    def _resort(self):
+        """Sort again the points, starting from the previous order."""
+        order = np.argsort(self._keys[self._order], kind='stable')
+        self._order = self._order[order]
+        self._sorted_keys = self._keys[self._order]
+
+    def update(self, points):
+        """
+        Update the points positions.
+
+        Only the points that changed of box are moved, which is cheap if
+        the points only moved slightly.
+        """
+        points = np.asarray(points)
+        if points.ndim == 1:
+            points = points[:, np.newaxis]
+        if points.shape != self.points.shape:
+            raise ValueError("Points should keep the same shape")
+        self._merge()
+        self.points = points
+        self._set_bounds()
+        keys = self._cell_keys(points)
+        if np.any(keys != self._keys):
+            self._keys = keys
+            self._resort()
+
+    def add(self, points):
+        """
+        Add new points to the index.
+
+        New points are indexed after the current ones. They are inserted
+        in the sorted boxes once they are more than an eighth of the
+        points (so that adding points one by one stays cheap).
+        """
+        points = np.asarray(points)
+        if points.ndim == 1:
+            points = points[:, np.newaxis]
+        if len(points) == 0:
+            return
+        nmb = len(self.points)
+        new_nmb = nmb + len(points)
+        # points and keys are stored in growing buffers to limit copies
+        if (self._buffer is None or len(self._buffer) < new_nmb
+                or self.points.base is not self._buffer
+                or self._keys.base is not self._keys_buffer):
+            size = max(2*new_nmb, 1024)
+            buff = np.empty((size, self.points.shape[1]),
+                            dtype=np.result_type(self.points, points))
+            buff[:nmb] = self.points
+            self._buffer = buff
+            self._keys_buffer = np.empty(size, dtype=self._keys.dtype)
+            self._keys_buffer[:nmb] = self._keys
+        self._buffer[nmb:new_nmb] = points
+        self.points = self._buffer[:new_nmb]
+        self._keys_buffer[nmb:new_nmb] = self._cell_keys(points)
+        self._keys = self._keys_buffer[:new_nmb]
+        self._low = np.minimum(self._low, np.min(points, axis=0))
+        self._high = np.maximum(self._high, np.max(points, axis=0))
+        if new_nmb - len(self._order) > max(1024, new_nmb//8):
+            self._merge()
+
+    def _merge(self):
+        """Insert the added points in the sorted boxes."""
+        start = len(self._order)
+        if start == len(self.points):
+            return
+        keys = self._keys[start:]
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        pos = np.searchsorted(self._sorted_keys, keys, 'right')
+        self._order = np.insert(self._order, pos, order + start)
+        self._sorted_keys = np.insert(self._sorted_keys, pos, keys)
+
+    @classmethod
+    def from_sorted(cls, points, cell_size, keys, order):
+        """
+        Create an index from an already sorted state
+        (as given by the 'keys' and 'order' attributes of an other index).
+        """
+        index = cls.__new__(cls)
+        index.points = np.asarray(points)
+        if index.points.ndim == 1:
+            index.points = index.points[:, np.newaxis]
+        index.cell_size = float(cell_size)
+        index._keys = keys
+        index._order = order
+        index._sorted_keys = keys[order]
+        index._buffer = None
+        index._keys_buffer = None
+        index._set_bounds()
+        return index
+
+    @property
+    def keys(self):
+        """Box key of each point."""
+        return self._keys
+
+    @property
+    def order(self):
+        """Indexes of the points, sorted by box."""
+        self._merge()
+        return self._order
+
+    def query(self, queries, eps):
+        """
+        Find all the points closer than 'eps' to the queries.
+
+        Parameters
+        ----------
+        queries : array
+            (q, d) array of query points.
+        eps : number
+            Neighborhood radius (maximum norm).
+
+        Returns
+        -------
+        qind : array
+            Indexes of the queries.
+        nind : array
+            Indexes of the neighbors (in the index points).
+        dist : array
+            Distances between the queries and their neighbors.
+        """
+        queries = np.asarray(queries)
+        if queries.ndim == 1:
+            queries = queries[:, np.newaxis]
+        # added points not sorted yet are checked one by one
+        start = len(self._order)
+        if len(queries)*(len(self.points) - start) > 2**22:
+            self._merge()
+            start = len(self._order)
+        cells = self._cells(queries)
+        rad = int(np.ceil(eps/self.cell_size))
+        # boxes sharing the same first coordinate have contiguous keys
+        if cells.shape[1] == 1:
+            ranges = [(cells - rad, cells + rad)]
+        else:
+            ranges = [(cells + [i, -rad], cells + [i, rad])
+                      for i in range(-rad, rad + 1)]
+        qinds = []
+        ninds = []
+        dists = []
+        for first, last in ranges:
+            low = np.searchsorted(self._sorted_keys, self._combine(first),
+                                  'left')
+            high = np.searchsorted(self._sorted_keys, self._combine(last),
+                                   'right')
+            nmb = high - low
+            tot = np.sum(nmb)
+            if tot == 0:
+                continue
+            qind = np.repeat(np.arange(len(queries)), nmb)
+            pos = np.arange(tot) + np.repeat(low - np.cumsum(nmb) + nmb, nmb)
+            nind = self._order[pos]
+            # reject the far candidates coordinate by coordinate
+            dist = np.abs(self.points[nind, 0] - queries[qind, 0])
+            for i in range(1, queries.shape[1]):
+                filt = dist < eps
+                qind, nind, dist = qind[filt], nind[filt], dist[filt]
+                dist = np.maximum(dist, np.abs(self.points[nind, i]
+                                               - queries[qind, i]))
+            filt = dist < eps
+            qinds.append(qind[filt])
+            ninds.append(nind[filt])
+            dists.append(dist[filt])
+        if start < len(self.points):
+            dist = np.max(np.abs(queries[:, None]
+                                 - self.points[None, start:]), axis=2)
+            qind, nind = np.nonzero(dist < eps)
+            qinds.append(qind)
+            ninds.append(nind + start)
+            dists.append(dist[qind, nind])
+        if len(qinds) == 0:
+            return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                    np.zeros(0, dtype=self.points.dtype))
+        return (np.concatenate(qinds), np.concatenate(ninds),
+                np.concatenate(dists))
+
+    def query_min_neighbors(self, queries, eps, min_nmb, factor=1.2,
+                            exclude=None):
+        """
+        Find the points closer than 'eps' to the queries, increasing 'eps'
+        for the queries with less than 'min_nmb' neighbors.
+
+        Parameters
+        ----------
+        queries : array
+            (q, d) array of query points.
+        eps : number
+            Initial neighborhood radius (maximum norm).
+        min_nmb : integer
+            Minimal number of neighbors.
+        factor : number
+            Factor to increase the radius if not enough neighbors were
+            found (default to 1.2).
+        exclude : function
+            Function of (qind, nind) returning the pairs to exclude
+            (e.g. temporal neighbors).
+            Default to no exclusion.
+
+        Returns
+        -------
+        qind, nind, dist : arrays
+            See 'query', sorted by query.
+        """
+        queries = np.asarray(queries)
+        if queries.ndim == 1:
+            queries = queries[:, np.newaxis]
+        # radius large enough to contain all the points
+        max_eps = np.max(self._high - self._low) + 1.
+        todo = np.arange(len(queries))
+        qinds, ninds, dists = [], [], []
+        while True:
+            qind, nind, dist = self.query(queries[todo], eps)
+            qind = todo[qind]
+            if exclude is not None:
+                filt = ~exclude(qind, nind)
+                qind, nind, dist = qind[filt], nind[filt], dist[filt]
+            counts = np.bincount(qind, minlength=len(queries))[todo]
+            done = (counts >= min_nmb) | (eps > max_eps)
+            filt = np.zeros(len(queries), dtype=bool)
+            filt[todo[done]] = True
+            filt = filt[qind]
+            qinds.append(qind[filt])
+            ninds.append(nind[filt])
+            dists.append(dist[filt])
+            todo = todo[~done]
+            if len(todo) == 0:
+                break
+            eps *= factor
+        qind = np.concatenate(qinds)
+        order = np.argsort(qind, kind='stable')
+        return (qind[order], np.concatenate(ninds)[order],
+                np.concatenate(dists)[order])
+
+    def query_knn(self, queries, k, eps, factor=1.2, exclude=None):
+        """
+        Find the 'k' nearest neighbors of the queries.
+
+        Parameters
+        ----------
+        queries : array
+            (q, d) array of query points.
+        k : integer
+            Number of neighbors.
+        eps : number
+            Initial search radius (should be of the order of the k-th
+            neighbor distance).
+        factor : number
+            Factor to increase the radius if not enough neighbors were
+            found (default to 1.2).
+        exclude : function
+            Function of (qind, nind) returning the pairs to exclude
+            (e.g. temporal neighbors).
+            Default to no exclusion.
+
+        Returns
+        -------
+        nind : array
+            (q, k) array of neighbors indexes, sorted by distance.
+        dist : array
+            (q, k) array of neighbors distances.
+        """
+        qind, nind, dist = self.query_min_neighbors(queries, eps, k,
+                                                    factor=factor,
+                                                    exclude=exclude)
+        order = np.lexsort((dist, qind))
+        qind, nind, dist = qind[order], nind[order], dist[order]
+        counts = np.bincount(qind, minlength=len(queries))
+        if np.any(counts < k):
+            raise ValueError("Less than {} points available".format(k))
+        rank = np.arange(len(qind)) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+        filt = rank < k
+        return nind[filt].reshape(-1, k), dist[filt].reshape(-1, k)
+
+
+def data_hash(x):
+    """Return a hash of the array content (values, shape and type)."""
+    x = np.ascontiguousarray(x)
+    sha = hashlib.sha1(str((x.shape, x.dtype.str)).encode())
+    sha.update(x.view(np.uint8).ravel() if x.size else b'')
+    return sha.hexdigest()
+
+
+# Cache of the neighbor indexes of the last embeddings
+INDEX_CACHE_SIZE = 4
+_INDEX_CACHE = OrderedDict()
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+def embedding_index(x, dim, delay=1, cell_size=None):
+    """
+    Return the delay vectors of a time serie and their neighbor index.
+
+    Indexes are cached, so successive calls on the same time serie and
+    embedding reuse them.
+
+    Parameters
+    ----------
+    x : array
+        Scalar (n) or multivariate (n, c) time serie.
+    dim : integer
+        Embedding dimension.
+    delay : integer
+        Embedding delay (default to 1).
+    cell_size : number
+        Size of the index boxes (default to 1/100 of the data interval).
+
+    Returns
+    -------
+    emb : array
+        Delay vectors (see 'embed').
+    index : NeighborIndex object
+        Neighbor index of the delay vectors.
+    """
+    if cell_size is None:
+        cell_size = data_interval(x)/100.
+    key = (data_hash(x), dim, delay, cell_size)
+    with _INDEX_CACHE_LOCK:
+        if key in _INDEX_CACHE:
+            _INDEX_CACHE.move_to_end(key)
+            return _INDEX_CACHE[key]
+    # private copy, so that the cached index can not be modified
+    emb = embed(np.array(x), dim, delay)
+    index = NeighborIndex(emb, cell_size)
+    with _INDEX_CACHE_LOCK:
+        _INDEX_CACHE[key] = (emb, index)
+        while len(_INDEX_CACHE) > INDEX_CACHE_SIZE:
+            _INDEX_CACHE.popitem(last=False)
+    return emb, index
+
+
+# For the shared arrays scratch files
+SHARED_DIR = os.path.join(tempfile.gettempdir(), 'pytisean/')
+
+
+class SharedArray(object):
+    """
+    Array published once in a memory-mapped scratch file, to be shared
+    (without copy) between processes.
+
+    Pickling a SharedArray only transmits the scratch file path, and
+    unpickled handles map the same data. Handles are reference-counted:
+    the scratch files are removed when the last handle is closed (or
+    garbage collected). A pickled handle holds a reference until it is
+    unpickled (each pickle should be unpickled once, as done by
+    'multiprocessing'), so the publishing handle can be closed while
+    the data is sent to the workers.
+    SharedArray objects can be given as 'data' to the native
+    implementations and to the TISEAN wrappers (the text file read by
+    the TISEAN binaries is written only once, and shared too).
+
+    Parameters
+    ----------
+    array : array
+        Data to publish.
+
+    Examples
+    --------
+    >>> with SharedArray(x) as shared:
+    ...     with multiprocessing.Pool(8) as pool:
+    ...         res = pool.map(analysis, [shared]*8)
+    """
+
+    def __init__(self, array):
+        array = np.asarray(array)
+        if not os.path.isdir(SHARED_DIR):
+            os.makedirs(SHARED_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix='pytisean_shared_', suffix='.npy',
+                                    dir=SHARED_DIR)
+        os.close(fd)
+        shared = np.lib.format.open_memmap(path, mode='w+',
+                                           dtype=array.dtype,
+                                           shape=array.shape)
+        shared[...] = array
+        shared.flush()
+        del shared
+        with open(path + '.refs', 'w') as f:
+            f.write('0')
+        self._attach(path)
+
+    def _attach(self, path, incr=1):
+        self.path = path
+        self._array = None
+        self._closed = False
+        self._update_refs(incr)
+
+    def _update_refs(self, incr):
+        """Update the reference count, and cleanup if it reaches 0."""
+        with open(self.path + '.refs', 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            refs = int(f.read() or 0) + incr
+            f.seek(0)
+            f.truncate()
+            f.write(str(refs))
+            if refs <= 0:
+                # (with the text versions of all types)
+                prefix = glob.escape(self.path[:-4])
+                for path in ([self.path] + glob.glob(prefix + '.txt')
+                             + glob.glob(prefix + '.*.txt')):
+                    if os.path.isfile(path):
+                        os.remove(path)
+                os.remove(self.path + '.refs')
+        return refs
+
+    def __getstate__(self):
+        if self._closed:
+            raise ValueError("SharedArray is closed")
+        # reference of the pickled handle (data in flight)
+        self._update_refs(1)
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        # (the reference taken when pickling is passed to this handle)
+        self._attach(state['path'], incr=0)
+
+    @property
+    def array(self):
+        """Shared data (read-only memory map)."""
+        if self._closed:
+            raise ValueError("SharedArray is closed")
+        if self._array is None:
+            self._array = np.load(self.path, mmap_mode='r')
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+
+    def __len__(self):
+        return len(self.array)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def text_path(self, dtype=None):
+        """Path of the text version of the data (for a given type)."""
+        if dtype is None:
+            return self.path[:-4] + '.txt'
+        return "{}.{}.txt".format(self.path[:-4], np.dtype(dtype).name)
+
+    def text_file(self, writer, dtype=None):
+        """
+        Return the path of the text version of the data (as read by the
+        TISEAN binaries), writing it with 'writer(path, array, dtype)' if
+        it does not exist yet (only once for all the handles).
+        There is one text file per 'dtype' (the data written as this
+        type, default to the data type).
+        """
+        path = self.text_path(dtype)
+        with open(self.path + '.refs', 'r') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if not os.path.isfile(path):
+                writer(path + '.tmp', self.array, dtype=dtype)
+                os.replace(path + '.tmp', path)
+        return path
+
+    def close(self):
+        """Release this handle (and the scratch files if it is the last
+        one)."""
+        if self._closed:
+            return
+        self._array = None
+        self._closed = True
+        self._update_refs(-1)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
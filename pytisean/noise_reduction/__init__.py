@@ -1 +1 @@
-from .noise_reduction import ghkss
+from .noise_reduction import ghkss, lazy
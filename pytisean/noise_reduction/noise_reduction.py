@@ -4,7 +4,16 @@
 """ TISEAN noise reduction methods
 """
 
-from ..tiseanwrapper import tisean
+import itertools
+import multiprocessing
+import tempfile
+
+import numpy as np
+
+from ..nativetools import (read_data, iter_chunks, float_dtype,
+                           data_interval, embed, NeighborIndex, SharedArray)
+from ..tiseanwrapper import tisean, input_extent, write_output, text_format
+from ..store import StoreTarget
 
 __author__ = "Gaby Launay"
 __copyright__ = "Gaby Launay 2017"
@@ -18,7 +27,8 @@ __status__ = "Development"
 def ghkss(data, delay=1, nmb_comp=1, dim=5, dim_manifold=2,
           min_nmb_neigh=30, min_neigh_size=None, nmb_it=1,
           euclidean_metric=False, nmb_data_to_use=None,
-          ignored_row=0, col_to_read=1, output_file=None, verbose=0):
+          ignored_row=0, col_to_read=1, output_file=None, verbose=0,
+          native=False, nmb_proc=1, dtype=None):
     """
     Perform This program performs a noise reduction as proposed in Grassberger
     et al. In principal, it performs a orthogonal projection onto a
@@ -60,6 +70,19 @@ def ghkss(data, delay=1, nmb_comp=1, dim=5, dim_manifold=2,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    native : boolean
+        If 'True', use the native implementation instead of the TISEAN
+        binary (default to 'False').
+        Local covariances are then computed and diagonalized by batches,
+        and the neighbor search structure is updated (not rebuilt) between
+        iterations. Only scalar time series ('nmb_comp=1') are supported.
+    nmb_proc : integer
+        Number of processes sharing the reference points
+        (native implementation only, default to 1).
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used), also used to write the TISEAN input (default to no
+        conversion).
 
     Returns
     -------
@@ -68,6 +91,22 @@ def ghkss(data, delay=1, nmb_comp=1, dim=5, dim_manifold=2,
         (Additional information are avaialable as comments in the result file)
 
     """
+    if native:
+        if nmb_comp != 1:
+            raise ValueError("The native 'ghkss' only handle scalar time "
+                             "series")
+        res = _ghkss_native(data, delay=delay, dim=dim,
+                            dim_manifold=dim_manifold,
+                            min_nmb_neigh=min_nmb_neigh,
+                            min_neigh_size=min_neigh_size, nmb_it=nmb_it,
+                            euclidean_metric=euclidean_metric,
+                            nmb_data_to_use=nmb_data_to_use,
+                            ignored_row=ignored_row,
+                            col_to_read=col_to_read, nmb_proc=nmb_proc,
+                            dtype=dtype)
+        if output_file is not None:
+            write_output(output_file, res)
+        return res
     # prepare arguments
     args = "-x{} -m{},{} -d{} -q{} -k{} -i{} -V{}"\
            .format(ignored_row, nmb_comp, dim, delay, dim_manifold,
@@ -82,8 +121,320 @@ def ghkss(data, delay=1, nmb_comp=1, dim=5, dim_manifold=2,
         args += " -2"
     args = args.split(" ")
     # run command
-    res, msg = tisean('ghkss', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read, nmb_comp)
+    res, msg = tisean('ghkss', args, input_data=data, output_file=output_file,
+                      dtype=dtype, **extent)
+    # return
+    if msg != "":
+        print(msg)
+    return res
+
+
+# Number of reference points processed at once by the native routines
+BATCH_SIZE = 2048
+
+
+def lazy(data, dim=3, radius=None, rel_radius=None, nmb_it=1,
+         nmb_data_to_use=None, ignored_row=0, col_to_read=1,
+         output_file=None, verbose=0, native=False, chunk_size=2**20,
+         dtype=None):
+    """
+    Perform a simple nonlinear noise reduction, replacing the middle
+    coordinate of each delay vector by its average over the neighborhood
+    (locally constant approximation, see Schreiber).
+
+    Parameters
+    ----------
+    data : array or string
+        data, can de an array or a filename (or an iterable of arrays,
+        for the native implementation with 'radius').
+    dim : integer
+        Embedding dimension (default to 3).
+    radius: number, optional
+        Absolute radius of neighbourhoods
+    rel_radius: number, optional
+        Radius of the neighbourhoods relative to the standard deviation
+    nmb_it : integer
+        Number of iterations (default to 1).
+    nmb_data_to_use : integer
+        Number of data points to use (default to everything).
+    ignored_row : integer
+        Number of file rows to ignore if 'time_serie' is a file path
+        (Default to 0).
+    col_to_read : integer
+        Number of columns to be read if 'time_serie' is a file path
+        (Default to 1).
+    output_file : string
+        Output fiel path.
+        If None, do not write a file, just return the map.
+    verbose : integer
+        Verbosity level (defaul to 0 for only fatal errors.
+    native : boolean
+        If 'True', use the native implementation instead of the TISEAN
+        binary (default to 'False').
+        The time serie is then read, processed (by overlapping chunks,
+        neighbors being only searched in the current chunk) and written
+        chunk by chunk, so only a few chunks are in memory.
+    chunk_size : integer
+        Number of points per chunk (native implementation only,
+        default to 2^20).
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used), also used to write the TISEAN input (default to no
+        conversion).
+
+    Returns
+    -------
+    filt_data : array
+        Filtered data.
+        (With the native implementation, this is a memory-mapped array,
+        and nothing is returned if 'output_file' is a file path, as the
+        chunks are directly written to the file.)
+    """
+    if radius is None and rel_radius is None:
+        raise ValueError("You should specify at least 'radius' or "
+                         "'rel_radius'")
+    if native:
+        return _lazy_native(data, dim=dim, radius=radius,
+                            rel_radius=rel_radius, nmb_it=nmb_it,
+                            nmb_data_to_use=nmb_data_to_use,
+                            ignored_row=ignored_row,
+                            col_to_read=col_to_read,
+                            output_file=output_file, chunk_size=chunk_size,
+                            dtype=dtype)
+    # prepare arguments
+    args = "-m{} -i{} -x{} -c{} -V{}"\
+           .format(dim, nmb_it, ignored_row, col_to_read, verbose)
+    if radius is not None:
+        args += " -r{}".format(radius)
+    else:
+        args += " -v{}".format(rel_radius)
+    if nmb_data_to_use is not None:
+        args += " -l{}".format(nmb_data_to_use)
+    args = args.split(" ")
+    # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read)
+    res, msg = tisean('lazy', args, input_data=data, output_file=output_file,
+                      dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
     return res
+
+
+def _lazy_std(chunks):
+    """Standard deviation of a serie read by chunks (in float64)."""
+    nmb, mean, sq_dev = 0, 0., 0.
+    for x in chunks:
+        if len(x) == 0:
+            continue
+        x = np.asarray(x, dtype=np.float64)
+        x_mean = np.mean(x)
+        # (chunks statistics are merged as Chan et al.)
+        tot = nmb + len(x)
+        delta = x_mean - mean
+        sq_dev += np.sum((x - x_mean)**2) + delta**2*nmb*len(x)/tot
+        mean += delta*len(x)/tot
+        nmb = tot
+    if nmb == 0:
+        raise ValueError("No data")
+    return np.sqrt(sq_dev/nmb)
+
+
+def _lazy_filter(buff, dim, radius, nmb_it, means):
+    """Filter in place a part of a serie (see 'lazy')."""
+    mid = dim//2
+    emb = embed(buff, dim)
+    index = None
+    for _ in range(nmb_it):
+        if index is None:
+            index = NeighborIndex(emb, radius)
+        else:
+            index.update(emb)
+        sums = means[:len(emb)]
+        sums[...] = 0
+        counts = np.zeros(len(emb))
+        for batch in range(0, len(emb), BATCH_SIZE):
+            qind, nind, _ = index.query(
+                emb[batch:batch + BATCH_SIZE], radius)
+            sums[batch:batch + BATCH_SIZE] = np.bincount(
+                qind, weights=emb[nind, mid],
+                minlength=min(BATCH_SIZE, len(emb) - batch))
+            counts[batch:batch + BATCH_SIZE] = np.bincount(
+                qind, minlength=min(BATCH_SIZE, len(emb) - batch))
+        sums /= counts
+        buff[mid:mid + len(emb)] = sums
+
+
+def _lazy_native(data, dim=3, radius=None, rel_radius=None, nmb_it=1,
+                 nmb_data_to_use=None, ignored_row=0, col_to_read=1,
+                 output_file=None, chunk_size=2**20, dtype=None):
+    """
+    Native version of 'lazy'.
+
+    The serie is read, filtered and written chunk by chunk, so that the
+    memory used is bounded by 'chunk_size'.
+    """
+    if isinstance(data, (list, tuple)):
+        data = np.asarray(data)
+
+    def chunks():
+        return iter_chunks(data, chunk_size=chunk_size,
+                           nmb_data_to_use=nmb_data_to_use,
+                           ignored_row=ignored_row, col_to_read=col_to_read,
+                           dtype=dtype)
+    # first pass to get the radius
+    if radius is None:
+        if not isinstance(data, (str, np.ndarray, SharedArray)):
+            raise ValueError("'radius' should be given for iterators")
+        radius = rel_radius*_lazy_std(chunks())
+    res_dtype = float_dtype(dtype)
+    pad = dim - 1
+    # preallocated buffers, reused for every chunk
+    # (the neighborhood sums stay in float64)
+    work = np.empty(chunk_size + 2*pad, dtype=res_dtype)
+    means = np.empty(chunk_size + pad)
+
+    def filtered():
+        """
+        Yield the filtered chunks (each chunk is filtered with the 'pad'
+        raw points around it, processed by the neighbor chunks).
+        """
+        prev = np.empty(0, dtype=res_dtype)
+        pending = np.empty(0, dtype=res_dtype)
+        for x in itertools.chain(chunks(), [None]):
+            if x is not None:
+                pending = np.concatenate((pending, x))
+            # (a chunk is processed once the points after it are read)
+            min_nmb = 1 if x is None else chunk_size + pad
+            while len(pending) >= min_nmb:
+                core = min(chunk_size, len(pending))
+                buff = work[:len(prev) + min(len(pending), core + pad)]
+                buff[:len(prev)] = prev
+                buff[len(prev):] = pending[:len(buff) - len(prev)]
+                _lazy_filter(buff, dim, radius, nmb_it, means)
+                yield buff[len(prev):len(prev) + core]
+                prev = np.concatenate((prev, pending[:core]))
+                prev = prev[len(prev) - pad:]
+                pending = pending[core:]
+    # chunks directly written to the output file
+    if output_file is not None and not isinstance(output_file, StoreTarget):
+        fmt = text_format(res_dtype)
+        with open(output_file, 'wb') as f:
+            for chunk in filtered():
+                np.savetxt(f, chunk, fmt=fmt)
+        return
+    # or to a (memory-mapped) temporary file
+    with tempfile.TemporaryFile() as f:
+        nmb = 0
+        for chunk in filtered():
+            f.write(chunk.tobytes())
+            nmb += len(chunk)
+        f.flush()
+        res = np.memmap(f, dtype=res_dtype, mode='r+', shape=(nmb,))
+    if output_file is not None:
+        write_output(output_file, res)
+    return res
+
+
+def _ghkss_corrections(emb, index, start, stop, weights, dim_manifold,
+                       min_nmb_neigh, min_neigh_size):
+    """
+    Compute the projection corrections of the delay vectors
+    'start' to 'stop'.
+    """
+    dim = emb.shape[1]
+    corr = np.empty((stop - start, dim), dtype=emb.dtype)
+    for first in range(start, stop, BATCH_SIZE):
+        last = min(first + BATCH_SIZE, stop)
+        refs = emb[first:last]
+        qind, nind, _ = index.query_min_neighbors(refs, min_neigh_size,
+                                                  min_nmb_neigh)
+        counts = np.bincount(qind, minlength=len(refs))
+        bounds = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        # neighborhoods centers and weighted covariance matrices
+        # (accumulated in float64, even for float32 data)
+        neigh = emb[nind].astype(np.float64)
+        center = np.add.reduceat(neigh, bounds, axis=0)/counts[:, None]
+        dev = (neigh - center[qind])*weights
+        cov = np.add.reduceat(dev[:, :, None]*dev[:, None, :], bounds,
+                              axis=0)/counts[:, None, None]
+        # project onto the directions of smallest variance
+        _, vects = np.linalg.eigh(cov)
+        noise = vects[:, :, :dim - dim_manifold]
+        dev = (refs - center)*weights
+        proj = np.einsum('nij,nj->ni', noise,
+                         np.einsum('nji,nj->ni', noise, dev))
+        corr[first - start:last - start] = proj/weights
+    return corr
+
+
+def _ghkss_worker(job):
+    """Compute the corrections for a block of reference points."""
+    (serie, keys, order, dim, delay, start, stop, weights, dim_manifold,
+     min_nmb_neigh, min_neigh_size) = job
+    try:
+        emb = embed(serie.array, dim, delay)
+        index = NeighborIndex.from_sorted(emb, min_neigh_size, keys.array,
+                                          order.array)
+        return _ghkss_corrections(emb, index, start, stop, weights,
+                                  dim_manifold, min_nmb_neigh,
+                                  min_neigh_size)
+    finally:
+        for shared in [serie, keys, order]:
+            shared.close()
+
+
+def _ghkss_native(data, delay=1, dim=5, dim_manifold=2, min_nmb_neigh=30,
+                  min_neigh_size=None, nmb_it=1, euclidean_metric=False,
+                  nmb_data_to_use=None, ignored_row=0, col_to_read=1,
+                  nmb_proc=1, dtype=None):
+    """Native version of 'ghkss'."""
+    if dim_manifold >= dim:
+        raise ValueError("'dim_manifold' should be smaller than 'dim'")
+    # (modified in place, so not a view of the input)
+    serie = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                      ignored_row=ignored_row, col_to_read=col_to_read,
+                      dtype=float_dtype(dtype), copy=True)
+    if min_neigh_size is None:
+        min_neigh_size = data_interval(serie)/1000.
+    # Tricky metric: corrections are discouraged on the first and last
+    # components of the delay vectors
+    weights = np.ones(dim)
+    if not euclidean_metric:
+        weights[0] = weights[-1] = 1e3
+    emb = embed(serie, dim, delay)
+    index = NeighborIndex(emb, min_neigh_size)
+    # Contributions of the delay vectors corrections to each data point
+    times = (np.arange(len(emb))[:, None] + delay*np.arange(dim)).ravel()
+    nmb_contrib = np.bincount(times, minlength=len(serie))
+    pool = None
+    try:
+        if nmb_proc > 1:
+            pool = multiprocessing.Pool(nmb_proc)
+        bounds = np.linspace(0, len(emb), max(nmb_proc, 1) + 1).astype(int)
+        for _ in range(nmb_it):
+            if pool is not None:
+                # current serie and index, published for the workers
+                with SharedArray(serie) as shared_serie, \
+                        SharedArray(index.keys) as shared_keys, \
+                        SharedArray(index.order) as shared_order:
+                    jobs = [(shared_serie, shared_keys, shared_order, dim,
+                             delay, bounds[i], bounds[i + 1], weights,
+                             dim_manifold, min_nmb_neigh, min_neigh_size)
+                            for i in range(nmb_proc)]
+                    corr = np.concatenate(pool.map(_ghkss_worker, jobs))
+            else:
+                corr = _ghkss_corrections(emb, index, 0, len(emb), weights,
+                                          dim_manifold, min_nmb_neigh,
+                                          min_neigh_size)
+            serie -= (np.bincount(times, weights=corr.ravel(),
+                                  minlength=len(serie))
+                      / np.maximum(nmb_contrib, 1))
+            # points only moved slightly: update the index
+            index.update(emb)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return serie
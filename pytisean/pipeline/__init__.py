@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+from .pipeline import Pipeline, Node
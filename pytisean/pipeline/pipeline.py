@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+""" Analysis pipelines, with memoized intermediate results
+"""
+
+import functools
+import hashlib
+import os
+import pickle
+import types
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from ..nativetools import data_hash, SharedArray
+from ..tiseanwrapper import tisean_pipe
+
+__author__ = "Gaby Launay"
+__copyright__ = "Gaby Launay 2017"
+__credits__ = "Rainer Hegger, Holger Kantz and Thomas Schreiber"
+__license__ = "MIT"
+__version__ = "0.1"
+__email__ = "gaby.launay@tutanota.com"
+__status__ = "Development"
+
+
+def _value_key(value, seen=()):
+    """Return a string identifying the content of an argument value."""
+    if isinstance(value, Node):
+        return "node:" + value.key
+    if isinstance(value, SharedArray):
+        value = value.array
+    if isinstance(value, np.ndarray):
+        return "array:" + data_hash(value)
+    if isinstance(value, (list, tuple)):
+        return "{}({})".format(type(value).__name__,
+                               ",".join(_value_key(val, seen)
+                                        for val in value))
+    if isinstance(value, dict):
+        return "dict({})".format(",".join(
+            "{}:{}".format(_value_key(key, seen), _value_key(val, seen))
+            for key, val in sorted(value.items(), key=repr)))
+    if isinstance(value, str) and os.path.isfile(value):
+        # files are identified by their path, size and modification time
+        stat = os.stat(value)
+        return "file:{}:{}:{}".format(os.path.abspath(value), stat.st_size,
+                                      stat.st_mtime_ns)
+    if callable(value) and not isinstance(value, type):
+        return "func:" + _func_key(value, seen)
+    return _repr_key(value)
+
+
+def _repr_key(value):
+    """Return the representation of a value, if it identifies it."""
+    key = repr(value)
+    if " at 0x" in key:
+        # (memory addresses change between runs)
+        raise ValueError("Cannot identify {} by its content, give an "
+                         "explicit key (see 'Pipeline.add_named')"
+                         .format(key))
+    return key
+
+
+def _code_key(code):
+    """Return a string identifying a code object (and its constants)."""
+    consts = [_code_key(const) if isinstance(const, types.CodeType)
+              else repr(const) for const in code.co_consts]
+    return "{}:{}:{}".format(code.co_code.hex(), ",".join(consts),
+                             ",".join(code.co_names))
+
+
+def _func_key(func, seen=()):
+    """
+    Return a string identifying a function: its name, code, constants,
+    defaults and closure values.
+    """
+    if id(func) in seen:
+        # (recursive closures)
+        return "recursive"
+    seen = seen + (id(func),)
+    if isinstance(func, functools.partial):
+        return "partial({},{},{})".format(_func_key(func.func, seen),
+                                          _value_key(func.args, seen),
+                                          _value_key(func.keywords, seen))
+    if isinstance(func, types.MethodType):
+        return "method({},{})".format(_func_key(func.__func__, seen),
+                                      _value_key(func.__self__, seen))
+    name = "{}.{}".format(getattr(func, '__module__', ''),
+                          getattr(func, '__qualname__', ''))
+    if not isinstance(func, types.FunctionType):
+        if hasattr(func, '__wrapped__'):
+            # (decorated functions)
+            return name + ":" + _func_key(func.__wrapped__, seen)
+        if hasattr(func, '__qualname__'):
+            # builtins
+            return name
+        # other callables
+        return name + ":" + _repr_key(func)
+    cells = [_value_key(cell.cell_contents, seen)
+             for cell in func.__closure__ or ()]
+    return "{}:{}:{}:{}:{}".format(
+        name, _code_key(func.__code__),
+        _value_key(func.__defaults__ or (), seen),
+        _value_key(func.__kwdefaults__ or {}, seen), ",".join(cells))
+
+
+def _run_command(command, args, input_data=None):
+    """Run a TISEAN command (see 'Pipeline.add_command')."""
+    return tisean_pipe([(command, args)], input_data)[0]
+
+
+class Node(object):
+    """
+    Operation of a pipeline (see 'Pipeline.add').
+
+    Parameters
+    ----------
+    func : function
+        Operation.
+    args, kwargs :
+        Arguments of the operation, can be other nodes (replaced by their
+        results).
+    key : string
+        Key identifying the operation, replacing its name and code in the
+        node hash (default to the operation name, code, constants,
+        defaults and closure values).
+    """
+
+    def __init__(self, func, args=(), kwargs=None, key=None):
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        # content hash of the operation and of all its inputs
+        sha = hashlib.sha1()
+        sha.update(("key:" + key if key is not None else _func_key(func))
+                   .encode())
+        for arg in self.args:
+            sha.update(_value_key(arg).encode())
+        for name in sorted(self.kwargs):
+            sha.update("{}={}".format(name, _value_key(self.kwargs[name]))
+                       .encode())
+        self.key = sha.hexdigest()
+
+    @property
+    def inputs(self):
+        """Nodes this node depends on."""
+        values = list(self.args) + list(self.kwargs.values())
+        return [val for val in values if isinstance(val, Node)]
+
+    @property
+    def is_command(self):
+        """If the node is a TISEAN command (see 'Pipeline.add_command')."""
+        return self.func is _run_command
+
+    def __repr__(self):
+        return "Node({}, {})".format(getattr(self.func, '__name__', '?'),
+                                     self.key[:8])
+
+
+class Pipeline(object):
+    """
+    Pipeline of operations (a directed acyclic graph of nodes).
+
+    Each node result is memoized by the content hash of the node
+    operation, arguments and inputs: running again a pipeline where only
+    downstream parameters were changed does not recompute the upstream
+    nodes.
+    Intermediate results are given to the next nodes in memory (as
+    arrays, without going through files).
+    Chains of TISEAN commands (see 'add_command') are streamed: the
+    intermediate commands only used by the next one of the chain are
+    connected by OS pipes, and their results are never materialized.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Directory where to also store the node results, to reuse them
+        between sessions (default to memory only).
+
+    Examples
+    --------
+    >>> pipe = Pipeline()
+    >>> noisy = pipe.add(makenoise, x, noise_level=5)
+    >>> clean = pipe.add(ghkss, noisy, dim=7, native=True)
+    >>> res = pipe.run([pipe.add(d2, clean, max_dim=5),
+    ...                 pipe.add(mutual, clean, native=True)], nmb_proc=2)
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._memo = {}
+        self.nmb_computed = 0
+
+    def add(self, func, *args, **kwargs):
+        """
+        Add an operation to the pipeline.
+
+        Parameters
+        ----------
+        func : function
+            Operation (ex: 'ghkss', 'delay', 'pca', 'd2', or any other
+            function).
+        args, kwargs :
+            Arguments of the operation. Can be other nodes, replaced by
+            their results when running the pipeline.
+
+        Returns
+        -------
+        node : Node object
+        """
+        return Node(func, args, kwargs)
+
+    def add_named(self, key, func, *args, **kwargs):
+        """
+        Add an operation identified by an explicit key (for operations
+        that cannot be identified by their code, as callable objects).
+
+        Parameters
+        ----------
+        key : string
+            Key identifying the operation (should change when the
+            operation does).
+        func, args, kwargs :
+            See 'add'.
+
+        Returns
+        -------
+        node : Node object
+        """
+        return Node(func, args, kwargs, key=key)
+
+    def add_command(self, command, args, data=None):
+        """
+        Add a TISEAN command to the pipeline.
+
+        Consecutive commands are run at the same time, connected by OS
+        pipes, when the intermediate results are not needed elsewhere
+        (see 'tiseanwrapper.tisean_pipe').
+
+        Parameters
+        ----------
+        command : string
+            TISEAN routine.
+        args : list of strings
+            Arguments of the routine, without input and output files
+            (ex: ['-m1,7', '-q2']).
+        data : array, string, SharedArray or Node object
+            Input data (if necessary).
+
+        Returns
+        -------
+        node : Node object
+
+        Examples
+        --------
+        >>> noisy = pipe.add_command('makenoise', ['-%5'], 'data.dat')
+        >>> clean = pipe.add_command('ghkss', ['-m1,7', '-q2'], noisy)
+        """
+        return Node(_run_command, (command, tuple(args), data))
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def _lookup(self, key):
+        """Return (found, result) from the memo or the cache directory."""
+        if key in self._memo:
+            return True, self._memo[key]
+        if self.cache_dir is not None \
+                and os.path.isfile(self._cache_path(key)):
+            with open(self._cache_path(key), 'rb') as f:
+                self._memo[key] = pickle.load(f)
+            return True, self._memo[key]
+        return False, None
+
+    def _store(self, key, res):
+        self._memo[key] = res
+        if self.cache_dir is not None:
+            # atomic write, for concurrent pipelines sharing the directory
+            path = self._cache_path(key)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(res, f)
+            os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _stream_source(node, streamed):
+        """
+        Return the streamed chain of commands ending with a node, and the
+        chain input.
+        """
+        stages = []
+        while True:
+            command, args, data = node.args
+            stages.insert(0, (command, list(args)))
+            if not isinstance(data, Node) or data.key not in streamed:
+                return stages, data
+            node = data
+
+    def _inputs(self, node, streamed):
+        """Nodes whose results are needed to compute a node."""
+        if node.is_command:
+            _, data = self._stream_source(node, streamed)
+            return [data] if isinstance(data, Node) else []
+        return node.inputs
+
+    def _compute(self, node, streamed):
+        def value(val):
+            return self._memo[val.key] if isinstance(val, Node) else val
+        if node.is_command:
+            stages, data = self._stream_source(node, streamed)
+            res, _ = tisean_pipe(stages, value(data))
+            self.nmb_computed += len(stages)
+            return res
+        args = [value(arg) for arg in node.args]
+        kwargs = {name: value(val) for name, val in node.kwargs.items()}
+        res = node.func(*args, **kwargs)
+        self.nmb_computed += 1
+        return res
+
+    def run(self, targets, nmb_proc=1):
+        """
+        Compute the results of some nodes (and of the nodes they depend
+        on, if not memoized).
+
+        Parameters
+        ----------
+        targets : Node object or list of Node objects
+            Nodes to compute.
+        nmb_proc : integer
+            Number of independent nodes computed at the same time
+            (default to 1).
+
+        Returns
+        -------
+        res :
+            Results of the target(s).
+        """
+        single = isinstance(targets, Node)
+        if single:
+            targets = [targets]
+        # nodes to compute (only looking upstream of non-memoized nodes)
+        todo = {}
+        stack = list(targets)
+        while stack:
+            node = stack.pop()
+            if node.key in todo or self._lookup(node.key)[0]:
+                continue
+            todo[node.key] = node
+            stack.extend(node.inputs)
+        # commands only used by the next command are streamed into it
+        consumers = {}
+        for node in todo.values():
+            for inp in set(inp.key for inp in node.inputs):
+                consumers.setdefault(inp, []).append(node)
+        target_keys = set(node.key for node in targets)
+        streamed = set(key for key, node in todo.items()
+                       if node.is_command and key not in target_keys
+                       and len(consumers.get(key, [])) == 1
+                       and consumers[key][0].is_command)
+        for key in streamed:
+            del todo[key]
+        # run the nodes whose inputs are ready
+        pending = {}
+        with ThreadPoolExecutor(max(1, nmb_proc)) as pool:
+            while todo or pending:
+                for key, node in list(todo.items()):
+                    if all(inp.key in self._memo
+                           for inp in self._inputs(node, streamed)):
+                        del todo[key]
+                        future = pool.submit(self._compute, node, streamed)
+                        pending[future] = node
+                if not pending:
+                    raise ValueError("Pipeline contains a cycle")
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = pending.pop(future)
+                    self._store(node.key, future.result())
+        res = [self._memo[node.key] for node in targets]
+        return res[0] if single else res
+
+    def clear(self):
+        """Forget the memoized results (not the cache directory ones)."""
+        self._memo = {}
@@ -1 +1,2 @@
-from .prediction import lzo_test
+from .prediction import lzo_test, local_linear_forecast, \
+    LocalConstantForecaster
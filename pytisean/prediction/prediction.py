@@ -4,7 +4,11 @@
 """ TISEAN prediction tools wrappers
 """
 
-from ..tiseanwrapper import tisean
+import numpy as np
+
+from ..nativetools import (read_data, data_interval, embed,
+                           embedding_index, NeighborIndex)
+from ..tiseanwrapper import tisean, input_extent, write_output
 
 __author__ = "Gaby Launay"
 __copyright__ = "Gaby Launay 2017"
@@ -20,7 +24,7 @@ def lzo_test(data, dim=2, delay=1, nmb_comp=1, nmb_error=None,
              neigh_incr_factor=1.2, forecasted_steps=1,
              caus_win_size=None, nmb_data_to_use=None,
              ignored_row=0, col_to_read=None,
-             output_file=None, verbose=0):
+             output_file=None, verbose=0, native=False, dtype=None):
     """
     Compute the forecasting error using a zeroth order NL model.
 
@@ -67,6 +71,18 @@ def lzo_test(data, dim=2, delay=1, nmb_comp=1, nmb_error=None,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    native : boolean
+        If 'True', use the native implementation instead of the TISEAN
+        binary (default to 'False').
+        All the reference points are then processed by batches, the
+        errors for all the forecasted steps coming from the same
+        neighborhoods. The neighbor index of an embedding is cached, and
+        reused by subsequent calls on the same data with the same
+        'dim' and 'delay'.
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used), also used to write the TISEAN input (default to no
+        conversion).
 
     Returns
     -------
@@ -75,6 +91,20 @@ def lzo_test(data, dim=2, delay=1, nmb_comp=1, nmb_error=None,
        Following columns : relative forecast errors.
        As many lines as 'forecasted_steps'
     """
+    if native:
+        res = _lzo_test_native(data, dim=dim, delay=delay, nmb_comp=nmb_comp,
+                               nmb_error=nmb_error, dist_ref=dist_ref,
+                               min_nmb_neigh=min_nmb_neigh,
+                               neigh_init_size=neigh_init_size,
+                               neigh_incr_factor=neigh_incr_factor,
+                               forecasted_steps=forecasted_steps,
+                               caus_win_size=caus_win_size,
+                               nmb_data_to_use=nmb_data_to_use,
+                               ignored_row=ignored_row,
+                               col_to_read=col_to_read, dtype=dtype)
+        if output_file is not None:
+            write_output(output_file, res)
+        return res
     # prepare arguments
     args = "-x{} -m{},{} -d{} -S{} -k{} -f{} -s{} -V{}" \
            .format(ignored_row, nmb_comp, dim, delay, dist_ref, min_nmb_neigh,
@@ -91,9 +121,388 @@ def lzo_test(data, dim=2, delay=1, nmb_comp=1, nmb_error=None,
         args += " -C{}".format(caus_win_size)
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read, nmb_comp)
     res, msg = tisean('lzo-test', args, input_data=data,
-                      output_file=output_file)
+                      output_file=output_file, dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
     return res
+
+
+# Number of reference points processed at once by the native routines
+BATCH_SIZE = 2048
+
+
+def _lzo_test_native(data, dim=2, delay=1, nmb_comp=1, nmb_error=None,
+                     dist_ref=1, min_nmb_neigh=30, neigh_init_size=None,
+                     neigh_incr_factor=1.2, forecasted_steps=1,
+                     caus_win_size=None, nmb_data_to_use=None,
+                     ignored_row=0, col_to_read=None, dtype=None):
+    """Native version of 'lzo_test'."""
+    if col_to_read is None:
+        col_to_read = 1
+    x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                  ignored_row=ignored_row, col_to_read=col_to_read,
+                  nmb_col_to_read=nmb_comp, dtype=dtype)
+    x = x.reshape(len(x), -1)
+    if neigh_init_size is None:
+        neigh_init_size = data_interval(x)/1000.
+    if caus_win_size is None:
+        caus_win_size = forecasted_steps
+    steps = np.arange(1, forecasted_steps + 1)
+    emb, index = embedding_index(x, dim, delay)
+    # time of the last component of each delay vector
+    shift = (dim - 1)*delay
+    nmb_vec = len(x) - shift - forecasted_steps
+    if nmb_vec <= 0:
+        raise ValueError("Time serie too short")
+    refs = np.arange(0, nmb_vec, dist_ref)
+    if nmb_error is not None:
+        refs = refs[:nmb_error]
+    sq_err = np.zeros((forecasted_steps, x.shape[1]))
+    for first in range(0, len(refs), BATCH_SIZE):
+        batch = refs[first:first + BATCH_SIZE]
+
+        def exclude(qind, nind):
+            """Exclude causal neighbors and neighbors without future."""
+            return ((nind >= nmb_vec)
+                    | (np.abs(nind - batch[qind]) < caus_win_size))
+
+        qind, nind, _ = index.query_min_neighbors(
+            emb[batch], neigh_init_size, min_nmb_neigh,
+            factor=neigh_incr_factor, exclude=exclude)
+        counts = np.bincount(qind, minlength=len(batch))
+        valid = counts > 0
+        # forecasts for all the steps from the same neighborhoods
+        for i, step in enumerate(steps):
+            for comp in range(x.shape[1]):
+                pred = np.bincount(qind, weights=x[nind + shift + step, comp],
+                                   minlength=len(batch))
+                pred = pred[valid]/counts[valid]
+                true = x[batch[valid] + shift + step, comp]
+                sq_err[i, comp] += np.sum((pred - true)**2)
+    rel_err = np.sqrt(sq_err/len(refs))/np.std(x, axis=0, dtype=np.float64)
+    return np.column_stack((steps, rel_err))
+
+
+def _local_linear_iterate(x, emb, index, delay, times, nmb_neigh, steps,
+                          regul, neigh_init_size, caus_win_size):
+    """
+    Iterate local linear one step forecasts from the given times.
+
+    Returns a (len(times), steps) array of forecasts.
+    """
+    dim = emb.shape[1]
+    shift = (dim - 1)*delay
+    # delay vectors with a known next value
+    nmb_vec = len(emb) - 1
+    refs = times - shift
+    hist = x[times[:, None] + np.arange(-shift, 1)].astype(float)
+    lamb = regul*nmb_neigh*np.var(x)
+    forecasts = np.empty((len(times), steps))
+    for step in range(steps):
+        states = hist[:, ::delay]
+
+        def exclude(qind, nind):
+            """Exclude causal neighbors and neighbors without future."""
+            return ((nind >= nmb_vec)
+                    | (np.abs(nind - refs[qind]) < caus_win_size))
+
+        nind, _ = index.query_knn(states, nmb_neigh, neigh_init_size,
+                                  exclude=exclude)
+        # stacked regularized least squares: x(t + 1) = a + b.(v - state)
+        design = np.ones((len(times), nmb_neigh, dim + 1))
+        design[:, :, 1:] = emb[nind] - states[:, None, :]
+        target = x[nind + shift + 1]
+        lhs = np.einsum('nki,nkj->nij', design, design)
+        lhs[:, np.arange(1, dim + 1), np.arange(1, dim + 1)] += lamb
+        rhs = np.einsum('nki,nk->ni', design, target)
+        coefs = np.linalg.solve(lhs, rhs[:, :, None])[:, :, 0]
+        forecasts[:, step] = coefs[:, 0]
+        hist = np.column_stack((hist[:, 1:], coefs[:, 0]))
+    return forecasts
+
+
+def local_linear_forecast(data, dim=2, delay=1, nmb_neigh=30,
+                          forecasted_steps=1, queries=None, regul=1e-3,
+                          nmb_error=None, dist_ref=1, neigh_init_size=None,
+                          caus_win_size=None, nmb_data_to_use=None,
+                          ignored_row=0, col_to_read=1, dtype=None):
+    """
+    Iterated forecasts using local linear models (as TISEAN 'nstep').
+
+    For each state, a linear model is fitted (by regularized least
+    squares) on its 'nmb_neigh' nearest neighbors to get a one step
+    forecast. The forecast is then iterated. All the states are processed
+    at once, with stacked least squares problems.
+
+    Parameters
+    ----------
+    data : array or string
+        data, can de an array or a filename.
+    dim : integer
+        Embedding dimension (default to 2).
+    delay : integer
+        Embedding delay (default to 1).
+    nmb_neigh : integer
+        Number of neighbors used for the fits (default to 30).
+    forecasted_steps : integer
+        Number of iterated forecast steps (default to 1).
+    queries : array of integers
+        Times to forecast from, between '(dim - 1)*delay' and the last
+        point (default to the last point).
+    regul : number
+        Regularization of the linear fits, relative to the data variance
+        (default to 1e-3).
+    nmb_error : integer
+        Number of points where the in-sample error should be computed
+        (default to all).
+    dist_ref : integer
+        Temporal distance between the in-sample reference points
+        (default to 1).
+    neigh_init_size : number
+        Neighborhood size to start the neighbors search with
+        (default to 1% of the data interval).
+    caus_win_size : integer
+        Width of the causality window for the in-sample errors (default
+        to 'forecasted_steps').
+    nmb_data_to_use : integer
+        Number of data points to use (default to everything).
+    ignored_row : integer
+        Number of file rows to ignore if 'data' is a file path
+        (Default to 0).
+    col_to_read : integer
+        Number of columns to be read if 'data' is a file path
+        (Default to 1).
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used by the neighbor search, default to no conversion).
+        The linear fits are computed in float64.
+
+    Returns
+    -------
+    forecasts : array
+        (len(queries), forecasted_steps) array of forecasts.
+    errors : array
+        First column : forecasted steps.
+        Second column : relative (to the standard deviation) in-sample
+        forecast errors.
+    """
+    x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                  ignored_row=ignored_row, col_to_read=col_to_read,
+                  dtype=dtype)
+    if neigh_init_size is None:
+        neigh_init_size = data_interval(x)/100.
+    if caus_win_size is None:
+        caus_win_size = forecasted_steps
+    emb, index = embedding_index(x, dim, delay)
+    shift = (dim - 1)*delay
+    if queries is None:
+        queries = [len(x) - 1]
+    queries = np.asarray(queries, dtype=int)
+    # (queries need a full delay vector of past values)
+    if np.any(queries < shift) or np.any(queries > len(x) - 1):
+        raise ValueError("Queries should be between {} and {}"
+                         .format(shift, len(x) - 1))
+    # (the in-sample errors need points with 'forecasted_steps' known
+    # next values)
+    if len(x) - forecasted_steps <= shift:
+        raise ValueError("Not enough data to forecast {} steps"
+                         .format(forecasted_steps))
+    forecasts = np.empty((len(queries), forecasted_steps))
+    for first in range(0, len(queries), BATCH_SIZE):
+        forecasts[first:first + BATCH_SIZE] = _local_linear_iterate(
+            x, emb, index, delay, queries[first:first + BATCH_SIZE],
+            nmb_neigh, forecasted_steps, regul, neigh_init_size, 0)
+    # in-sample errors
+    refs = np.arange(shift, len(x) - forecasted_steps, dist_ref)
+    if nmb_error is not None:
+        refs = refs[:nmb_error]
+    sq_err = np.zeros(forecasted_steps)
+    steps = np.arange(1, forecasted_steps + 1)
+    for first in range(0, len(refs), BATCH_SIZE):
+        batch = refs[first:first + BATCH_SIZE]
+        pred = _local_linear_iterate(x, emb, index, delay, batch, nmb_neigh,
+                                     forecasted_steps, regul,
+                                     neigh_init_size, caus_win_size)
+        sq_err += np.sum((pred - x[batch[:, None] + steps])**2, axis=0)
+    errors = np.column_stack((steps, np.sqrt(sq_err/len(refs))/np.std(x)))
+    return forecasts, errors
+
+
+class LocalConstantForecaster(object):
+    """
+    Locally constant forecaster (as TISEAN 'predict'), keeping its
+    neighbor index in memory.
+
+    The forecast of a state is the average future of its neighbors in
+    the delay embedding space. Once fitted, forecasts only need a neighbor
+    query, and new observations can be appended without rebuilding the
+    index.
+
+    Parameters
+    ----------
+    delay: integer
+        Delay
+    dim: integer
+        Embedding dimension
+    radius: number, optional
+        Absolute radius of neighbourhoods
+    rel_radius: number, optional
+        Radius of the neighbourhoods relative to the standard deviation
+        (of the data of each fit).
+    min_nmb_neigh : integer
+        Minimal number of neighbors, the radius is increased if not enough
+        neighbors are found (default to 1).
+    neigh_incr_factor : number
+        Factor to increase the neighborhood size if not enough neighbors
+        were found (default to 1.2).
+    """
+
+    def __init__(self, delay, dim, radius=None, rel_radius=None,
+                 min_nmb_neigh=1, neigh_incr_factor=1.2):
+        if radius is None and rel_radius is None:
+            raise ValueError("You should specify at least 'radius' or "
+                             "'rel_radius'")
+        self.delay = delay
+        self.dim = dim
+        self.radius = radius
+        self.rel_radius = rel_radius
+        self.min_nmb_neigh = min_nmb_neigh
+        self.neigh_incr_factor = neigh_incr_factor
+        self.serie = None
+        self.index = None
+        self._buffer = None
+        # (radius used, resolved from 'rel_radius' at each 'fit')
+        self._radius = None
+
+    def fit(self, data, nmb_data_to_use=None, ignored_row=0, col_to_read=1,
+            dtype=None):
+        """
+        Build the neighbor index of a scalar time serie.
+
+        Parameters
+        ----------
+        data : array or string
+            data, can de an array or a filename.
+        nmb_data_to_use : integer
+            Number of data points to use (default to everything).
+        ignored_row : integer
+            Number of file rows to ignore if 'time_serie' is a file path
+            (Default to 0).
+        col_to_read : integer
+            Number of columns to be read if 'time_serie' is a file path
+            (Default to 1).
+        dtype : data-type
+            Floating point type the serie is kept in (ex: np.float32,
+            default to the data type, or float64 for integer data).
+
+        Returns
+        -------
+        self : LocalConstantForecaster object
+        """
+        serie = np.array(read_data(data, nmb_data_to_use=nmb_data_to_use,
+                                   ignored_row=ignored_row,
+                                   col_to_read=col_to_read, dtype=dtype))
+        if serie.dtype.kind != 'f':
+            serie = serie.astype(float)
+        if self.radius is None:
+            self._radius = self.rel_radius*np.std(serie)
+        else:
+            self._radius = self.radius
+        self.serie = serie
+        self.index = NeighborIndex(embed(serie, self.dim, self.delay),
+                                   self._radius)
+        return self
+
+    def append(self, values):
+        """
+        Append new observations, and index the new delay vectors.
+        """
+        if self.index is None:
+            raise Exception("The forecaster should be fitted first")
+        # (appended values keep the serie type)
+        values = np.atleast_1d(np.asarray(values, dtype=self.serie.dtype))
+        nmb_vec = len(self.index)
+        nmb = len(self.serie)
+        new_nmb = nmb + len(values)
+        # the serie is stored in a growing buffer to limit copies
+        if (self._buffer is None or len(self._buffer) < new_nmb
+                or self.serie.base is not self._buffer):
+            self._buffer = np.empty(max(2*new_nmb, 1024),
+                                    dtype=self.serie.dtype)
+            self._buffer[:nmb] = self.serie
+        self._buffer[nmb:new_nmb] = values
+        self.serie = self._buffer[:new_nmb]
+        # (only the new delay vectors are embedded)
+        self.index.add(embed(self.serie[nmb_vec:], self.dim, self.delay))
+
+    def predict(self, k_steps=1, state=None):
+        """
+        Forecast the next values.
+
+        Parameters
+        ----------
+        k_steps : integer
+            Number of steps ahead to forecast (default to 1).
+        state : array
+            Delay vector [x(t - (dim - 1)*delay), ..., x(t)] to forecast
+            from (default to the last delay vector of the time serie).
+
+        Returns
+        -------
+        forecast : array
+            Forecasts for the steps 1 to 'k_steps'.
+        """
+        if self.index is None:
+            raise Exception("The forecaster should be fitted first")
+        if state is None:
+            state = self.index.points[-1]
+        shift = (self.dim - 1)*self.delay
+        # only the delay vectors with a known future can be used
+        nmb_vec = len(self.serie) - shift - k_steps
+        if nmb_vec <= 0:
+            raise ValueError("Not enough data to forecast {} steps"
+                             .format(k_steps))
+        _, nind, _ = self.index.query_min_neighbors(
+            np.reshape(state, (1, -1)), self._radius, self.min_nmb_neigh,
+            factor=self.neigh_incr_factor,
+            exclude=lambda qind, nind: nind >= nmb_vec)
+        futures = self.serie[nind[:, None] + shift + np.arange(1, k_steps + 1)]
+        return np.mean(futures, axis=0)
+
+    def save(self, path):
+        """
+        Save the fitted forecaster (with its index) in a '.npz' file.
+        """
+        if self.index is None:
+            raise Exception("The forecaster should be fitted first")
+        # (unset radii are saved as NaN)
+        radii = [np.nan if radius is None else radius
+                 for radius in [self.radius, self.rel_radius]]
+        np.savez(path, serie=self.serie, keys=self.index.keys,
+                 order=self.index.order,
+                 params=[self.delay, self.dim, self._radius,
+                         self.min_nmb_neigh, self.neigh_incr_factor],
+                 radii=radii)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a forecaster saved with 'save' (the index is not rebuilt).
+        """
+        with np.load(path) as f:
+            delay, dim, radius, min_nmb_neigh, factor = f["params"]
+            abs_radius, rel_radius = [None if np.isnan(val) else float(val)
+                                      for val in f["radii"]]
+            forecaster = cls(int(delay), int(dim), radius=abs_radius,
+                             rel_radius=rel_radius,
+                             min_nmb_neigh=int(min_nmb_neigh),
+                             neigh_incr_factor=factor)
+            forecaster._radius = radius
+            forecaster.serie = f["serie"]
+            forecaster.index = NeighborIndex.from_sorted(
+                embed(forecaster.serie, forecaster.dim, forecaster.delay),
+                radius, f["keys"], f["order"])
+        return forecaster
@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+from .runner import main, load_spec, expand_jobs, run_job, run_jobs
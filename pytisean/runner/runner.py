@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+""" Command-line batch runner, driven by a job specification file
+"""
+
+import argparse
+import functools
+import glob
+import inspect
+import json
+import os
+import pickle
+import sys
+import time
+import traceback
+
+from ..batch import CostModel, run_scheduled, get_analysis
+from ..batch.batch import _input_hash
+
+__author__ = "Gaby Launay"
+__copyright__ = "Gaby Launay 2017"
+__credits__ = "Rainer Hegger, Holger Kantz and Thomas Schreiber"
+__license__ = "MIT"
+__version__ = "0.1"
+__email__ = "gaby.launay@tutanota.com"
+__status__ = "Development"
+
+
+def load_spec(path):
+    """
+    Load a job specification file (JSON, or TOML if the file extension is
+    '.toml').
+
+    A specification contains:
+    - 'inputs': list of input file globs,
+    - 'analyses': list of analyses, as dictionaries with a 'function'
+      (ex: 'lyap_r' or 'lyapunov.lyap_r'), an optional 'name' (default to
+      the function name) and optional 'params' (function arguments),
+    - 'output_dir': output directory (default to 'results'),
+    - 'nmb_proc': number of jobs run at the same time (default to 1),
+    - 'max_memory': maximal estimated memory (in bytes) of the jobs run at
+      the same time (default to no limit),
+    - 'cost_model': JSON file where the jobs durations calibration is kept
+      (default to no calibration between runs).
+    """
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            # (same binary API, before Python 3.11)
+            import tomli as tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def expand_jobs(spec):
+    """
+    Expand a job specification into a list of jobs (one per input file and
+    analysis).
+
+    Outputs keep the input paths relative to their common directory
+    (ex: 'a/run1.txt' and 'b/run1.txt' give 'a/run1.<name>' and
+    'b/run1.<name>' in the output directory).
+    """
+    output_dir = spec.get('output_dir', 'results')
+    paths = []
+    for pattern in spec['inputs']:
+        paths += sorted(glob.glob(pattern))
+    paths = sorted(set(os.path.abspath(path) for path in paths))
+    if len(paths) > 0:
+        root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    jobs = []
+    for path in paths:
+        stem = os.path.splitext(os.path.relpath(path, root))[0]
+        for analysis in spec['analyses']:
+            name = analysis.get('name', analysis['function'].split('.')[-1])
+            jobs.append({'input': path,
+                         'function': analysis['function'],
+                         'name': name,
+                         'params': analysis.get('params', {}),
+                         'output': os.path.join(output_dir,
+                                                "{}.{}".format(stem, name))})
+    return jobs
+
+
+def _input_record(path):
+    """Return the record of an input file (path, size, modification time
+    and content hash)."""
+    stat = os.stat(path)
+    return {'input': os.path.abspath(path), 'input_size': stat.st_size,
+            'input_mtime': stat.st_mtime_ns,
+            'input_hash': _input_hash(path)}
+
+
+def _is_up_to_date(job):
+    """Test if the job outputs were computed from the same input, with the
+    same parameters."""
+    record = job['output'] + '.job.json'
+    if not os.path.isfile(record):
+        return False
+    with open(record, 'r') as f:
+        previous = json.load(f)
+    if previous.get('function') != job['function'] \
+            or previous.get('params') != job['params'] \
+            or previous.get('input') != os.path.abspath(job['input']):
+        return False
+    outputs = previous.get('output_files')
+    if not outputs or not all(os.path.isfile(path) for path in outputs):
+        return False
+    # same file: only hash the content if it was modified
+    stat = os.stat(job['input'])
+    if previous.get('input_size') == stat.st_size \
+            and previous.get('input_mtime') == stat.st_mtime_ns:
+        return True
+    return previous.get('input_hash') == _input_hash(job['input'])
+
+
+def run_job(job, force=False):
+    """
+    Run one job, writing its output and a record of its parameters.
+
+    Returns
+    -------
+    summary : dictionary
+        Job input, analysis, status ('done', 'skipped' or 'failed'),
+        duration and error message.
+    """
+    summary = {'input': job['input'], 'analysis': job['name'],
+               'status': 'done', 'time': 0., 'error': None}
+    if not force and _is_up_to_date(job):
+        summary['status'] = 'skipped'
+        return summary
+    start = time.time()
+    try:
+        # (recorded before running, in case the input changes meanwhile)
+        input_record = _input_record(job['input'])
+        func = get_analysis(job['function'])
+        out_dir = os.path.dirname(job['output'])
+        if out_dir != '' and not os.path.isdir(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
+        # let the wrappers write their outputs themselves if they can
+        if 'output_file' in inspect.signature(func).parameters:
+            output_file = job['output'] + '.dat'
+            # (previous outputs are removed, to only record the new ones)
+            for path in glob.glob(glob.escape(output_file) + '*'):
+                os.remove(path)
+            func(job['input'], output_file=output_file, **job['params'])
+            # (some wrappers write several suffixed files, ex: 'd2')
+            output_files = sorted(glob.glob(glob.escape(output_file) + '*'))
+        else:
+            output_file = job['output'] + '.pkl'
+            res = func(job['input'], **job['params'])
+            with open(output_file, 'wb') as f:
+                pickle.dump(res, f)
+            output_files = [output_file]
+        with open(job['output'] + '.job.json', 'w') as f:
+            record = {'function': job['function'],
+                      'params': job['params'],
+                      'output_files': output_files}
+            record.update(input_record)
+            json.dump(record, f)
+    except Exception:
+        summary['status'] = 'failed'
+        summary['error'] = traceback.format_exc()
+    summary['time'] = time.time() - start
+    return summary
+
+
+def _is_failed(summary):
+    return summary['status'] == 'failed'
+
+
+def run_jobs(jobs, nmb_proc=1, force=False, max_memory=None,
+             cost_model=None, verbose=0):
+    """
+    Run jobs on a pool of 'nmb_proc' processes, longest expected first
+    (see 'batch.run_scheduled').
+
+    Parameters
+    ----------
+    jobs : list of dictionaries
+        Jobs (see 'expand_jobs').
+    nmb_proc : integer
+        Number of jobs run at the same time (default to 1).
+    force : boolean
+        If 'True', also run the up-to-date jobs.
+    max_memory : number
+        Maximal estimated memory (in bytes) of the jobs run at the same
+        time (default to no limit).
+    cost_model : string
+        JSON file where the jobs durations calibration is kept.
+    verbose : integer
+        Verbosity level (defaul to 0 for no messages).
+
+    Returns
+    -------
+    summaries : list of dictionaries
+        Summary of each job (see 'run_job').
+    """
+    summaries = [None]*len(jobs)
+    todo = []
+    for i, job in enumerate(jobs):
+        summary = {'input': job['input'], 'analysis': job['name'],
+                   'status': 'skipped', 'time': 0., 'error': None}
+        if not force and _is_up_to_date(job):
+            summaries[i] = summary
+            continue
+        # unknown analyses fail without being scheduled
+        # (their cost cannot be estimated)
+        try:
+            get_analysis(job['function'])
+        except Exception:
+            summary['status'] = 'failed'
+            summary['error'] = traceback.format_exc()
+            summaries[i] = summary
+            continue
+        todo.append(i)
+    res, _ = run_scheduled([jobs[i] for i in todo], nmb_proc=nmb_proc,
+                           max_memory=max_memory,
+                           cost_model=CostModel(cost_model),
+                           runner=functools.partial(run_job, force=True),
+                           use_processes=nmb_proc > 1,
+                           is_failed=_is_failed)
+    for i, summary in zip(todo, res):
+        summaries[i] = summary
+    if verbose:
+        for summary in summaries:
+            print("{status}: {analysis} on {input} ({time:.2f}s)"
+                  .format(**summary))
+    return summaries
+
+
+def main(argv=None):
+    """Command-line entry point ('pytisean-run')."""
+    parser = argparse.ArgumentParser(
+        prog='pytisean-run',
+        description="Run pytisean analyses over files, as described in a "
+                    "JSON or TOML job specification.")
+    parser.add_argument('spec', help="job specification file")
+    parser.add_argument('-j', '--nmb-proc', type=int, default=None,
+                        help="number of jobs run at the same time")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="also run up-to-date jobs")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="print each job status")
+    args = parser.parse_args(argv)
+    spec = load_spec(args.spec)
+    nmb_proc = args.nmb_proc or spec.get('nmb_proc', 1)
+    jobs = expand_jobs(spec)
+    start = time.time()
+    summaries = run_jobs(jobs, nmb_proc=nmb_proc, force=args.force,
+                         max_memory=spec.get('max_memory'),
+                         cost_model=spec.get('cost_model'),
+                         verbose=args.verbose)
+    # summary of timings and failures
+    counts = {status: sum(summ['status'] == status for summ in summaries)
+              for status in ['done', 'skipped', 'failed']}
+    output_dir = spec.get('output_dir', 'results')
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump({'total_time': time.time() - start, 'counts': counts,
+                   'jobs': summaries}, f, indent=2)
+    print("{} jobs: {done} done, {skipped} skipped, {failed} failed"
+          .format(len(jobs), **counts))
+    for summ in summaries:
+        if summ['status'] == 'failed':
+            print("=== {analysis} on {input} failed:\n{error}"
+                  .format(**summ))
+    return 1 if counts['failed'] > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 #!/usr/env python3
-from .stationarity import recurr, stp
+from .stationarity import recurr, recurr_to_csr, recurr_runs, rqa, \
+    rqa_windowed, stp
@@ -5,13 +5,19 @@
 """
 
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-from ..tiseanwrapper import tisean
+import numpy as np
+
+from ..nativetools import read_data, data_interval, embed, NeighborIndex
+from ..tiseanwrapper import tisean, input_extent, write_output
+from ..store import StoreTarget
 
 
 def recurr(data, compo_nmb=1, dim=2, delay=1, neigh_size=None,
            perc_pts=100.0, nmb_data_to_use=None, ignored_row=1,
-           col_to_read=1, output_file=None, verbose=0):
+           col_to_read=1, output_file=None, verbose=0, native=False,
+           tile_size=4096, random_seed=1, dtype=None):
     """
     Produce a recurrence plot of the, possibly multivariate, data set.
     That means, for each point in the data set it looks for all points,
@@ -48,13 +54,40 @@ def recurr(data, compo_nmb=1, dim=2, delay=1, neigh_size=None,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    native : boolean
+        If 'True', use the native implementation instead of the TISEAN
+        binary (default to 'False').
+        The recurrence plot is then computed by tiles, using a box-assisted
+        neighbor search, and only the recurrent pairs are stored.
+    tile_size : integer
+        Number of reference points per tile (native implementation only,
+        default to 4096).
+    random_seed : integer
+        Seed used to select the saved points if 'perc_pts' is lower than
+        100 (native implementation only, default to 1).
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used), also used to write the TISEAN input (default to no
+        conversion).
 
     Returns
     -------
     xys : array
         Pairs of integers representing the indexes of the pairs of points
         having a distance smaller than 'neigh_size'.
+        (With the native implementation, this is a (n, 2) array of int32,
+        and nothing is returned if 'output_file' is specified, as the
+        tiles are directly written to the file.)
     """
+    if native:
+        return _recurr_native(data, compo_nmb=compo_nmb, dim=dim,
+                              delay=delay, neigh_size=neigh_size,
+                              perc_pts=perc_pts,
+                              nmb_data_to_use=nmb_data_to_use,
+                              ignored_row=ignored_row,
+                              col_to_read=col_to_read,
+                              output_file=output_file, tile_size=tile_size,
+                              random_seed=random_seed, dtype=dtype)
     # prepare arguments
     args = "-x{} -c{} -m{},{} -d{} -%{} -V{}"\
            .format(ignored_row, col_to_read,
@@ -65,15 +98,277 @@ def recurr(data, compo_nmb=1, dim=2, delay=1, neigh_size=None,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
-    res, msg = tisean('recurr', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read, compo_nmb)
+    res, msg = tisean('recurr', args, input_data=data, output_file=output_file,
+                      dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
     return res
 
+def _recurr_tiles(data, compo_nmb=1, dim=2, delay=1, neigh_size=None,
+                  perc_pts=100.0, nmb_data_to_use=None, ignored_row=1,
+                  col_to_read=1, tile_size=4096, random_seed=1, dtype=None):
+    """
+    Generator of the recurrence plot tiles.
+
+    Yield (n, 2) arrays of int32 recurrent pairs (i, j), with j < i, for
+    successive blocks of 'tile_size' reference points.
+    """
+    x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                  ignored_row=ignored_row, col_to_read=col_to_read,
+                  nmb_col_to_read=compo_nmb, dtype=dtype)
+    emb = embed(x, dim, delay)
+    if neigh_size is None:
+        neigh_size = data_interval(x)/1000.
+    index = NeighborIndex(emb, neigh_size)
+    rand = np.random.RandomState(random_seed)
+    # time index of the delay vectors (last component)
+    shift = (dim - 1)*delay
+    for start in range(0, len(emb), tile_size):
+        qind, nind, _ = index.query(emb[start:start + tile_size],
+                                    neigh_size)
+        qind += start
+        filt = nind < qind
+        if perc_pts < 100:
+            filt &= rand.random_sample(len(filt)) < perc_pts/100.
+        tile = np.empty((np.sum(filt), 2), dtype=np.int32)
+        tile[:, 0] = qind[filt] + shift
+        tile[:, 1] = nind[filt] + shift
+        yield tile[np.lexsort((tile[:, 1], tile[:, 0]))]
+
+
+def _recurr_native(data, output_file=None, **kwargs):
+    """Native version of 'recurr'."""
+    tiles = _recurr_tiles(data, **kwargs)
+    if output_file is None:
+        return np.concatenate(list(tiles))
+    if isinstance(output_file, StoreTarget):
+        output_file.write(np.concatenate(list(tiles)))
+        return
+    with open(output_file, 'w') as f:
+        for tile in tiles:
+            np.savetxt(f, tile, fmt="%d")
+
+
+def recurr_to_csr(xys, nmb_pts=None):
+    """
+    Convert recurrent pairs (as returned by 'recurr') into a compressed
+    sparse row representation.
+
+    Parameters
+    ----------
+    xys : (n, 2) array
+        Recurrent pairs.
+    nmb_pts : integer
+        Number of rows of the recurrence matrix
+        (default to the largest index + 1).
+
+    Returns
+    -------
+    indptr : array of int32
+        Row 'i' neighbors are 'indices[indptr[i]:indptr[i + 1]]'.
+    indices : array of int32
+        Column indexes.
+    """
+    xys = np.asarray(xys, dtype=np.int32).reshape(-1, 2)
+    if nmb_pts is None:
+        nmb_pts = int(xys.max()) + 1 if len(xys) != 0 else 0
+    order = np.lexsort((xys[:, 1], xys[:, 0]))
+    indices = xys[order, 1]
+    counts = np.bincount(xys[:, 0], minlength=nmb_pts)
+    indptr = np.zeros(nmb_pts + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(counts)
+    return indptr, indices
+
+
+def _runs(fixed, moving):
+    """
+    Return the runs of consecutive 'moving' values for each 'fixed' value,
+    as a (n, 3) array of [fixed, first moving value, run length].
+    """
+    order = np.lexsort((moving, fixed))
+    fixed = fixed[order]
+    moving = moving[order]
+    new_run = np.ones(len(fixed), dtype=bool)
+    new_run[1:] = (fixed[1:] != fixed[:-1]) | (moving[1:] != moving[:-1] + 1)
+    starts = np.flatnonzero(new_run)
+    lengths = np.diff(np.append(starts, len(fixed)))
+    return np.column_stack((fixed[starts], moving[starts], lengths))
+
+
+def recurr_runs(xys):
+    """
+    Compress recurrent pairs (as returned by 'recurr') into run-lengths
+    of diagonal and vertical lines.
+
+    Parameters
+    ----------
+    xys : (n, 2) array
+        Recurrent pairs (i, j), with j < i.
+
+    Returns
+    -------
+    diag : (n, 3) array
+        Diagonal lines: [i - j, first j, length].
+    vert : (n, 3) array
+        Vertical lines of the full (symmetric) recurrence plot:
+        [column, first row, length].
+    """
+    xys = np.asarray(xys, dtype=np.int64).reshape(-1, 2)
+    rows, cols = xys[:, 0], xys[:, 1]
+    diag = _runs(rows - cols, cols)
+    # vertical lines are below the main diagonal in the column, and above
+    # it (i.e. horizontal lines of the lower part) by symmetry
+    vert = np.concatenate((_runs(cols, rows), _runs(rows, cols)))
+    return diag, vert
+
+
+def _rqa_measures(diag_len, vert_len, nmb_pts, min_diag, min_vert):
+    """Compute the RQA measures from the lines lengths."""
+    nmb_rec = np.sum(diag_len)
+    nmb_pairs = nmb_pts*(nmb_pts - 1)/2.
+    long_diag = diag_len[diag_len >= min_diag]
+    long_vert = vert_len[vert_len >= min_vert]
+    hist = np.bincount(diag_len, minlength=min_diag)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        probas = hist[min_diag:]/float(len(long_diag))
+        probas = probas[probas > 0]
+        res = {"recurrence_rate": nmb_rec/nmb_pairs if nmb_pairs else np.nan,
+               "determinism": np.sum(long_diag)/float(nmb_rec),
+               "mean_diagonal": np.mean(long_diag) if len(long_diag)
+               else np.nan,
+               "max_diagonal": np.max(diag_len) if len(diag_len) else 0,
+               "entropy": -np.sum(probas*np.log(probas)),
+               "laminarity": np.sum(long_vert)/(2.*nmb_rec),
+               "trapping_time": np.mean(long_vert) if len(long_vert)
+               else np.nan,
+               "max_vertical": np.max(vert_len) if len(vert_len) else 0,
+               "diagonal_hist": hist}
+    return res
+
+
+def rqa(xys, nmb_pts=None, min_diag=2, min_vert=2):
+    """
+    Recurrence quantification analysis.
+
+    Measures are computed on the full (symmetric) recurrence plot,
+    excluding the main diagonal.
+
+    Parameters
+    ----------
+    xys : (n, 2) array or tuple of arrays
+        Recurrent pairs (as returned by 'recurr') or lines run-lengths
+        (as returned by 'recurr_runs').
+    nmb_pts : integer
+        Size of the recurrence plot (default to the largest index minus
+        the smallest one, plus one).
+    min_diag : integer
+        Minimal length of the diagonal lines (default to 2).
+    min_vert : integer
+        Minimal length of the vertical lines (default to 2).
+
+    Returns
+    -------
+    res : dictionary
+        'recurrence_rate', 'determinism', 'mean_diagonal', 'max_diagonal',
+        'entropy' (Shannon entropy of the diagonal lines lengths),
+        'laminarity', 'trapping_time', 'max_vertical' and 'diagonal_hist'
+        (number of diagonal lines for each length).
+    """
+    if isinstance(xys, tuple):
+        diag, vert = xys
+    else:
+        diag, vert = recurr_runs(xys)
+    if nmb_pts is None:
+        if len(diag) == 0:
+            raise ValueError("'nmb_pts' should be specified if there is "
+                             "no recurrences")
+        nmb_pts = (np.max(diag[:, 0] + diag[:, 1] + diag[:, 2])
+                   - np.min(diag[:, 1]))
+    return _rqa_measures(diag[:, 2], vert[:, 2], nmb_pts, min_diag, min_vert)
+
+
+def rqa_windowed(xys, window, step, start=None, stop=None, min_diag=2,
+                 min_vert=2):
+    """
+    Recurrence quantification analysis over sliding windows.
+
+    The lines run-lengths are computed only once, and clipped to each
+    window.
+
+    Parameters
+    ----------
+    xys : (n, 2) array or tuple of arrays
+        Recurrent pairs (as returned by 'recurr') or lines run-lengths
+        (as returned by 'recurr_runs').
+    window : integer
+        Windows size (in points).
+    step : integer
+        Step between two successive windows.
+    start, stop : integers
+        First and last (excluded) indexes to consider (default to the
+        smallest and largest recurrent indexes).
+    min_diag : integer
+        Minimal length of the diagonal lines (default to 2).
+    min_vert : integer
+        Minimal length of the vertical lines (default to 2).
+
+    Returns
+    -------
+    starts : array
+        First index of each window.
+    res : dictionary of arrays
+        RQA measures (see 'rqa') for each window.
+    """
+    if isinstance(xys, tuple):
+        diag, vert = xys
+    else:
+        diag, vert = recurr_runs(xys)
+    if start is None:
+        start = np.min(diag[:, 1])
+    if stop is None:
+        stop = np.max(diag[:, 0] + diag[:, 1] + diag[:, 2])
+    # sort the lines by first column, to only look at the ones
+    # that can intersect a window
+    diag = diag[np.argsort(diag[:, 1], kind='stable')]
+    vert = vert[np.argsort(vert[:, 0], kind='stable')]
+    # (the diagonal lines before 'first_line' all end before the window,
+    # and this pointer only moves forward with the windows)
+    diag_ends = np.maximum.accumulate(diag[:, 1] + diag[:, 2])
+    first_line = 0
+    starts = np.arange(start, stop - window + 1, step)
+    measures = []
+    for wstart in starts:
+        wstop = wstart + window
+        # diagonal lines: points (j + k, j), with wstart <= j, j + k < wstop
+        first_line = max(first_line, np.searchsorted(diag_ends, wstart,
+                                                     'right'))
+        sub = diag[first_line:np.searchsorted(diag[:, 1], wstop - 1)]
+        first = np.maximum(sub[:, 1], wstart)
+        last = np.minimum(sub[:, 1] + sub[:, 2], wstop - sub[:, 0])
+        diag_len = last - first
+        diag_len = diag_len[diag_len > 0]
+        # vertical lines: in a column of the window
+        sub = vert[np.searchsorted(vert[:, 0], wstart):
+                   np.searchsorted(vert[:, 0], wstop)]
+        vert_len = (np.minimum(sub[:, 1] + sub[:, 2], wstop)
+                    - np.maximum(sub[:, 1], wstart))
+        vert_len = vert_len[vert_len > 0]
+        measures.append(_rqa_measures(diag_len, vert_len, window, min_diag,
+                                      min_vert))
+    res = {}
+    for key in ["recurrence_rate", "determinism", "mean_diagonal",
+                "max_diagonal", "entropy", "laminarity", "trapping_time",
+                "max_vertical"]:
+        res[key] = np.array([meas[key] for meas in measures])
+    return starts, res
+
+
 def stp(data, delay=1, dim=2, time_resolution=1, time_steps=100,
         levels_frac=0.05, nmb_data_to_use=None, ignored_row=1, col_to_read=1,
-        output_file=None, verbose=0):
+        output_file=None, verbose=0, native=False, nmb_bins=1000,
+        nmb_ref_points=None, nmb_proc=1, random_seed=1, dtype=None):
     """
     Computes a space time separation plot as discussed by Provenzale et al.
 
@@ -104,11 +399,50 @@ def stp(data, delay=1, dim=2, time_resolution=1, time_steps=100,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    native : boolean
+        If 'True', use the native implementation instead of the TISEAN
+        binary (default to 'False').
+        Distances are then accumulated in logarithmic histograms for each
+        time separation, and the levels are interpolated from them.
+    nmb_bins : integer
+        Number of logarithmic bins of the distance histograms
+        (native implementation only, default to 1000).
+    nmb_ref_points : integer
+        Number of reference points randomly chosen to compute the distances
+        (native implementation only, default to all the points).
+        Useful to get an approximate plot for very long time series.
+    nmb_proc : integer
+        Number of threads used to process the time separations
+        (native implementation only, default to 1).
+    random_seed : integer
+        Seed used to choose the reference points
+        (native implementation only, default to 1).
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used), also used to write the TISEAN input (default to no
+        conversion).
 
     Returns
     -------
-    ?
+    res : array
+        First column: time separation.
+        Second column: distance at which the given fraction of the pairs
+        is reached.
+        One block of 'time_steps' lines per level (levels_frac,
+        2*levels_frac, ...).
     """
+    if native:
+        res = _stp_native(data, delay=delay, dim=dim,
+                          time_resolution=time_resolution,
+                          time_steps=time_steps, levels_frac=levels_frac,
+                          nmb_data_to_use=nmb_data_to_use,
+                          ignored_row=ignored_row, col_to_read=col_to_read,
+                          nmb_bins=nmb_bins, nmb_ref_points=nmb_ref_points,
+                          nmb_proc=nmb_proc, random_seed=random_seed,
+                          dtype=dtype)
+        if output_file is not None:
+            write_output(output_file, res)
+        return res
     warnings.warn("The command 'stp' seems to have some trouble parsing "
                     "path with complex characters")
     # Check
@@ -122,8 +456,73 @@ def stp(data, delay=1, dim=2, time_resolution=1, time_steps=100,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
-    res, msg = tisean('stp', args, input_data=data, output_file=output_file)
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read)
+    res, msg = tisean('stp', args, input_data=data, output_file=output_file,
+                      dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
     return res
+
+
+# Number of reference points processed at once by the native 'stp'
+STP_CHUNK_SIZE = 2**16
+
+
+def _stp_native(data, delay=1, dim=2, time_resolution=1, time_steps=100,
+                levels_frac=0.05, nmb_data_to_use=None, ignored_row=1,
+                col_to_read=1, nmb_bins=1000, nmb_ref_points=None,
+                nmb_proc=1, random_seed=1, dtype=None):
+    """Native version of 'stp'."""
+    x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                  ignored_row=ignored_row, col_to_read=col_to_read,
+                  dtype=dtype)
+    emb = embed(x, dim, delay)
+    times = time_resolution*np.arange(1, time_steps + 1)
+    if times[-1] >= len(emb):
+        raise ValueError("Time series too short for {} time steps"
+                         .format(time_steps))
+    levels = levels_frac*np.arange(1, int(np.ceil(1./levels_frac)))
+    # logarithmic bins, from the data interval down to 1e-6 of it
+    log_max = np.log(data_interval(x))
+    log_min = log_max - np.log(1e6)
+    bin_size = (log_max - log_min)/nmb_bins
+    # reference points (all of them or a random subset)
+    refs = None
+    if nmb_ref_points is not None and nmb_ref_points < len(emb):
+        rand = np.random.RandomState(random_seed)
+        refs = np.sort(rand.choice(len(emb) - times[0], nmb_ref_points,
+                                   replace=False))
+
+    def histogram(time):
+        """Histogram of the distances for one time separation."""
+        hist = np.zeros(nmb_bins)
+        nmb_pts = len(emb) - time
+        if refs is None:
+            chunks = (np.arange(i, min(i + STP_CHUNK_SIZE, nmb_pts))
+                      for i in range(0, nmb_pts, STP_CHUNK_SIZE))
+        else:
+            valid = refs[:np.searchsorted(refs, nmb_pts)]
+            chunks = (valid[i:i + STP_CHUNK_SIZE]
+                      for i in range(0, len(valid), STP_CHUNK_SIZE))
+        for ind in chunks:
+            dist = np.max(np.abs(emb[ind + time] - emb[ind]), axis=1)
+            with np.errstate(divide='ignore'):
+                bins = np.floor((np.log(dist) - log_min)/bin_size)
+            bins = np.clip(bins, 0, nmb_bins - 1).astype(int)
+            hist += np.bincount(bins, minlength=nmb_bins)
+        return hist
+
+    if nmb_proc > 1:
+        with ThreadPoolExecutor(nmb_proc) as pool:
+            hists = list(pool.map(histogram, times))
+    else:
+        hists = [histogram(time) for time in times]
+    # interpolate the levels from the cumulative histograms
+    res = np.empty((len(levels), len(times), 2))
+    res[:, :, 0] = times
+    edges = log_min + bin_size*np.arange(nmb_bins + 1)
+    for i, hist in enumerate(hists):
+        cum = np.concatenate(([0], np.cumsum(hist)))
+        res[:, i, 1] = np.exp(np.interp(levels*cum[-1], cum, edges))
+    return res.reshape(-1, 2)
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+""" On-disk store of analysis results, as binary shards
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from ..batch.batch import _input_hash
+
+__author__ = "Gaby Launay"
+__copyright__ = "Gaby Launay 2017"
+__credits__ = "Rainer Hegger, Holger Kantz and Thomas Schreiber"
+__license__ = "MIT"
+__version__ = "0.1"
+__email__ = "gaby.launay@tutanota.com"
+__status__ = "Development"
+
+
+# Number of results buffered in memory before writing a shard
+SHARD_SIZE = 10000
+
+# Arguments only changing how an analysis is computed (not recorded as
+# parameters by 'ResultStore.run')
+ENGINE_ARGS = ['native', 'nmb_proc', 'verbose', 'chunk_size', 'tile_size',
+               'full_output', 'output_file', 'dtype']
+
+
+def _json_value(value):
+    """
+    Return a parameter value as a JSON value (numpy scalars and arrays
+    are converted to numbers and lists).
+    """
+    if isinstance(value, (np.generic, np.ndarray)):
+        value = value.tolist()
+    if isinstance(value, (list, tuple, set)):
+        return [_json_value(val) for val in value]
+    if isinstance(value, dict):
+        return {str(key): _json_value(val) for key, val in value.items()}
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    raise TypeError("Parameter value {!r} is not JSON serializable"
+                    .format(value))
+
+
+def _matches(value, wanted):
+    """Test if a stored parameter value matches a wanted one."""
+    if isinstance(wanted, (list, tuple, set)) \
+            and not isinstance(value, (list, tuple)):
+        return any(_matches(value, val) for val in wanted)
+    if isinstance(value, (int, float)) and isinstance(wanted, (int, float)) \
+            and not isinstance(value, bool):
+        return bool(np.isclose(value, wanted))
+    return value == wanted
+
+
+def _type_name(dtype):
+    """Return the name of a type, as used in the shard file names."""
+    return np.dtype(dtype).name
+
+
+class StoreTarget(object):
+    """
+    Destination of an analysis result in a results store, to give as
+    'output_file' to the wrappers (see 'ResultStore.target').
+    """
+
+    def __init__(self, store, analysis, input_hash, params):
+        self.store = store
+        self.analysis = analysis
+        self.input_hash = input_hash
+        self.params = params
+
+    def write(self, res):
+        """Append a result (or a list of results, one per output file)."""
+        if isinstance(res, (list, tuple)):
+            for i, part in enumerate(res):
+                params = dict(self.params, part=i)
+                self.store._append(self.analysis, part, self.input_hash,
+                                   params)
+        else:
+            self.store._append(self.analysis, res, self.input_hash,
+                               self.params)
+
+
+class ResultStore(object):
+    """
+    Store of analysis results, appended into binary shards.
+
+    Each analysis has its own directory of shards: '.npy' files with the
+    (flattened) results values one after the other (one file per type),
+    and a '.json' index with their types, shapes and a column per
+    parameter (and the input hash).
+    Results are buffered in memory and written 'shard_size' at a time
+    (or when calling 'flush').
+    Shards are written atomically, with unique names, so several
+    processes can fill the same store.
+
+    Parameters
+    ----------
+    path : string
+        Store directory.
+    shard_size : integer
+        Number of results per shard (default to 'SHARD_SIZE').
+    compress : boolean
+        If 'True', write compressed shards ('.npz' files, that cannot be
+        memory-mapped).
+
+    Examples
+    --------
+    >>> with ResultStore('results') as store:
+    ...     for max_delay in [10, 20, 30]:
+    ...         store.run(mutual, x, max_delay=max_delay)
+    ...     lyap_k(x, max_dim=5,
+    ...            output_file=store.target('lyap_k', x, max_dim=5))
+    >>> res = store.select('mutual', max_delay=[10, 30])
+    """
+
+    def __init__(self, path, shard_size=SHARD_SIZE, compress=False):
+        self.path = path
+        self.shard_size = shard_size
+        self.compress = compress
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def __getstate__(self):
+        # (sent to other processes without the buffered results)
+        return {'path': self.path, 'shard_size': self.shard_size,
+                'compress': self.compress}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def target(self, analysis, input_data=None, **params):
+        """
+        Return a destination for a result, to give as 'output_file' to the
+        wrappers instead of a file path.
+
+        Parameters
+        ----------
+        analysis : string
+            Analysis name (ex: 'mutual').
+        input_data : array, string or SharedArray
+            Analysis input, identified by the hash of its content in the
+            store index.
+        params :
+            Parameters recorded with the result (numbers, strings,
+            booleans, lists or numpy scalars and arrays).
+        """
+        input_hash = None if input_data is None \
+            else _input_hash(input_data)
+        params = {name: _json_value(val) for name, val in params.items()}
+        return StoreTarget(self, analysis, input_hash, params)
+
+    def run(self, func, data, **kwargs):
+        """
+        Run an analysis and append its result, with its arguments as
+        parameters (except the ones of 'ENGINE_ARGS') and its name as
+        analysis name.
+
+        Returns
+        -------
+        res :
+            Analysis result.
+        """
+        params = {name: val for name, val in kwargs.items()
+                  if name not in ENGINE_ARGS}
+        target = self.target(func.__name__, data, **params)
+        res = func(data, **kwargs)
+        target.write(res)
+        return res
+
+    def _append(self, analysis, res, input_hash, params):
+        res = np.asarray(res)
+        if res.dtype.hasobject or res.dtype.fields is not None:
+            raise TypeError("Only numerical results can be stored")
+        # (native byte order, one values file per type)
+        res = res.astype(res.dtype.newbyteorder('='), copy=False)
+        with self._lock:
+            buff = self._buffers.setdefault(analysis, [])
+            buff.append((res, input_hash, params))
+            if len(buff) < self.shard_size:
+                return
+            del self._buffers[analysis]
+        self._write_shard(analysis, buff)
+
+    def flush(self):
+        """Write the buffered results."""
+        with self._lock:
+            buffers = self._buffers
+            self._buffers = {}
+        for analysis, buff in buffers.items():
+            self._write_shard(analysis, buff)
+
+    def _write_shard(self, analysis, buff):
+        directory = os.path.join(self.path, analysis)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        # unique (and chronologically sorted) shard name
+        name = "{:016x}-{}-{}".format(time.time_ns(), os.getpid(),
+                                      threading.get_ident())
+        # one values array per type (results keep their type)
+        dtypes = [res.dtype.str for res, _, _ in buff]
+        values = {}
+        offsets = []
+        for (res, _, _), dtype in zip(buff, dtypes):
+            parts = values.setdefault(dtype, [])
+            offsets.append(sum(part.size for part in parts))
+            parts.append(res.ravel())
+        values = {dtype: np.concatenate(parts)
+                  for dtype, parts in values.items()}
+        names = sorted(set(nm for _, _, params in buff for nm in params))
+        index = {'offsets': offsets,
+                 'dtypes': dtypes,
+                 'shapes': [list(res.shape) for res, _, _ in buff],
+                 'input': [input_hash for _, input_hash, _ in buff],
+                 'params': {nm: [params.get(nm) for _, _, params in buff]
+                            for nm in names}}
+        # values first, then the index (a shard exists once indexed)
+        path = os.path.join(directory, name)
+        if self.compress:
+            with open(path + '.npz.tmp', 'wb') as f:
+                np.savez_compressed(f, **{_type_name(dtype): vals
+                                          for dtype, vals in values.items()})
+            os.replace(path + '.npz.tmp', path + '.npz')
+        else:
+            for dtype, vals in values.items():
+                type_path = "{}.{}.npy".format(path, _type_name(dtype))
+                with open(type_path + '.tmp', 'wb') as f:
+                    np.save(f, vals)
+                os.replace(type_path + '.tmp', type_path)
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.json.tmp', path + '.json')
+
+    def analyses(self):
+        """Return the names of the stored analyses."""
+        return sorted(name for name in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, name)))
+
+    def _shards(self, analysis):
+        """Return the indexes of an analysis shards (cached)."""
+        directory = os.path.join(self.path, analysis)
+        if not os.path.isdir(directory):
+            return []
+        cache = self._indexes.setdefault(analysis, {})
+        names = sorted(name[:-5] for name in os.listdir(directory)
+                       if name.endswith('.json'))
+        for name in names:
+            if name not in cache:
+                with open(os.path.join(directory, name + '.json'), 'r') as f:
+                    cache[name] = json.load(f)
+        return [(name, cache[name]) for name in names]
+
+    def index(self, analysis):
+        """
+        Return the index of the stored results of an analysis.
+
+        Returns
+        -------
+        index : dictionary
+            Columns (lists) 'input' (input hashes), 'shape', 'dtype' and
+            one per parameter.
+        """
+        shards = self._shards(analysis)
+        names = sorted(set(nm for _, shard in shards
+                           for nm in shard['params']))
+        index = {'input': [], 'shape': [], 'dtype': []}
+        index.update({nm: [] for nm in names})
+        for _, shard in shards:
+            nmb = len(shard['offsets'])
+            index['input'] += shard['input']
+            index['shape'] += [tuple(shape) for shape in shard['shapes']]
+            index['dtype'] += [np.dtype(dtype) for dtype in shard['dtypes']]
+            for nm in names:
+                index[nm] += shard['params'].get(nm, [None]*nmb)
+        return index
+
+    def _values(self, analysis, name, dtype, mmap):
+        path = os.path.join(self.path, analysis, name)
+        type_path = "{}.{}.npy".format(path, _type_name(dtype))
+        if os.path.isfile(type_path):
+            return np.load(type_path, mmap_mode='r' if mmap else None)
+        with np.load(path + '.npz') as f:
+            return f[_type_name(dtype)]
+
+    def select(self, analysis, input_data=None, mmap=True, **params):
+        """
+        Read the stored results of an analysis, filtered by parameters.
+
+        Only the index is read to find the results, and the values are
+        memory-mapped (for uncompressed stores).
+
+        Parameters
+        ----------
+        analysis : string
+            Analysis name.
+        input_data : array, string or SharedArray
+            If given, only return the results of this input.
+        mmap : boolean
+            If 'True' (default), return memory-mapped arrays.
+        params :
+            Wanted parameters values (ex: dim=3), or lists of wanted values
+            (ex: dim=[3, 4]).
+
+        Returns
+        -------
+        res : list of tuples
+            (parameters, result) of each selected result.
+        """
+        input_hash = None if input_data is None \
+            else _input_hash(input_data)
+        res = []
+        for name, shard in self._shards(analysis):
+            rows = range(len(shard['offsets']))
+            if input_hash is not None:
+                rows = [i for i in rows if shard['input'][i] == input_hash]
+            for nm, wanted in params.items():
+                column = shard['params'].get(nm)
+                if column is None:
+                    rows = []
+                    break
+                wanted = _json_value(wanted)
+                rows = [i for i in rows if _matches(column[i], wanted)]
+            if len(rows) == 0:
+                continue
+            values = {dtype: self._values(analysis, name, dtype, mmap)
+                      for dtype in set(shard['dtypes'][i] for i in rows)}
+            for i in rows:
+                shape = shard['shapes'][i]
+                start = shard['offsets'][i]
+                stop = start + int(np.prod(shape, dtype=int))
+                found = {nm: column[i]
+                         for nm, column in shard['params'].items()
+                         if column[i] is not None}
+                found['input'] = shard['input'][i]
+                vals = values[shard['dtypes'][i]]
+                res.append((found, vals[start:stop].reshape(shape)))
+        return res
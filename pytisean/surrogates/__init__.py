@@ -1 +1,2 @@
-from .surrogates import surrogates, endtoend, predict
+from .surrogates import surrogates, endtoend, endtoend_segment, predict, \
+    surrogate_test
@@ -4,7 +4,14 @@
 """ TISEAN surrogates testing tools wrappers
 """
 
-from ..tiseanwrapper import tisean
+import multiprocessing
+import os
+
+import numpy as np
+
+from ..nativetools import read_data
+from ..tiseanwrapper import tisean, input_extent
+from ..tiseanwrapper.tiseanwrapper import gentmpfile
 
 
 __author__ = "Gaby Launay"
@@ -18,7 +25,8 @@ __status__ = "Development"
 
 def surrogates(data, nmb_surr=1, nmb_it=None, spec=False,
                random_seed=1, nmb_data_to_use=None, ignored_row=0,
-               nmb_col_to_read=1, col_to_read=1, output_file=None, verbose=0):
+               nmb_col_to_read=1, col_to_read=1, output_file=None, verbose=0,
+               dtype=None):
     """
     Creates surrogate data with the same Fourier amplitudes and the
     same distribution of values.
@@ -53,6 +61,10 @@ def surrogates(data, nmb_surr=1, nmb_it=None, spec=False,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used), also used to write the TISEAN input (default to no
+        conversion).
 
     Returns
     -------
@@ -71,8 +83,10 @@ def surrogates(data, nmb_surr=1, nmb_it=None, spec=False,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read,
+                          nmb_col_to_read)
     res, msg = tisean('surrogates', args, input_data=data,
-                      output_file=output_file)
+                      output_file=output_file, dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
@@ -123,14 +137,113 @@ def endtoend(data, nmb_data_to_use=None, ignored_row=0,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read,
+                          nmb_col_to_read)
     res, msg = tisean('endtoend', args, input_data=data,
-                      output_file=output_file)
+                      output_file=output_file, **extent)
     # return
     if msg != "":
         print(msg)
     return res
 
 
+def _fft_lengths(min_length, max_length):
+    """Return the lengths in [min_length, max_length] of the form 2^i3^j5^k,
+    in decreasing order."""
+    lengths = []
+    pow2 = 1
+    while pow2 <= max_length:
+        pow3 = pow2
+        while pow3 <= max_length:
+            pow5 = pow3
+            while pow5 <= max_length:
+                if pow5 >= min_length:
+                    lengths.append(pow5)
+                pow5 *= 5
+            pow3 *= 3
+        pow2 *= 2
+    return sorted(lengths, reverse=True)
+
+
+def endtoend_segment(data, min_length=None, nmb_data_to_use=None,
+                     ignored_row=0, nmb_col_to_read=1, col_to_read=1,
+                     dtype=None):
+    """
+    Find the sub-sequence with the smallest end-to-end mismatch.
+
+    Native counterpart of 'endtoend': for each length of the form
+    2^i3^j5^k (FFT friendly), the offset minimizing the end-to-end
+    mismatch (jump plus slip, normalized by the sub-sequence variance) is
+    searched for, and the best sub-sequence is returned, ready to be used
+    by 'surrogates'.
+
+    Parameters
+    ----------
+    data : array or string
+        data, can de an array or a filename.
+    min_length : integer
+        Minimal length of the sub-sequence (default to half the data length).
+    nmb_data_to_use : integer
+        Number of data points to use (default to everything).
+    ignored_row : integer
+        Number of file rows to ignore if 'time_serie' is a file path
+        (Default to 0).
+    nmb_col_to_read: integer
+        Number of columns to be read (default to 1)
+    col_to_read : integer
+        Number of columns to be read if 'time_serie' is a file path
+        (Default to 1).
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used, default to no conversion).
+
+    Returns
+    -------
+    segment : array
+        Best sub-sequence.
+        If 'data' is an array, this is a view on it (no copy).
+    mismatch : nx5 array
+        For each tested length (in decreasing order): length, best offset,
+        jump, slip and total mismatch.
+    """
+    x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                  ignored_row=ignored_row, col_to_read=col_to_read,
+                  nmb_col_to_read=nmb_col_to_read, dtype=dtype)
+    nmb_pts = len(x)
+    if min_length is None:
+        min_length = nmb_pts//2
+    lengths = _fft_lengths(max(min_length, 3), nmb_pts)
+    if len(lengths) == 0:
+        raise ValueError("No possible sub-sequence longer than {} points"
+                         .format(min_length))
+    # Cumulative sums (centered to limit round-off errors, and in float64
+    # even for float32 data)
+    xc = x.reshape(nmb_pts, -1).astype(float)
+    xc = xc - xc.mean(axis=0)
+    zeros = np.zeros((1, xc.shape[1]))
+    cum1 = np.concatenate((zeros, np.cumsum(xc, axis=0)))
+    cum2 = np.concatenate((zeros, np.cumsum(xc**2, axis=0)))
+    # Score each length for all the offsets at once
+    mismatch = np.empty((len(lengths), 5))
+    for i, length in enumerate(lengths):
+        nmb_off = nmb_pts - length + 1
+        first = xc[:nmb_off]
+        last = xc[length - 1:]
+        var = (cum2[length:] - cum2[:nmb_off]
+               - (cum1[length:] - cum1[:nmb_off])**2/length)/length
+        var[var <= 0] = np.inf
+        jump = np.sum((last - first)**2/var, axis=1)
+        slip = np.sum(((xc[length - 1:] - xc[length - 2:nmb_pts - 1])
+                       - (xc[1:nmb_off + 1] - xc[:nmb_off]))**2/var, axis=1)
+        total = jump + slip
+        off = np.argmin(total)
+        mismatch[i] = [length, off, jump[off], slip[off], total[off]]
+    # Best sub-sequence (the longest one in case of equality)
+    best = np.argmin(mismatch[:, 4])
+    length, off = int(mismatch[best, 0]), int(mismatch[best, 1])
+    return x[off:off + length], mismatch
+
+
 def predict(data, delay, dim, radius=None, rel_radius=None,
             forecast=1, nmb_data_to_use=None, ignored_row=0,
             col_to_read=1, output_file=None, verbose=0):
@@ -182,9 +295,159 @@ def predict(data, delay, dim, radius=None, rel_radius=None,
         args += " -l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read)
     res, msg = tisean('predict', args, input_data=data,
-                      output_file=output_file)
+                      output_file=output_file, **extent)
     # return
     if msg != "":
         print(msg)
     return res
+
+
+def _surrogate_statistic(job):
+    """Generate one surrogate and evaluate the statistic on it."""
+    data, statistic, seed, kwargs = job
+    surr = surrogates(data, nmb_surr=1, random_seed=seed, **kwargs)
+    return statistic(surr)
+
+
+def _rank_pvalue_bounds(stat_data, stat_surr, nmb_surr_max, alternative):
+    """
+    Return the smallest and largest p-values reachable once all the
+    'nmb_surr_max' surrogates are computed, given the ones already known.
+    """
+    stat_surr = np.asarray(stat_surr)
+    remaining = nmb_surr_max - len(stat_surr)
+    nmb_smaller = np.sum(stat_surr <= stat_data)
+    nmb_larger = np.sum(stat_surr >= stat_data)
+    norm = float(nmb_surr_max + 1)
+    if alternative == "smaller":
+        p_min = (1 + nmb_smaller)/norm
+        p_max = (1 + nmb_smaller + remaining)/norm
+    elif alternative == "larger":
+        p_min = (1 + nmb_larger)/norm
+        p_max = (1 + nmb_larger + remaining)/norm
+    else:
+        p_min = 2*min(1 + nmb_smaller, 1 + nmb_larger)/norm
+        p_max = 2*min(1 + nmb_smaller + remaining,
+                      1 + nmb_larger + remaining)/norm
+    return min(p_min, 1.), min(p_max, 1.)
+
+
+def surrogate_test(data, statistic, nmb_surr_max=99, batch_size=None,
+                   significance=0.05, alternative="two-sided",
+                   random_seed=1, nmb_proc=1, nmb_it=None, spec=False,
+                   nmb_data_to_use=None, ignored_row=0, col_to_read=1,
+                   verbose=0):
+    """
+    Perform a rank-based surrogate data hypothesis test.
+
+    Surrogates are generated (using 'surrogates') by batches and the
+    discriminating statistic is evaluated on each of them. The test stops
+    as soon as the outcome (rejection or not of the null hypothesis at the
+    given significance) cannot be changed by the remaining surrogates.
+
+    Parameters
+    ----------
+    data : array or string
+        data, can de an array or a filename.
+    statistic : function
+        Discriminating statistic, called on 'data' and on each surrogate
+        (arrays), and returning a number.
+        Should be picklable if 'nmb_proc' is greater than 1.
+    nmb_surr_max : integer
+        Maximal number of surrogates (default to 99).
+    batch_size : integer
+        Number of surrogates generated between two checks of the test
+        outcome (default to 'nmb_proc', or 10 if 'nmb_proc' is 1).
+    significance : number
+        Significance level of the test (default to 0.05).
+    alternative : string in {"two-sided", "smaller", "larger"}
+        Alternative hypothesis, "smaller" meaning that the statistic is
+        expected to be smaller on the data than on the surrogates
+        (default to "two-sided").
+    random_seed : integer
+        Seed for the first surrogate, following surrogates use successive
+        seeds (default to 1).
+    nmb_proc : integer
+        Number of processes used to compute the surrogates and the
+        statistic (default to 1).
+    nmb_it integer, optional
+        Number of iterations for the surrogates generation
+        (by default, continue until no further changes).
+    spec: bool, optional
+        Make spectrum exact rather than distribution (default to distributions)
+    nmb_data_to_use : integer
+        Number of data points to use (default to everything).
+    ignored_row : integer
+        Number of file rows to ignore if 'time_serie' is a file path
+        (Default to 0).
+    col_to_read : integer
+        Number of columns to be read if 'time_serie' is a file path
+        (Default to 1).
+    verbose : integer
+        Verbosity level (defaul to 0 for only fatal errors.
+
+    Returns
+    -------
+    pvalue : number
+        Rank-based p-value (computed with the surrogates actually used).
+    stat_data : number
+        Statistic of the data.
+    stat_surr : array
+        Statistic of each surrogate actually used (in generation order).
+        As the test stops early, 'len(stat_surr)' is the number of
+        surrogates used: a multiple of 'batch_size', or 'nmb_surr_max'.
+    """
+    # Check
+    if alternative not in ["two-sided", "smaller", "larger"]:
+        raise ValueError("Unknown alternative: '{}'".format(alternative))
+    if batch_size is None:
+        batch_size = nmb_proc if nmb_proc > 1 else 10
+    kwargs = {"nmb_it": nmb_it, "spec": spec,
+              "nmb_data_to_use": nmb_data_to_use,
+              "ignored_row": ignored_row, "col_to_read": col_to_read,
+              "verbose": verbose}
+    # Write data only once for all the surrogates
+    if isinstance(data, str):
+        data_file = data
+    else:
+        data_file = gentmpfile()
+        np.savetxt(data_file, data, delimiter='\t')
+    pool = None
+    try:
+        # (the statistic is computed on the data used for the surrogates)
+        stat_data = statistic(read_data(data,
+                                        nmb_data_to_use=nmb_data_to_use,
+                                        ignored_row=ignored_row,
+                                        col_to_read=col_to_read))
+        if nmb_proc > 1:
+            pool = multiprocessing.Pool(nmb_proc)
+            mapper = pool.map
+        else:
+            mapper = map
+        stat_surr = []
+        while len(stat_surr) < nmb_surr_max:
+            nmb_new = min(batch_size, nmb_surr_max - len(stat_surr))
+            seed = random_seed + len(stat_surr)
+            jobs = [(data_file, statistic, seed + i, kwargs)
+                    for i in range(nmb_new)]
+            stat_surr += list(mapper(_surrogate_statistic, jobs))
+            p_min, p_max = _rank_pvalue_bounds(stat_data, stat_surr,
+                                               nmb_surr_max, alternative)
+            if p_max <= significance or p_min > significance:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if not isinstance(data, str):
+            os.remove(data_file)
+    # p-value with the surrogates actually used
+    stat_surr = np.array(stat_surr)
+    pvalue, _ = _rank_pvalue_bounds(stat_data, stat_surr, len(stat_surr),
+                                    alternative)
+    if verbose > 0:
+        print("Surrogate test stopped after {} surrogates (out of {})"
+              .format(len(stat_surr), nmb_surr_max))
+    return pvalue, stat_data, stat_surr
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
 #!/usr/env python3
 
-from .tiseanwrapper import tisean
+from .tiseanwrapper import tisean, tisean_pipe, input_extent, write_input, \
+    write_output, text_format, TiseanResult
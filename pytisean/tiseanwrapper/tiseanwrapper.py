@@ -4,12 +4,17 @@
 """ Wrapper to TISEAN binaries. """
 
 import os
+import re
 import subprocess
 import tempfile
 from tempfile import gettempdir
 
 import numpy as np
 
+from ..nativetools import column_indexes, is_binary, load_binary, \
+    SharedArray
+from ..store import StoreTarget
+
 
 # For temporary files
 TMPDIR = os.path.join(gettempdir(), 'pytisean/')
@@ -47,8 +52,238 @@ def is_exec(command):
     return False
 
 
+# Number of rows written at once to the TISEAN input files
+WRITE_CHUNK_SIZE = 2**16
+
+
+def input_extent(nmb_data_to_use=None, ignored_row=0, col_to_read=None,
+                 nmb_col_to_read=1):
+    """
+    Return the number of rows and columns of the input data actually read
+    by a TISEAN routine (to be given to 'tisean').
+
+    Parameters
+    ----------
+    nmb_data_to_use : integer
+        Number of data points to use (default to everything).
+    ignored_row : integer
+        Number of rows to ignore (Default to 0).
+    col_to_read : integer, string or list of integers
+        Column(s) to read, starting from 1 (Default to all).
+    nmb_col_to_read : integer
+        Number of successive columns to read, starting from 'col_to_read'
+        if it is an integer (Default to 1).
+    """
+    extent = {"nmb_rows": None, "nmb_cols": None}
+    if nmb_data_to_use is not None:
+        extent["nmb_rows"] = ignored_row + nmb_data_to_use
+    if col_to_read is not None:
+        cols = column_indexes(col_to_read, nmb_col_to_read)
+        extent["nmb_cols"] = max(cols) + 1
+    return extent
+
+
+def text_format(dtype):
+    """
+    Return the text format writing values of type 'dtype' with their
+    precision (so that they are read back unchanged).
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'biu':
+        return '%d'
+    if dtype.kind == 'f' and dtype.itemsize < 8:
+        # 9 significant digits for float32, 6 for float16
+        return '%.{}g'.format(np.finfo(dtype).precision + 3)
+    return '%.18e'
+
+
+def write_input(path, data, nmb_rows=None, nmb_cols=None, dtype=None):
+    """
+    Write data to a TISEAN input file, by chunks.
+
+    Parameters
+    ----------
+    path : string
+        File path.
+    data : array
+        Data to write (can be memory-mapped, only the written rows
+        are read).
+    nmb_rows : integer
+        Number of rows to write (default to all).
+    nmb_cols : integer
+        Number of columns to write (default to all).
+    dtype : data-type
+        Type the data are converted to, and written with the precision of
+        (default to the data type).
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    data = data[:nmb_rows, :nmb_cols]
+    if dtype is None:
+        dtype = data.dtype
+    fmt = text_format(dtype)
+    with open(path, 'wb') as f:
+        for start in range(0, len(data), WRITE_CHUNK_SIZE):
+            chunk = data[start:start + WRITE_CHUNK_SIZE]
+            np.savetxt(f, chunk.astype(dtype, copy=False), fmt=fmt,
+                       delimiter='\t')
+
+
+def write_output(output_file, res):
+    """
+    Write results to an output file, or append them to a results store
+    (if 'output_file' is a 'store.StoreTarget').
+    """
+    if isinstance(output_file, StoreTarget):
+        output_file.write(res)
+    else:
+        res = np.asarray(res)
+        np.savetxt(output_file, res, fmt=text_format(res.dtype))
+
+
+# 'key= value' (or 'key: value') pairs in TISEAN comments
+_COMMENT_FIELD = re.compile(r"([A-Za-z][\w .()-]*?)\s*[=:]\s*"
+                            r"([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)")
+
+
+def _field_name(key):
+    """Normalize a comment key into a python name."""
+    return re.sub(r"\W+", "_", key.strip().lower()).strip("_")
+
+
+class TiseanResult(object):
+    """
+    Output of a TISEAN command, keeping the comments and the blocks
+    (separated by blank lines) TISEAN writes.
+
+    The output is only parsed (once) when one of the attributes is
+    first accessed.
+
+    Attributes
+    ----------
+    data : array
+        All the numerical values.
+    comments : list of strings
+        Comment lines (without the leading '#').
+    blocks : list of arrays
+        Blocks of values.
+    headers : list of dictionaries
+        Fields of the comments preceding each block
+        (ex: {'dim': 2, 'epsilon': 0.001}).
+    metadata : dictionary
+        Fields of all the comments ('key= value' pairs), also accessible
+        as attributes (ex: 'res.estimated_ky_dimension').
+
+    Parameters
+    ----------
+    text : string
+        Output of the TISEAN command.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._parsed = None
+
+    @property
+    def data(self):
+        return self._parse()[4]
+
+    def _parse(self):
+        """Parse the comments and the values, in one pass."""
+        if self._parsed is not None:
+            return self._parsed
+        comments, headers = [], []
+        metadata = {}
+        header = {}
+        rows = []
+        # (index of the first row of each block)
+        bounds = []
+        block_start = 0
+        for line in self.text.splitlines() + ['']:
+            line = line.strip()
+            if len(rows) > block_start \
+                    and (line == '' or line.startswith('#')):
+                # end of a block
+                bounds.append(block_start)
+                headers.append(header)
+                header = {}
+                block_start = len(rows)
+            if line.startswith('#'):
+                comment = line.lstrip('#').strip()
+                comments.append(comment)
+                for key, value in _COMMENT_FIELD.findall(comment):
+                    value = int(value) if re.match(r"^[-+]?\d+$", value) \
+                        else float(value)
+                    header[_field_name(key)] = value
+                    metadata[_field_name(key)] = value
+            elif line != '':
+                rows.append(line)
+        # all the values are converted at once
+        if len(rows) == 0:
+            values = np.empty((0, 0))
+        else:
+            values = np.loadtxt(rows, ndmin=2)
+        blocks = np.split(values, bounds[1:]) if bounds else []
+        data = values[:, 0] if values.shape[1] == 1 else values
+        self._parsed = comments, blocks, headers, metadata, data
+        return self._parsed
+
+    @property
+    def comments(self):
+        return self._parse()[0]
+
+    @property
+    def blocks(self):
+        return self._parse()[1]
+
+    @property
+    def headers(self):
+        return self._parse()[2]
+
+    @property
+    def metadata(self):
+        return self._parse()[3]
+
+    def block(self, **fields):
+        """
+        Return the first block whose header contains the given fields
+        (ex: 'res.block(dim=3)').
+        """
+        for header, block in zip(self.headers, self.blocks):
+            if all(key in header and np.isclose(header[key], value)
+                   for key, value in fields.items()):
+                return block
+        raise KeyError("No block with {}".format(fields))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        metadata = self._parse()[3]
+        if name in metadata:
+            return metadata[name]
+        raise AttributeError("No field '{}' in the TISEAN output"
+                             .format(name))
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.data
+        return self.data.astype(dtype)
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+
 def tisean(command, args, input_data=None, output_file=None,
-           output_file_ext=None):
+           output_file_ext=None, nmb_rows=None, nmb_cols=None,
+           full_output=False, dtype=None):
     """
     Run a TISEAN command.
 
@@ -59,29 +294,69 @@ def tisean(command, args, input_data=None, output_file=None,
     args : list of string
         Arguments for the tisean routine.
         One argument per string (ex: ['-V1', '-d2', '-x100']).
-    input_data : array or file path
+    input_data : array, file path or SharedArray
         Input data for the tisean command (if necessary).
         (Can be a file path or an array of values).
-    output_file : file path, optional
-        Output file path.
+    output_file : file path or StoreTarget, optional
+        Output file path, or destination in a results store
+        (see 'store.ResultStore.target').
         If 'None' (default), return the results.
     output_file_ext : list of string, optional
         In case the tisean return more than one file,
-        the parameter specify the extension to look for.
+        the parameter specify the extension to look for
+        (appended to the output file path, ex: ['.c2', '.d2']).
+    nmb_rows : integer, optional
+        If 'input_data' is an array (or a binary file), number of rows
+        actually needed by the command (default to all).
+        Only those rows are written to the command input file.
+    nmb_cols : integer, optional
+        If 'input_data' is an array (or a binary file), number of columns
+        actually needed by the command (default to all).
+    full_output : boolean, optional
+        If 'True', return TiseanResult objects (keeping the comments and
+        blocks of the output) instead of arrays.
+    dtype : data-type, optional
+        If 'input_data' is an array (or a binary file), type it is
+        written with (ex: np.float32 to only write 9 significant digits,
+        default to its own type).
     """
+    def read(path):
+        if not full_output:
+            return np.loadtxt(path)
+        with open(path, 'r') as f:
+            return TiseanResult(f.read())
+
+    # check if command exist (before creating any temporary file)
+    if not is_exec(command):
+        raise Exception("'{}' command not on path".format(command))
     # Return values if something fails
     res = None
     err_string = 'Something failed!'
+    # Results store (filled from a temporary output file)
+    store_target = None
+    if isinstance(output_file, StoreTarget):
+        store_target = output_file
+        output_file = None
     # Handles files (create temporary files if necessary)
     if input_data is not None:
         is_input_data = True
+        if is_binary(input_data):
+            input_data = load_binary(input_data)
+        if isinstance(input_data, SharedArray):
+            # shared text file, written only once (for each type)
+            input_data = input_data.text_file(write_input, dtype)
         if isinstance(input_data, str):
             fullname_in = input_data
             is_input_file = True
         else:
             fullname_in = gentmpfile()
             is_input_file = False
-            np.savetxt(fullname_in, input_data, delimiter='\t')
+            try:
+                write_input(fullname_in, input_data, nmb_rows=nmb_rows,
+                            nmb_cols=nmb_cols, dtype=dtype)
+            except Exception:
+                os.remove(fullname_in)
+                raise
     else:
         is_input_data = False
         is_input_file = False
@@ -91,27 +366,30 @@ def tisean(command, args, input_data=None, output_file=None,
     else:
         fullname_out = gentmpfile()
         is_output_file = False
-    # check if command exist
-    if not is_exec(command):
-        raise Exception("'{}' command not on path".format(command))
     # Try to work on the local directory
     # (because some tisean function does not handle very well full paths)
-    base_dir = os.getcwd()
+    # (the command is run there, without changing the current directory,
+    # to stay thread-safe)
+    work_dir = None
+    arg_out = fullname_out
     if is_input_data:
-        if os.path.dirname(fullname_out) == os.path.dirname(fullname_in):
-            os.chdir(os.path.dirname(fullname_out))
-            fullname_out = os.path.basename(fullname_out)
-            fullname_in = os.path.basename(fullname_in)
+        arg_in = fullname_in
+        if os.path.dirname(fullname_out) == os.path.dirname(fullname_in) \
+                and os.path.dirname(fullname_out) != "":
+            work_dir = os.path.dirname(fullname_out)
+            arg_out = os.path.basename(fullname_out)
+            arg_in = os.path.basename(fullname_in)
     # add paths to args
-    args += ["-o", "{}".format(fullname_out)]
+    args += ["-o", "{}".format(arg_out)]
     if is_input_data:
-        args += [fullname_in]
+        args += [arg_in]
     # Need cleanup temporary files even if the command fails
     try:
         # Call the wanted command
         subp = subprocess.Popen([command] + args,
                                 stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+                                stderr=subprocess.PIPE,
+                                cwd=work_dir)
         # Communicate with the subprocess
         (_, err_bytes) = subp.communicate()
         try:
@@ -129,9 +407,9 @@ def tisean(command, args, input_data=None, output_file=None,
         if output_file_ext is not None:
             res = []
             for ext in output_file_ext:
-                res.append(np.loadtxt(os.path.join(fullname_out, ext)))
+                res.append(read(fullname_out + ext))
         else:
-            res = np.loadtxt(fullname_out)
+            res = read(fullname_out)
     # Cleanup
     finally:
         if not is_input_file and is_input_data:
@@ -139,10 +417,125 @@ def tisean(command, args, input_data=None, output_file=None,
         if not is_output_file:
             if output_file_ext is not None:
                 for ext in output_file_ext:
-                    os.remove(os.path.join(fullname_out, ext))
-            else:
+                    if os.path.isfile(fullname_out + ext):
+                        os.remove(fullname_out + ext)
+            if os.path.isfile(fullname_out):
                 os.remove(fullname_out)
-    # Return to base directory
-    os.chdir(base_dir)
+    if store_target is not None and res is not None:
+        store_target.write(res)
     # Return
     return res, err_string
+
+
+def tisean_pipe(stages, input_data=None, output_file=None, nmb_rows=None,
+                nmb_cols=None):
+    """
+    Run a chain of TISEAN commands, connected by OS pipes.
+
+    The standard output of each command is the standard input of the next
+    one, so intermediate results never go through python (nor through
+    files). Only the output of the last command is read.
+
+    Parameters
+    ----------
+    stages : list of (string, list of string) tuples
+        TISEAN routines and their arguments (see 'tisean'), without input
+        and output files (ex: [('makenoise', ['-%5']),
+        ('ghkss', ['-m1,7', '-q2'])]).
+    input_data : array, file path or SharedArray
+        Input data for the first command (if necessary).
+    output_file : file path or StoreTarget, optional
+        Output file path for the last command, or results store
+        destination (see 'store.ResultStore.target').
+        If 'None' (default), return the results.
+    nmb_rows, nmb_cols : integers, optional
+        Number of rows and columns of 'input_data' actually needed by the
+        first command (see 'tisean').
+
+    Returns
+    -------
+    res : array
+        Output of the last command.
+    err_strings : list of string
+        Messages (standard error) of each command.
+    """
+    for command, _ in stages:
+        if not is_exec(command):
+            raise Exception("'{}' command not on path".format(command))
+    # results store destination (output read from the last pipe)
+    store_target = None
+    if isinstance(output_file, StoreTarget):
+        store_target = output_file
+        output_file = None
+    # input file for the first command
+    fullname_in = None
+    is_input_file = True
+    if input_data is not None:
+        if is_binary(input_data):
+            input_data = load_binary(input_data)
+        if isinstance(input_data, SharedArray):
+            input_data = input_data.text_file(write_input)
+        if isinstance(input_data, str):
+            fullname_in = input_data
+        else:
+            fullname_in = gentmpfile()
+            is_input_file = False
+            write_input(fullname_in, input_data, nmb_rows=nmb_rows,
+                        nmb_cols=nmb_cols)
+    # one error file per command (pipes could fill up and block)
+    errs = [tempfile.TemporaryFile() for _ in stages]
+    procs = []
+    out = None
+    try:
+        if output_file is not None:
+            out = open(output_file, 'wb')
+        for i, (command, args) in enumerate(stages):
+            args = list(args)
+            if i == 0 and fullname_in is not None:
+                args += [fullname_in]
+            last = i == len(stages) - 1
+            stdin = procs[-1].stdout if procs else subprocess.DEVNULL
+            stdout = subprocess.PIPE
+            if last and out is not None:
+                stdout = out
+            procs.append(subprocess.Popen([command] + args, stdin=stdin,
+                                          stdout=stdout, stderr=errs[i]))
+            # the next command is now the only reader
+            if i > 0:
+                procs[-2].stdout.close()
+        if out is None:
+            res_bytes = procs[-1].stdout.read()
+            procs[-1].stdout.close()
+        for proc in procs:
+            proc.wait()
+        # Check if tisean error occured
+        err_strings = []
+        for (command, args), err in zip(stages, errs):
+            err.seek(0)
+            err_string = err.read().decode('utf-8')
+            err_strings.append(err_string)
+            if len(err_string) != 0:
+                print("\n=== TISEAN MESSAGE ===\n" +
+                      "=== Launched command:\n    {}\n"
+                      .format(" ".join([command] + list(args))) +
+                      "=== Tisean said: \n    " + err_string)
+    # Cleanup
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+        for err in errs:
+            err.close()
+        if out is not None:
+            out.close()
+        if not is_input_file:
+            os.remove(fullname_in)
+    # Read the output
+    if out is not None:
+        res = np.loadtxt(output_file)
+    else:
+        res = np.loadtxt(res_bytes.decode('utf-8').splitlines())
+    if store_target is not None:
+        store_target.write(res)
+    # Return
+    return res, err_strings
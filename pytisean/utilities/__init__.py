@@ -1 +1 @@
-from .utilities import histogram, import_data_file
+from .utilities import histogram, rebin_histogram, import_data_file
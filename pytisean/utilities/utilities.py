@@ -1,7 +1,9 @@
 """ TISEAN utilities wrappers
 """
 
-from ..tiseanwrapper import tisean
+from ..nativetools import iter_chunks, column_indexes, SharedArray
+from ..tiseanwrapper import tisean, input_extent, write_output
+import json
 import os
 import numpy as np
 
@@ -15,7 +17,8 @@ __status__ = "Development"
 
 
 def histogram(data, bins=50, nmb_data_to_use=None, ignored_row=0,
-              col_to_read=1, output_file=None, verbose=0):
+              col_to_read=1, output_file=None, verbose=0, native=False,
+              data_range=None, chunk_size=2**20, dtype=None):
     """
     Estimate the scalar distribution of a scalar set.
 
@@ -36,12 +39,41 @@ def histogram(data, bins=50, nmb_data_to_use=None, ignored_row=0,
         If None, do not write a file, just return the map.
     verbose : integer
         Verbosity level (defaul to 0 for only fatal errors.
+    native : boolean
+        If 'True', use the native implementation instead of the TISEAN
+        binary (default to 'False').
+        Data are then accumulated by chunks, and can also be a memory-mapped
+        array, a '.npy' file or an iterable of arrays. Several columns can
+        be given to 'col_to_read' (ex: [1, 2] or '1,2').
+    data_range : tuple of numbers
+        Range of the histogram (native implementation only).
+        By default, the range is computed in a first pass over the data
+        (and should be given if 'data' is an iterator).
+    chunk_size : integer
+        Number of rows read at once (native implementation only,
+        default to 2^20).
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used), also used to write the TISEAN input (default to no
+        conversion).
 
     Returns
     -------
     xy : list of [x, y] tuples
         With 'x' the bin position and 'y' the bin value.
+        (With the native implementation and several columns, one
+        histogram per column)
     """
+    if native:
+        res = _histogram_native(data, bins=bins,
+                                nmb_data_to_use=nmb_data_to_use,
+                                ignored_row=ignored_row,
+                                col_to_read=col_to_read,
+                                data_range=data_range,
+                                chunk_size=chunk_size, dtype=dtype)
+        if output_file is not None:
+            write_output(output_file, res.reshape(-1, 2))
+        return res
     # prepare arguments
     args = "-x{} -c{} -b{} -V{}" \
            .format(ignored_row, col_to_read, bins, verbose)
@@ -49,44 +81,237 @@ def histogram(data, bins=50, nmb_data_to_use=None, ignored_row=0,
         args += "-l{}".format(nmb_data_to_use)
     args = args.split(" ")
     # run command
+    extent = input_extent(nmb_data_to_use, ignored_row, col_to_read)
     res, msg = tisean('histogram', args, input_data=data,
-                      output_file=output_file)
+                      output_file=output_file, dtype=dtype, **extent)
     # return
     if msg != "":
         print(msg)
     return res
 
 
-def import_data_file(path):
+def _histogram_native(data, bins=50, nmb_data_to_use=None, ignored_row=0,
+                      col_to_read=1, data_range=None, chunk_size=2**20,
+                      dtype=None):
+    """Native version of 'histogram'."""
+    def chunks():
+        return iter_chunks(data, chunk_size=chunk_size,
+                           nmb_data_to_use=nmb_data_to_use,
+                           ignored_row=ignored_row, col_to_read=col_to_read,
+                           dtype=dtype)
+    # first pass to get the range
+    if data_range is None:
+        if not isinstance(data, (str, np.ndarray, SharedArray)):
+            raise ValueError("'data_range' should be given for iterators")
+        mins, maxs = [], []
+        for x in chunks():
+            x = x.reshape(len(x), -1)
+            mins.append(np.min(x, axis=0))
+            maxs.append(np.max(x, axis=0))
+        data_range = (np.min(mins, axis=0), np.max(maxs, axis=0))
+    # (bins positions are computed in float64, chunk by chunk)
+    low, high = (np.asarray(lim, dtype=float) for lim in data_range)
+    # accumulate the counts
+    counts = None
+    nmb_pts = 0
+    for x in chunks():
+        x = x.reshape(len(x), -1)
+        if counts is None:
+            counts = np.zeros((x.shape[1], bins))
+            width = (high - low)/bins*np.ones(x.shape[1])
+            width[width == 0] = 1.
+        ind = np.floor((x - low)/width).astype(int)
+        # (the upper bound is in the last bin)
+        ind[(ind == bins) & (x <= high)] = bins - 1
+        for i in range(x.shape[1]):
+            valid = (ind[:, i] >= 0) & (ind[:, i] < bins)
+            counts[i] += np.bincount(ind[valid, i], minlength=bins)
+        nmb_pts += len(x)
+    if counts is None:
+        raise ValueError("No data")
+    res = np.empty((len(counts), bins, 2))
+    res[:, :, 0] = low[..., None] + width[:, None]*(np.arange(bins) + .5)
+    res[:, :, 1] = counts/nmb_pts
+    return res[0] if len(res) == 1 else res
+
+
+def rebin_histogram(hist, bins):
+    """
+    Compute a coarser histogram from a finer one (as returned by
+    'histogram'), without reading the data again.
+
+    The result is exact if the number of bins of 'hist' is a multiple of
+    'bins' (the counts are linearly interpolated otherwise).
+
+    Parameters
+    ----------
+    hist : array
+        (n, 2) array of [bin position, bin value] (or (c, n, 2) for several
+        columns).
+    bins : integer
+        New number of bins.
+
+    Returns
+    -------
+    xy : list of [x, y] tuples
+        With 'x' the bin position and 'y' the bin value.
+    """
+    hist = np.asarray(hist, dtype=float)
+    if hist.ndim == 3:
+        return np.array([rebin_histogram(sub, bins) for sub in hist])
+    width = hist[1, 0] - hist[0, 0] if len(hist) > 1 else 1.
+    edges = np.append(hist[:, 0] - width/2., hist[-1, 0] + width/2.)
+    cum = np.concatenate(([0], np.cumsum(hist[:, 1])))
+    new_edges = np.linspace(edges[0], edges[-1], bins + 1)
+    res = np.empty((bins, 2))
+    res[:, 0] = (new_edges[1:] + new_edges[:-1])/2.
+    res[:, 1] = np.diff(np.interp(new_edges, edges, cum))
+    return res
+
+
+def _parse_data_file(path, cols=None):
+    """
+    Parse a TISEAN data file in one pass.
+
+    Returns the heading, the line numbers of the comment (or empty) lines
+    and the data (only the columns 'cols' (0-based) if specified).
+    The file is read once, as a stream: the heading and comment lines are
+    collected while the numeric lines are given to the parser.
+    """
+    comment_lines = []
+    heading = []
+
+    def numeric_lines(f):
+        for i, line in enumerate(f):
+            if line.lstrip().startswith('#') or not line.strip():
+                comment_lines.append(i)
+                # heading: the comments before the first numeric line
+                if len(comment_lines) == i + 1 \
+                        and line.lstrip().startswith('#'):
+                    heading.append(line.rstrip('\r\n') + "\n")
+                continue
+            yield line
+
+    with open(path, 'r') as f:
+        data = np.loadtxt(numeric_lines(f), usecols=cols, ndmin=2)
+    return "".join(heading), comment_lines, data
+
+
+def _select_columns(data, cols):
+    """
+    Select columns (0-based), as a view if they are evenly spaced (so
+    that memory-mapped data is not read).
+    """
+    data = data.reshape(len(data), -1)
+    if cols is None:
+        return data
+    steps = np.diff(cols)
+    if len(cols) == 1 or (steps[0] > 0 and np.all(steps == steps[0])):
+        step = 1 if len(cols) == 1 else int(steps[0])
+        return data[:, cols[0]:cols[-1] + 1:step]
+    return data[:, cols]
+
+
+def _sidecar_paths(path):
+    """Return the paths of the binary cache files of a data file."""
+    return path + ".pytisean.npy", path + ".pytisean.json"
+
+
+def _source_signature(path):
+    """Return the modification time and size of a file."""
+    stat = os.stat(path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _load_sidecar(path):
+    """Load the binary cache of a data file, if it exists and is valid."""
+    data_path, meta_path = _sidecar_paths(path)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get("source") != _source_signature(path):
+            return None
+        data = np.load(data_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if list(data.shape) != meta.get("shape"):
+        return None
+    return meta, data
+
+
+def _write_sidecar(path, heading, comment_lines, data):
+    """Write the binary cache of a data file (atomically)."""
+    data_path, meta_path = _sidecar_paths(path)
+    meta = {"source": _source_signature(path), "heading": heading,
+            "comment_lines": comment_lines, "shape": list(data.shape)}
+    try:
+        with open(data_path + ".tmp", 'wb') as f:
+            np.save(f, data)
+        os.replace(data_path + ".tmp", data_path)
+        with open(meta_path + ".tmp", 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+    except OSError:
+        # read-only directory: just do without the cache
+        pass
+
+
+def import_data_file(path, col_to_read=None, ignored_row=0, cache=True):
     """
     Import a data file produced by tisean.
 
+    The file is parsed in one pass. If 'cache' is True, a binary copy of the
+    data (and heading) is saved next to the file on first load, and used
+    (memory-mapped) for this and the following loads, as long as the file
+    is not modified.
+
     Parameters
     ----------
     path : string
         File path.
+    col_to_read : integer, string or list of integers
+        Column(s) to read, starting from 1 (ex: 2, [1, 3] or '1,3')
+        (Default to all).
+    ignored_row : integer
+        Number of file rows to ignore (Default to 0).
+    cache : boolean
+        If 'True' (default), use (and create if necessary) the binary
+        cache files ('<path>.pytisean.npy' and '<path>.pytisean.json').
 
     Returns
     -------
     heading : string
         Heading of the data file (if exist).
     data : array
-        Data as numpy array.
+        Data as numpy array (read-only if 'cache' is True, and then
+        memory-mapped unless the columns are not evenly spaced).
     """
     if not os.path.isfile(path):
         raise ValueError("No file '{}'".format(path))
-    # load data
-    data = np.loadtxt(path, dtype=float, comments='#')
-    # load headings
-    f = open(path, 'r')
-    msg = ""
-    while True:
-        line = f.readline()
-        if len(line) != 0:
-            if line[0] == '#':
-                msg += line
-            else:
-                break
-    f.close()
-    # return
-    return msg, data
+    cols = None
+    if col_to_read is not None:
+        cols = column_indexes(col_to_read)
+    if cache:
+        loaded = _load_sidecar(path)
+        if loaded is None:
+            # (all the columns are cached, for the other selections)
+            heading, comment_lines, data = _parse_data_file(path)
+            _write_sidecar(path, heading, comment_lines, data)
+            loaded = _load_sidecar(path)
+        if loaded is not None:
+            meta, data = loaded
+            heading, comment_lines = meta["heading"], meta["comment_lines"]
+        # (same result if the cache could not be written)
+        data = _select_columns(data, cols)
+        data.flags.writeable = False
+    else:
+        # only the wanted columns are parsed
+        heading, comment_lines, data = _parse_data_file(path, cols)
+    # ignored rows are counted in file lines (comments included)
+    if ignored_row > 0:
+        nmb_comments = np.sum(np.asarray(comment_lines) < ignored_row)
+        data = data[ignored_row - nmb_comments:]
+    # return (as 'np.loadtxt' would)
+    if data.ndim == 2 and data.shape[1] == 1:
+        data = data[:, 0]
+    return heading, data
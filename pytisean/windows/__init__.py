@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+from .windows import sliding_windows
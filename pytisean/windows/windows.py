@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+""" Sliding-window analysis of long time series
+"""
+
+import numpy as np
+
+from ..nativetools import read_data, data_interval, digitize
+
+__author__ = "Gaby Launay"
+__copyright__ = "Gaby Launay 2017"
+__credits__ = "Rainer Hegger, Holger Kantz and Thomas Schreiber"
+__license__ = "MIT"
+__version__ = "0.1"
+__email__ = "gaby.launay@tutanota.com"
+__status__ = "Development"
+
+
+# Number of distances computed at once for the correlation sums
+PAIR_CHUNK_SIZE = 2**20
+
+
+class _WindowState(object):
+    """
+    State of an incremental analysis over a window of samples.
+
+    The state is defined over a set of items (samples, pairs or delay
+    vectors) whose indexes are in [start, stop - 'self.margin').
+    Subclasses implement '_add' and '_remove' for a range of items,
+    and 'result'.
+    """
+    margin = 0
+
+    def __init__(self, x, start, stop):
+        self.x = x
+        self.start = start
+        self.stop = start
+        self._reset()
+        self.slide(start, stop)
+
+    def _reset(self):
+        raise NotImplementedError()
+
+    def _add(self, start, stop):
+        raise NotImplementedError()
+
+    def _remove(self, start, stop):
+        raise NotImplementedError()
+
+    def slide(self, start, stop):
+        """Move the window to [start, stop)."""
+        old_start, old_stop = self.start, self.stop - self.margin
+        new_start, new_stop = start, stop - self.margin
+        if new_start > old_stop or new_start < old_start \
+                or new_stop < old_stop:
+            # no overlap (or backward move): restart from scratch
+            self._reset()
+            old_start = old_stop = new_start
+        # departing items (the remaining ones are [new_start, old_stop))
+        if new_start > old_start:
+            self._remove(old_start, new_start)
+        self.start = start
+        # arriving items (the ones already there are [new_start, old_stop))
+        if new_stop > old_stop:
+            self._add(old_stop, new_stop)
+        self.stop = stop
+
+    def result(self):
+        raise NotImplementedError()
+
+
+class _HistogramState(_WindowState):
+    """Histogram of the samples (see 'utilities.histogram')."""
+
+    def __init__(self, x, start, stop, bins=50, data_range=None):
+        if data_range is None:
+            data_range = (np.min(x), np.max(x))
+        self.bins = bins
+        self.low, self.high = data_range
+        self.boxes = digitize(x, bins, data_range)
+        super(_HistogramState, self).__init__(x, start, stop)
+
+    def _reset(self):
+        self.counts = np.zeros(self.bins)
+
+    def _add(self, start, stop):
+        self.counts += np.bincount(self.boxes[start:stop],
+                                   minlength=self.bins)
+
+    def _remove(self, start, stop):
+        self.counts -= np.bincount(self.boxes[start:stop],
+                                   minlength=self.bins)
+
+    def result(self):
+        width = (self.high - self.low)/self.bins
+        res = np.empty((self.bins, 2))
+        res[:, 0] = self.low + width*(np.arange(self.bins) + .5)
+        res[:, 1] = self.counts/self.counts.sum()
+        return res
+
+
+class _MutualState(_WindowState):
+    """
+    Time delayed mutual information (see 'embedding.mutual'), from the
+    joint histograms of the pairs (x(t), x(t + tau)).
+    """
+
+    def __init__(self, x, start, stop, max_delay=20, box_nmb=16,
+                 data_range=None):
+        if data_range is None:
+            data_range = (np.min(x), np.max(x))
+        self.max_delay = max_delay
+        self.box_nmb = box_nmb
+        self.boxes = digitize(x, box_nmb, data_range)
+        super(_MutualState, self).__init__(x, start, stop)
+
+    def _reset(self):
+        self.counts = np.zeros((self.max_delay + 1,
+                                self.box_nmb*self.box_nmb))
+
+    def _update(self, tau, first, last, sign):
+        """Add (or remove) the pairs (t, t + tau) for t in [first, last)."""
+        if last <= first:
+            return
+        keys = (self.boxes[first:last]*self.box_nmb
+                + self.boxes[first + tau:last + tau])
+        self.counts[tau] += sign*np.bincount(keys,
+                                             minlength=self.box_nmb**2)
+
+    def _add(self, start, stop):
+        # the pairs (t, t + tau) of the window are the ones with
+        # start <= t < stop - tau: the new ones are the ones whose second
+        # sample arrived
+        for tau in range(self.max_delay + 1):
+            self._update(tau, max(self.start, start - tau), stop - tau, 1)
+
+    def _remove(self, start, stop):
+        # departing pairs: the ones whose first sample left
+        for tau in range(self.max_delay + 1):
+            self._update(tau, start, min(stop, self.stop - tau), -1)
+
+    def result(self):
+        res = np.empty((self.max_delay + 1, 2))
+        res[:, 0] = np.arange(self.max_delay + 1)
+        for tau, counts in enumerate(self.counts):
+            joint = counts.reshape(self.box_nmb, self.box_nmb)
+            joint = joint/joint.sum()
+            marg_1 = joint.sum(axis=1)
+            marg_2 = joint.sum(axis=0)
+            i, j = np.nonzero(joint)
+            res[tau, 1] = np.sum(joint[i, j]*np.log(joint[i, j]
+                                                    / marg_1[i]/marg_2[j]))
+        return res
+
+
+class _CorrelationSumState(_WindowState):
+    """
+    Correlation sums (see 'dimension.d2') of the delay vectors in the
+    window, from the histograms of the pair distances (maximum norm)
+    for each embedding dimension.
+    """
+
+    def __init__(self, x, start, stop, delay=1, max_dim=10, theiler_wind=0,
+                 min_len_scale=None, max_len_scale=None, nmb_eps=100):
+        interval = data_interval(x)
+        if min_len_scale is None:
+            min_len_scale = interval/1000.
+        if max_len_scale is None:
+            max_len_scale = interval
+        self.delay = delay
+        self.max_dim = max_dim
+        self.theiler_wind = theiler_wind
+        self.log_eps = np.linspace(np.log(min_len_scale),
+                                   np.log(max_len_scale), nmb_eps)
+        self.log_eps_step = self.log_eps[1] - self.log_eps[0] \
+            if nmb_eps > 1 else 1.
+        self.eps = np.exp(self.log_eps)
+        self.margin = (max_dim - 1)*delay
+        super(_CorrelationSumState, self).__init__(x, start, stop)
+
+    def _reset(self):
+        self.counts = np.zeros((self.max_dim, len(self.eps) + 1))
+
+    def _pair_counts(self, start_1, stop_1, start_2, stop_2):
+        """
+        Histograms of the distances between the vectors of [start_1, stop_1)
+        and the ones of [start_2, stop_2) (with start_1 <= start_2 and
+        only counting each pair once).
+        """
+        nmb_eps = len(self.eps)
+        counts = np.zeros_like(self.counts)
+        cols = np.arange(start_2, stop_2)
+        chunk_size = max(1, PAIR_CHUNK_SIZE//max(1, len(cols)))
+        for first in range(start_1, stop_1, chunk_size):
+            rows = np.arange(first, min(first + chunk_size, stop_1))
+            # pairs too close in time (only near the diagonal)
+            invalid = None
+            if len(cols) > 0 and rows[-1] + self.theiler_wind >= cols[0]:
+                invalid = cols[None, :] - rows[:, None] <= self.theiler_wind
+            dist = np.zeros((len(rows), len(cols)), dtype=self.x.dtype)
+            for k in range(self.max_dim):
+                shift = k*self.delay
+                np.maximum(dist, np.abs(self.x[rows + shift][:, None]
+                                        - self.x[cols + shift][None, :]),
+                           out=dist)
+                # number of epsilons smaller or equal to the distance
+                # (epsilons are log-spaced)
+                with np.errstate(divide='ignore'):
+                    ind = np.floor((np.log(dist) - self.log_eps[0])
+                                   / self.log_eps_step) + 1
+                ind = np.clip(ind, 0, nmb_eps).astype(int)
+                if invalid is not None:
+                    ind[invalid] = nmb_eps + 1
+                counts[k] += np.bincount(ind.ravel(),
+                                         minlength=nmb_eps + 2)[:-1]
+        return counts
+
+    def _add(self, start, stop):
+        # new vectors against the ones already there, then between them
+        self.counts += self._pair_counts(self.start, start, start, stop)
+        self.counts += self._pair_counts(start, stop, start, stop)
+
+    def _remove(self, start, stop):
+        # departing vectors against the remaining ones, then between them
+        remaining = self.stop - self.margin
+        self.counts -= self._pair_counts(start, stop, stop, remaining)
+        self.counts -= self._pair_counts(start, stop, start, stop)
+
+    def result(self):
+        # number of pairs closer than each epsilon
+        cum = np.cumsum(self.counts, axis=1)[:, :-1]
+        total = self.counts[0].sum()
+        c2 = cum/total if total > 0 else np.zeros_like(cum)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d2 = np.gradient(np.log(c2), np.log(self.eps), axis=1)
+        return self.eps, c2, d2
+
+
+_STATES = {"histogram": _HistogramState,
+           "mutual": _MutualState,
+           "d2": _CorrelationSumState}
+
+
+def sliding_windows(analysis, data, window, step, nmb_data_to_use=None,
+                    ignored_row=0, col_to_read=1, dtype=None, **kwargs):
+    """
+    Run an analysis over sliding windows of a time serie.
+
+    Parameters
+    ----------
+    analysis : string or function
+        Analysis to run on each window:
+        'histogram', 'mutual' or 'd2' use native engines that update
+        their state by removing the departing samples and adding the
+        arriving ones (instead of recomputing each window), any other
+        function (ex: 'lyap_r') is called on each window.
+    data : array or string
+        data, can de an array or a filename (text, '.npy' or '.npz' file).
+    window : integer
+        Windows size (in points).
+    step : integer
+        Step between two successive windows.
+    nmb_data_to_use : integer
+        Number of data points to use (default to everything).
+    ignored_row : integer
+        Number of file rows to ignore if 'time_serie' is a file path
+        (Default to 0).
+    col_to_read : integer
+        Number of columns to be read if 'time_serie' is a file path
+        (Default to 1).
+    kwargs :
+        Additional arguments for the analysis:
+        - 'histogram': bins, data_range
+        - 'mutual': max_delay, box_nmb, data_range
+        - 'd2': delay, max_dim, theiler_wind, min_len_scale,
+          max_len_scale, nmb_eps
+        - function: any of its arguments.
+        For the native engines, the partitions (data_range) and length
+        scales are fixed from the whole time serie, so that windows are
+        comparable.
+    dtype : data-type
+        Type the data are converted to (ex: np.float32, to halve the
+        memory used, default to no conversion).
+
+    Yields
+    ------
+    start : integer
+        First index of the window.
+    res :
+        Analysis results on the window:
+        - 'histogram': (bins, 2) array of [x, y]
+        - 'mutual': (max_delay + 1, 2) array of [tau, mu]
+        - 'd2': epsilons, correlation sums and local slopes
+          (two (max_dim, nmb_eps) arrays)
+        - function: whatever the function returns.
+    """
+    x = read_data(data, nmb_data_to_use=nmb_data_to_use,
+                  ignored_row=ignored_row, col_to_read=col_to_read,
+                  dtype=dtype)
+    if step <= 0 or window <= 0:
+        raise ValueError("'window' and 'step' should be positive")
+    starts = range(0, len(x) - window + 1, step)
+    # generic analysis: one call per window (on views of the data)
+    if callable(analysis):
+        for start in starts:
+            yield start, analysis(x[start:start + window], **kwargs)
+        return
+    if analysis not in _STATES:
+        raise ValueError("Unknown analysis: '{}'".format(analysis))
+    if x.ndim != 1:
+        raise ValueError("Native windowed analyses only handle one column")
+    state = None
+    for start in starts:
+        if state is None:
+            state = _STATES[analysis](x, start, start + window, **kwargs)
+        else:
+            state.slide(start, start + window)
+        yield start, state.result()
@@ -43,11 +43,14 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
 
         # others
         'Natural Language :: English',
         'Operating System :: POSIX :: Linux',
+        # (shared scratch files are locked with 'fcntl')
+        'Operating System :: POSIX',
     ],
 
     # What does your project relate to?
@@ -65,7 +68,12 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['numpy'],
+    install_requires=['numpy',
+                      # (TOML job specifications, see 'runner.load_spec')
+                      'tomli; python_version < "3.11"'],
+
+    # (Python 3.8+ APIs are used, such as 'time.time_ns')
+    python_requires='>=3.8',
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
@@ -92,9 +100,9 @@ setup(
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.
-    # entry_points={
-    #     'console_scripts': [
-    #         'sample=sample:main',
-    #     ],
-    # },
+    entry_points={
+        'console_scripts': [
+            'pytisean-run=pytisean.runner:main',
+        ],
+    },
 )
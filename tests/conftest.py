@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+""" Shared fixtures of the pytisean tests
+"""
+
+import os
+import stat
+import sys
+
+import numpy as np
+import pytest
+
+from pytisean.tiseanwrapper.tiseanwrapper import is_exec
+
+
+def henon_serie(nmb_pts=2000, a=1.4, b=0.3, transient=100):
+    """x coordinate of the Henon map."""
+    x, y = 0.1, 0.1
+    res = np.empty(nmb_pts + transient)
+    for i in range(len(res)):
+        x, y = 1 - a*x**2 + y, b*x
+        res[i] = x
+    return res[transient:]
+
+
+def requires_tisean(*commands):
+    """Skip a test if the TISEAN binaries are not on the path."""
+    missing = [cmd for cmd in commands if not is_exec(cmd)]
+    return pytest.mark.skipif(len(missing) > 0,
+                              reason="TISEAN binaries not found: {}"
+                              .format(", ".join(missing)))
+
+
+# Fake TISEAN command: the options, the input file (or standard input)
+# read as 'x', and 'y' written to the '-o' file (or standard output)
+FAKE_COMMAND = """#!{python}
+import sys
+import numpy as np
+out, inp, opts = None, None, []
+args = sys.argv[1:]
+while args:
+    arg = args.pop(0)
+    if arg == '-o':
+        out = args.pop(0)
+    elif arg.startswith('-'):
+        opts.append(arg)
+    else:
+        inp = arg
+x = np.loadtxt(inp if inp is not None else sys.stdin, ndmin=1)
+{body}
+np.savetxt(out if out is not None else sys.stdout, y)
+"""
+
+
+@pytest.fixture
+def fake_command(tmp_path, monkeypatch):
+    """
+    Factory of fake TISEAN commands, put on the path ('body' computes
+    'y' from the input 'x' and the options 'opts').
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep
+                       + os.environ.get("PATH", ""))
+
+    def make(name, body="y = x"):
+        path = bin_dir / name
+        path.write_text(FAKE_COMMAND.format(python=sys.executable,
+                                            body=body))
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+        return str(path)
+    return make
+
+
+@pytest.fixture
+def henon():
+    return henon_serie()
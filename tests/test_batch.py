@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from pytisean.batch import multichannel, sweep, load_journal, CostModel, \
+    run_scheduled
+from pytisean.batch import batch
+from pytisean.utilities import histogram
+
+from conftest import henon_serie
+
+
+# analyses called (to check what is recomputed)
+CALLS = []
+
+
+def moment(x, order=1, center=False):
+    CALLS.append((order, center))
+    x = np.asarray(x)
+    if center:
+        x = x - np.mean(x)
+    return np.mean(x**order)
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    del CALLS[:]
+
+
+@pytest.fixture
+def channels():
+    """(1000, 3) data set of three different series."""
+    return np.column_stack((henon_serie(1000), henon_serie(1000, a=1.3),
+                            np.random.RandomState(0).normal(size=1000)))
+
+
+@pytest.mark.parametrize("nmb_proc", [1, 3])
+def test_multichannel(channels, nmb_proc):
+    res = multichannel(histogram, channels, nmb_proc=nmb_proc, bins=20,
+                       native=True)
+    assert res.shape == (3, 20, 2)
+    for i in range(3):
+        np.testing.assert_allclose(res[i], histogram(channels[:, i],
+                                                     bins=20, native=True))
+    res = multichannel(histogram, channels, channels='3,1',
+                       nmb_data_to_use=500, ignored_row=10, bins=20,
+                       native=True)
+    np.testing.assert_allclose(res[0], histogram(channels[10:510, 2],
+                                                  bins=20, native=True))
+    np.testing.assert_allclose(res[1], histogram(channels[10:510, 0],
+                                                 bins=20, native=True))
+
+
+def test_multichannel_files(channels, tmp_path):
+    ref = multichannel(np.mean, channels[5:])
+    np.savetxt(str(tmp_path / "x.dat"), channels)
+    np.save(str(tmp_path / "x.npy"), channels)
+    for name in ["x.dat", "x.npy"]:
+        res = multichannel(np.mean, str(tmp_path / name), ignored_row=5)
+        np.testing.assert_allclose(res, ref)
+    res = multichannel(np.mean, str(tmp_path / "x.npy"), channels=[2])
+    np.testing.assert_allclose(res, [np.mean(channels[:, 1])])
+
+
+def test_multichannel_results(channels):
+    # tuples of arrays are stacked element-wise
+    res = multichannel(lambda x: (np.min(x), x[:3]), channels)
+    np.testing.assert_allclose(res[0], np.min(channels, axis=0))
+    np.testing.assert_allclose(res[1], channels[:3].T)
+    # results of different shapes are returned as a list
+    res = multichannel(lambda x: x[x > 0], channels)
+    assert isinstance(res, list) and len(res) == 3
+    np.testing.assert_allclose(res[2], channels[channels[:, 2] > 0, 2])
+
+
+def test_multichannel_tisean(fake_command, channels):
+    # (each channel is serialized for the command)
+    fake_command('histogram', "y = np.array([len(x), np.mean(x)])")
+    res = multichannel(histogram, channels, nmb_proc=2)
+    np.testing.assert_allclose(res[:, 0], 1000)
+    np.testing.assert_allclose(res[:, 1], np.mean(channels, axis=0))
+
+
+@pytest.mark.parametrize("nmb_proc", [1, 3])
+def test_sweep(tmp_path, nmb_proc):
+    inputs = [henon_serie(500), henon_serie(600, a=1.3)]
+    grid = {'order': [1, 2, 3], 'center': [False, True]}
+    journal = str(tmp_path / "journal")
+    res = sweep(moment, inputs, grid, journal, nmb_proc=nmb_proc)
+    assert len(res) == 12 and len(CALLS) == 12
+    for cell in res:
+        x = inputs[cell['input']]
+        if cell['params']['center']:
+            x = x - np.mean(x)
+        assert cell['result'] == pytest.approx(
+            np.mean(x**cell['params']['order']))
+    records = load_journal(journal)
+    assert len(records) == 12
+    assert all(rec['function'].endswith('.moment')
+               for rec in records.values())
+    # resumed sweep: only the missing results are computed
+    os.remove(os.path.join(journal, sorted(records)[0] + '.pkl'))
+    del CALLS[:]
+    again = sweep(moment, inputs, grid, journal, nmb_proc=nmb_proc)
+    assert len(CALLS) == 1
+    assert [cell['result'] for cell in again] \
+        == [cell['result'] for cell in res]
+
+
+def test_sweep_journal(tmp_path):
+    x = henon_serie(500)
+    journal = str(tmp_path / "journal")
+    grid = [{'order': 2}, {'order': 4, 'center': True}]
+    sweep(moment, [x], grid, journal)
+    assert CALLS == [(2, False), (4, True)]
+    # (interrupted writes and unreadable records are recomputed)
+    with open(os.path.join(journal, "partial.pkl.tmp"), 'wb') as f:
+        f.write(b"partial")
+    name = sorted(load_journal(journal))[0]
+    with open(os.path.join(journal, name + '.pkl'), 'wb') as f:
+        f.write(b"")
+    assert len(load_journal(journal)) == 1
+    sweep(moment, [x], grid, journal)
+    assert len(CALLS) == 3
+    # inputs identified by content (new parameters or data)
+    sweep(moment, [x.copy()], grid + [{'order': 3}], journal)
+    assert len(CALLS) == 4
+    sweep(moment, [x + 1], grid, journal)
+    assert len(CALLS) == 6
+    assert load_journal(str(tmp_path / "missing")) == {}
+
+
+def test_cost_model(tmp_path, monkeypatch):
+    x = np.zeros(1000)
+    model = CostModel()
+    job = {'function': 'mutual', 'input': x, 'params': {'max_delay': 9}}
+    assert model.work(job) == 1000*10
+    # (function defaults are used)
+    assert model.work(dict(job, params={})) == 1000*21
+    assert model.work(dict(job, params={'nmb_data_to_use': 100})) == 100*21
+    # unknown analyses: points times dimension
+    assert model.work({'function': moment, 'input': x,
+                       'params': {'dim': 3}}) == 3000
+    assert model.estimate(job) == pytest.approx(1e4*1e-7)
+    assert model.memory(job) == 8*1000*(3 + 4)
+    # calibration (saved and loaded)
+    model.update(job, 2.)
+    assert model.estimate(job) == pytest.approx(2.)
+    model.update(job, 4.)
+    assert model.estimate(job) == pytest.approx(0.7*2. + 0.3*4.)
+    path = str(tmp_path / "cost.json")
+    model.path = path
+    model.save()
+    assert CostModel(path).estimate(job) == pytest.approx(2.6)
+    # the points of the input files are counted once
+    data = tmp_path / "x.dat"
+    np.savetxt(str(data), x)
+    counted = []
+    count = batch._nmb_points
+    monkeypatch.setattr(batch, '_nmb_points',
+                        lambda *args: counted.append(1) or count(*args))
+    job = dict(job, input=str(data))
+    assert model.nmb_points(job) == 1000
+    model.work(job)
+    model.memory(job)
+    assert len(counted) == 1
+    np.savetxt(str(data), x[:10])
+    os.utime(str(data), ns=(0, 0))
+    assert model.nmb_points(job) == 10
+
+
+def test_run_scheduled_order():
+    started = []
+
+    def runner(job):
+        started.append(job['input'])
+        return len(job['input'])
+
+    jobs = [{'function': 'histogram', 'input': np.zeros(nmb)}
+            for nmb in [10, 1000, 100]]
+    res, durations = run_scheduled(jobs, runner=runner)
+    # longest expected first, results in the jobs order
+    assert [len(x) for x in started] == [1000, 100, 10]
+    assert res == [10, 1000, 100]
+    assert len(durations) == 3
+    # default runner
+    res, _ = run_scheduled([{'function': moment, 'input': np.ones(5),
+                             'params': {'order': 2}}])
+    assert res == [1.]
+
+
+def test_run_scheduled_memory():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def runner(job):
+        with lock:
+            running.append(len(job['input']))
+            peak.append(sum(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(len(job['input']))
+
+    model = CostModel()
+    jobs = [{'function': 'histogram', 'input': np.zeros(nmb)}
+            for nmb in [1000, 900, 600, 500, 100]]
+    max_memory = model.memory(jobs[0]) + model.memory(jobs[-1])
+    run_scheduled(jobs, nmb_proc=4, max_memory=max_memory,
+                  cost_model=model, runner=runner)
+    # (the smaller jobs are run meanwhile, within the memory limit)
+    assert max(peak) <= 1100
+    assert max(peak) > 1000
+
+
+def test_run_scheduled_failed():
+    model = CostModel()
+    jobs = [{'function': 'histogram', 'input': np.zeros(1000)},
+            {'function': 'mutual', 'input': np.zeros(1000)}]
+
+    def runner(job):
+        time.sleep(0.01)
+        return job['function'] == 'mutual'
+
+    run_scheduled(jobs, cost_model=model, runner=runner,
+                  is_failed=lambda failed: failed)
+    # (only the successful job calibrates the model)
+    assert 'histogram' in model.coefs
+    assert 'mutual' not in model.coefs
+
+
+def test_run_scheduled_nmb_proc():
+    jobs = [{'function': moment, 'input': np.ones(5)}]
+    for nmb_proc in [0, -1]:
+        with pytest.raises(ValueError):
+            run_scheduled(jobs, nmb_proc=nmb_proc)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import numpy as np
+import pytest
+
+from pytisean.embedding import mutual, false_nearest, select_embedding
+from pytisean.nativetools import embed
+
+from conftest import henon_serie, requires_tisean
+
+
+def false_nearest_reference(x, dim, delay, ratio, theiler_wind):
+    """False nearest neighbors fraction, from all the pair distances."""
+    nmb_vec = len(x) - dim*delay
+    emb = embed(x, dim, delay)[:nmb_vec]
+    dist = np.max(np.abs(emb[:, None] - emb[None, :]), axis=2)
+    ind = np.arange(nmb_vec)
+    dist[np.abs(ind[:, None] - ind[None, :]) <= theiler_wind] = np.inf
+    nind = np.argmin(dist, axis=1)
+    dist = dist[ind, nind]
+    filt = (dist > 0) & (dist < np.std(x)/ratio)
+    qind, nind, dist = ind[filt], nind[filt], dist[filt]
+    next_dist = np.abs(x[qind + dim*delay] - x[nind + dim*delay])
+    return [dim, np.mean(next_dist/dist > ratio), np.mean(dist),
+            np.mean(dist**2)]
+
+
+def mutual_reference(x, max_delay, box_nmb):
+    """Mutual information, from the joint histograms."""
+    data_range = (np.min(x), np.max(x))
+    res = []
+    for tau in range(max_delay + 1):
+        joint, _, _ = np.histogram2d(x[:len(x) - tau], x[tau:], box_nmb,
+                                     range=[data_range, data_range])
+        joint /= joint.sum()
+        prod = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+        nz = joint > 0
+        res.append([tau, np.sum(joint[nz]*np.log(joint[nz]/prod[nz]))])
+    return np.array(res)
+
+
+def test_mutual_native():
+    x = henon_serie(2000)
+    res = mutual(x, max_delay=10, box_nmb=12, native=True)
+    np.testing.assert_allclose(res, mutual_reference(x, 10, 12),
+                               atol=1e-12)
+
+
+@pytest.mark.parametrize("delay, ratio, theiler_wind", [(1, 2., 0),
+                                                        (2, 10., 5)])
+def test_false_nearest_native(delay, ratio, theiler_wind):
+    x = henon_serie(800)
+    res = false_nearest(x, min_dim=1, max_dim=4, delay=delay, ratio=ratio,
+                        theiler_wind=theiler_wind, native=True)
+    ref = [false_nearest_reference(x, dim, delay, ratio, theiler_wind)
+           for dim in range(1, 5)]
+    np.testing.assert_allclose(res, ref)
+
+
+@requires_tisean('false_nearest')
+def test_false_nearest_tisean():
+    x = henon_serie(2000)
+    res = np.asarray(false_nearest(x, max_dim=4))
+    nat = false_nearest(x, max_dim=4, native=True)
+    np.testing.assert_allclose(nat[:, :2], res[:, :2], atol=0.02)
+
+
+@pytest.mark.parametrize("nmb_proc", [1, 2])
+def test_select_embedding(nmb_proc):
+    # (sine: decorrelated after a quarter period, mutual information
+    # minimum after about a quarter period too)
+    t = np.arange(3000)
+    x = np.sin(2*np.pi*t/40.) + 0.01*henon_serie(3000)
+    delay, dim, curves = select_embedding(x, max_delay=30, max_dim=5,
+                                          nmb_proc=nmb_proc)
+    np.testing.assert_allclose(curves["mutual"],
+                               mutual_reference(x, 30, 16), atol=1e-12)
+    acf = [np.corrcoef(x[:len(x) - tau], x[tau:])[0, 1]
+           for tau in range(1, 31)]
+    np.testing.assert_allclose(curves["autocorrelation"][1:, 1], acf,
+                               atol=0.02)
+    assert curves["decorrelation_time"] == np.argmax(np.array(acf)
+                                                     < 1/np.e) + 1
+    assert delay in curves["false_nearest"]
+    assert 8 <= delay <= 12
+
+
+def test_select_embedding_dimension():
+    # (the Henon map is two dimensional)
+    x = henon_serie(1000)
+    delay, dim, curves = select_embedding(x, delays=[1], max_dim=5)
+    assert (delay, dim) == (1, 2)
+    fnn = curves["false_nearest"][1]
+    # the dimension is the first one below the threshold (and the larger
+    # ones are not computed)
+    assert np.array_equal(fnn[:, 0], [1, 2])
+    assert fnn[0, 1] >= 0.01 and fnn[1, 1] < 0.01
+
+def test_select_embedding_delays():
+    x = henon_serie(1000)
+    delay, dim, curves = select_embedding(x, delays=[1, 3], max_dim=4,
+                                          ratio=2.)
+    assert sorted(curves["false_nearest"]) == [1, 3]
+    for tau, fnn in curves["false_nearest"].items():
+        ref = [false_nearest_reference(x, d, tau, 2., 0)
+               for d in range(1, len(fnn) + 1)]
+        np.testing.assert_allclose(fnn, ref)
+    assert delay in [1, 3]
+
+
+def test_native_float32():
+    x = henon_serie(1000)
+    res = mutual(x, max_delay=10, box_nmb=12, native=True)
+    res32 = mutual(x, max_delay=10, box_nmb=12, native=True,
+                   dtype=np.float32)
+    np.testing.assert_allclose(res32, res, atol=1e-6)
+    res = false_nearest(x, max_dim=4, native=True)
+    res32 = false_nearest(x, max_dim=4, native=True, dtype=np.float32)
+    np.testing.assert_allclose(res32, res, atol=0.01)
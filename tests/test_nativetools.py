@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import glob
+import multiprocessing
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from pytisean.nativetools import NeighborIndex, read_data, SharedArray
+from pytisean.tiseanwrapper import tisean, write_input
+
+
+def pairs(qind, nind):
+    """Sorted (query, neighbor) pairs."""
+    return sorted(zip(np.asarray(qind).tolist(), np.asarray(nind).tolist()))
+
+
+def query_reference(points, queries, eps):
+    """Brute-force maximum norm neighbors."""
+    dist = np.max(np.abs(queries[:, None] - points[None, :]), axis=2)
+    return pairs(*np.nonzero(dist < eps))
+
+
+@pytest.mark.parametrize("dim", [1, 2, 4])
+def test_neighbor_index_query(dim):
+    rand = np.random.RandomState(0)
+    points = rand.uniform(-1, 1, (2000, dim))
+    queries = rand.uniform(-1, 1, (300, dim))
+    index = NeighborIndex(points, 0.1)
+    for eps in [0.05, 0.1, 0.33]:
+        qind, nind, dist = index.query(queries, eps)
+        assert pairs(qind, nind) == query_reference(points, queries, eps)
+        np.testing.assert_allclose(
+            dist, np.max(np.abs(queries[qind] - points[nind]), axis=1))
+
+
+@pytest.mark.parametrize("nmb_add", [1, 7, 1500])
+def test_neighbor_index_add(nmb_add):
+    rand = np.random.RandomState(1)
+    points = rand.uniform(-1, 1, (3000, 2))
+    queries = rand.uniform(-1.5, 1.5, (50, 2))
+    index = NeighborIndex(points[:1000], 0.1)
+    for start in range(1000, 3000, nmb_add):
+        index.add(points[start:start + nmb_add])
+        if (start//nmb_add) % 50 == 0:
+            # (sorted and not yet sorted points are found)
+            assert pairs(*index.query(queries, 0.1)[:2]) \
+                == query_reference(points[:len(index)], queries, 0.1)
+    assert len(index) == 3000
+    assert np.array_equal(index.points, points)
+    assert np.array_equal(np.sort(index.order), np.arange(3000))
+    assert pairs(*index.query(queries, 0.1)[:2]) \
+        == query_reference(points, queries, 0.1)
+    # points outside the initial bounds are reached
+    far = np.array([[5., 5.]])
+    index.add(far)
+    nind, _ = index.query_knn(far + 0.5, 1, 0.01)
+    assert nind[0, 0] == 3000
+
+
+def test_neighbor_index_update():
+    rand = np.random.RandomState(2)
+    points = rand.uniform(-1, 1, (1000, 3))
+    index = NeighborIndex(points, 0.1)
+    index.add(rand.uniform(-1, 1, (10, 3)))
+    moved = index.points + rand.normal(0, 0.05, index.points.shape)
+    index.update(moved)
+    assert pairs(*index.query(moved[:100], 0.1)[:2]) \
+        == query_reference(moved, moved[:100], 0.1)
+    with pytest.raises(ValueError):
+        index.update(moved[:10])
+
+
+def test_neighbor_index_from_sorted():
+    rand = np.random.RandomState(3)
+    points = rand.uniform(-1, 1, (500, 2))
+    index = NeighborIndex(points, 0.1)
+    copy = NeighborIndex.from_sorted(points, 0.1, index.keys, index.order)
+    assert pairs(*copy.query(points, 0.1)[:2]) \
+        == pairs(*index.query(points, 0.1)[:2])
+
+
+def test_neighbor_index_min_neighbors_and_knn():
+    rand = np.random.RandomState(4)
+    points = rand.uniform(-1, 1, (1000, 2))
+    queries = rand.uniform(-1, 1, (20, 2))
+    index = NeighborIndex(points, 0.1)
+    qind, _, _ = index.query_min_neighbors(queries, 0.01, 15)
+    assert np.all(np.bincount(qind, minlength=20) >= 15)
+    assert np.all(np.diff(qind) >= 0)
+    nind, dist = index.query_knn(queries, 5, 0.01)
+    ref = np.max(np.abs(queries[:, None] - points[None, :]), axis=2)
+    np.testing.assert_allclose(dist, np.sort(ref, axis=1)[:, :5])
+    np.testing.assert_allclose(dist, np.take_along_axis(ref, nind, axis=1))
+    # excluded neighbors
+    nind, _ = index.query_knn(points[:20], 1, 0.01,
+                              exclude=lambda q, n: q == n)
+    assert np.all(nind[:, 0] != np.arange(20))
+    with pytest.raises(ValueError):
+        index.query_knn(queries, 1001, 0.01)
+
+
+def test_read_data_binary(tmp_path):
+    x = np.arange(300.).reshape(100, 3)
+    np.save(str(tmp_path / "x.npy"), x)
+    np.savez(str(tmp_path / "x.npz"), x)
+    np.savetxt(str(tmp_path / "x.dat"), x)
+    mapped = np.load(str(tmp_path / "x.npy"), mmap_mode='r')
+    for data in [x, mapped, str(tmp_path / "x.npy"),
+                 str(tmp_path / "x.npz"), str(tmp_path / "x.dat")]:
+        res = read_data(data, nmb_data_to_use=10, ignored_row=2,
+                        col_to_read=2, nmb_col_to_read=2)
+        assert np.array_equal(res, x[2:12, 1:3])
+        res = read_data(data, col_to_read='1,3')
+        assert np.array_equal(res, x[:, [0, 2]])
+    # (memory-mapped data is not read, but viewed)
+    res = read_data(mapped, col_to_read=3)
+    assert np.shares_memory(res, mapped)
+    assert np.array_equal(res, x[:, 2])
+    res = read_data(mapped, col_to_read=3, copy=True)
+    assert not np.shares_memory(res, mapped)
+    res = read_data(mapped, col_to_read=3, dtype=np.float32, copy=True)
+    assert res.dtype == np.float32
+
+
+def shared_files(shared):
+    """Scratch files of a shared array (data, references and texts)."""
+    return glob.glob(glob.escape(shared.path[:-4]) + '*')
+
+
+def shared_sum(shared):
+    try:
+        return float(np.sum(shared.array))
+    finally:
+        shared.close()
+
+
+def test_shared_array():
+    x = np.arange(100.).reshape(50, 2)
+    with SharedArray(x) as shared:
+        assert np.array_equal(shared.array, x)
+        assert np.array_equal(np.asarray(shared), x)
+        assert len(shared) == 50 and shared.shape == (50, 2)
+        assert not shared.array.flags.writeable
+        assert np.array_equal(read_data(shared, col_to_read=2), x[:, 1])
+        files = shared_files(shared)
+        assert len(files) == 2
+    assert not any(os.path.exists(path) for path in files)
+    with pytest.raises(ValueError):
+        shared.array
+    with pytest.raises(ValueError):
+        pickle.dumps(shared)
+
+
+def test_shared_array_pickle():
+    shared = SharedArray(np.arange(10))
+    dumped = pickle.dumps(shared)
+    # (the pickled handle keeps the data alive)
+    shared.close()
+    assert os.path.isfile(shared.path)
+    other = pickle.loads(dumped)
+    assert np.array_equal(other.array, np.arange(10))
+    other.close()
+    assert not os.path.exists(shared.path)
+
+
+def test_shared_array_processes():
+    x = np.random.RandomState(0).normal(size=(1000, 3))
+    with SharedArray(x) as shared:
+        with multiprocessing.Pool(2) as pool:
+            res = pool.map(shared_sum, [shared]*4)
+        assert res == pytest.approx([np.sum(x)]*4)
+        path = shared.path
+        assert os.path.isfile(path)
+    assert not os.path.exists(path)
+
+
+def test_shared_array_text_file(fake_command):
+    x = np.linspace(0, 1, 30)
+    calls = []
+
+    def writer(path, array, dtype=None):
+        calls.append(dtype)
+        write_input(path, array, dtype=dtype)
+
+    with SharedArray(x) as shared:
+        # (written once per type)
+        path = shared.text_file(writer)
+        assert shared.text_file(writer) == path
+        path_32 = shared.text_file(writer, np.float32)
+        assert path_32 != path
+        assert calls == [None, np.float32]
+        assert np.array_equal(np.loadtxt(path), x)
+        np.testing.assert_allclose(np.loadtxt(path_32), x, rtol=1e-7)
+        # given to the TISEAN wrapper
+        fake_command('fakecmd')
+        res, _ = tisean('fakecmd', [], input_data=shared)
+        assert np.array_equal(res, x)
+        files = shared_files(shared)
+    assert not any(os.path.exists(path) for path in files)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import glob
+import os
+
+import numpy as np
+import pytest
+
+from pytisean.noise_reduction import ghkss, lazy
+from pytisean.nativetools import embed
+from pytisean.nativetools.nativetools import SHARED_DIR
+
+from conftest import henon_serie, requires_tisean
+
+
+def noisy_henon(nmb_pts=1000, level=0.02, seed=0):
+    """Henon serie, and the serie with additive gaussian noise."""
+    x = henon_serie(nmb_pts)
+    noise = np.random.RandomState(seed).normal(0, level*np.std(x), len(x))
+    return x, x + noise
+
+
+def ghkss_reference(x, dim, delay, dim_manifold, min_nmb_neigh,
+                    min_neigh_size, euclidean_metric):
+    """One GHKSS iteration, one delay vector at a time."""
+    emb = embed(x, dim, delay)
+    weights = np.ones(dim)
+    if not euclidean_metric:
+        weights[0] = weights[-1] = 1e3
+    corr = np.zeros(len(x))
+    nmb_contrib = np.zeros(len(x))
+    for i, ref in enumerate(emb):
+        dist = np.max(np.abs(emb - ref), axis=1)
+        eps = min_neigh_size
+        while np.sum(dist < eps) < min_nmb_neigh:
+            eps *= 1.2
+        neigh = emb[dist < eps]
+        center = np.mean(neigh, axis=0)
+        dev = (neigh - center)*weights
+        _, vects = np.linalg.eigh(dev.T.dot(dev)/len(neigh))
+        noise = vects[:, :dim - dim_manifold]
+        proj = noise.dot(noise.T.dot((ref - center)*weights))/weights
+        times = i + delay*np.arange(dim)
+        corr[times] += proj
+        nmb_contrib[times] += 1
+    return x - corr/np.maximum(nmb_contrib, 1)
+
+
+@pytest.mark.parametrize("delay, euclidean_metric", [(1, False),
+                                                     (2, True)])
+def test_ghkss_native(delay, euclidean_metric):
+    _, x = noisy_henon(500)
+    res = ghkss(x, delay=delay, dim=4, dim_manifold=2, min_nmb_neigh=20,
+                min_neigh_size=0.01, euclidean_metric=euclidean_metric,
+                native=True)
+    ref = ghkss_reference(x, 4, delay, 2, 20, 0.01, euclidean_metric)
+    np.testing.assert_allclose(res, ref, atol=1e-10)
+
+
+def test_ghkss_native_reduces_noise():
+    # (projections need dense neighborhoods)
+    clean, x = noisy_henon(5000, level=0.05)
+    x_orig = x.copy()
+    res = ghkss(x, dim=5, dim_manifold=2, nmb_it=2, native=True)
+    # (the input is not modified)
+    assert np.array_equal(x, x_orig)
+    assert np.std(res - clean) < 0.7*np.std(x - clean)
+
+
+def test_ghkss_native_processes():
+    _, x = noisy_henon()
+    before = set(glob.glob(os.path.join(SHARED_DIR, '*')))
+    res = ghkss(x, dim=4, nmb_it=2, native=True)
+    res_par = ghkss(x, dim=4, nmb_it=2, native=True, nmb_proc=2)
+    np.testing.assert_allclose(res_par, res, rtol=0, atol=1e-12)
+    # (the shared arrays are cleaned up)
+    assert set(glob.glob(os.path.join(SHARED_DIR, '*'))) == before
+
+
+def test_ghkss_native_errors():
+    _, x = noisy_henon(200)
+    with pytest.raises(ValueError):
+        ghkss(x, dim=3, dim_manifold=3, native=True)
+    with pytest.raises(ValueError):
+        ghkss(x, nmb_comp=2, native=True)
+
+
+@requires_tisean('ghkss')
+def test_ghkss_tisean():
+    _, x = noisy_henon()
+    res = ghkss(x, dim=5, dim_manifold=2, min_nmb_neigh=30, nmb_it=2)
+    nat = ghkss(x, dim=5, dim_manifold=2, min_nmb_neigh=30, nmb_it=2,
+                native=True)
+    res = np.asarray(res).ravel()
+    # (TISEAN neighbors search slightly differs on the boundaries)
+    assert np.median(np.abs(nat - res)) < 0.1*np.std(x - res)
+
+
+def lazy_reference(x, dim, radius, nmb_it):
+    """Locally constant noise reduction of a whole serie."""
+    x = np.array(x, dtype=float)
+    mid = dim//2
+    for _ in range(nmb_it):
+        emb = embed(x, dim)
+        dist = np.max(np.abs(emb[:, None] - emb[None, :]), axis=2)
+        neigh = dist < radius
+        x[mid:mid + len(emb)] = neigh.dot(emb[:, mid])/neigh.sum(axis=1)
+    return x
+
+
+def lazy_chunks_reference(x, dim, radius, nmb_it, chunk_size):
+    """
+    Chunked noise reduction (each chunk filtered with the 'dim - 1' raw
+    points around it).
+    """
+    pad = dim - 1
+    res = []
+    for start in range(0, len(x), chunk_size):
+        first = max(start - pad, 0)
+        filt = lazy_reference(x[first:start + chunk_size + pad], dim,
+                              radius, nmb_it)
+        res.append(filt[start - first:start - first + chunk_size])
+    return np.concatenate(res)
+
+
+@pytest.mark.parametrize("dim, nmb_it", [(3, 1), (4, 3)])
+def test_lazy_native(dim, nmb_it):
+    _, x = noisy_henon(600)
+    res = lazy(x, dim=dim, radius=0.05, nmb_it=nmb_it, native=True)
+    np.testing.assert_allclose(res, lazy_reference(x, dim, 0.05, nmb_it))
+
+
+@pytest.mark.parametrize("chunk_size", [50, 97, 599, 600])
+def test_lazy_native_chunks(chunk_size):
+    _, x = noisy_henon(600)
+    ref = lazy_chunks_reference(x, 3, 0.05, 2, chunk_size)
+    res = lazy(x, dim=3, radius=0.05, nmb_it=2, native=True,
+               chunk_size=chunk_size)
+    np.testing.assert_allclose(res, ref)
+    # from an iterator of arrays of other sizes
+    parts = iter(np.array_split(x, 7))
+    res = lazy(parts, dim=3, radius=0.05, nmb_it=2, native=True,
+               chunk_size=chunk_size)
+    np.testing.assert_allclose(res, ref)
+
+
+def test_lazy_native_rel_radius():
+    _, x = noisy_henon(600)
+    res = lazy(x, dim=3, rel_radius=0.1, native=True)
+    np.testing.assert_allclose(res, lazy_reference(x, 3, 0.1*np.std(x), 1))
+    with pytest.raises(ValueError):
+        lazy(iter([x]), dim=3, rel_radius=0.1, native=True)
+    with pytest.raises(ValueError):
+        lazy(x, dim=3, native=True)
+
+
+def test_lazy_native_output_file(tmp_path):
+    _, x = noisy_henon(600)
+    res = lazy(x, dim=3, radius=0.05, native=True, chunk_size=100)
+    assert isinstance(res, np.memmap)
+    path = tmp_path / "lazy.dat"
+    assert lazy(x, dim=3, radius=0.05, native=True, chunk_size=100,
+                output_file=str(path)) is None
+    np.testing.assert_allclose(np.loadtxt(path), res)
+
+
+@requires_tisean('lazy')
+def test_lazy_tisean():
+    _, x = noisy_henon(600)
+    res = np.asarray(lazy(x, dim=3, radius=0.05, nmb_it=2))
+    res = res.reshape(len(x), -1)[:, 0]
+    nat = lazy(x, dim=3, radius=0.05, nmb_it=2, native=True)
+    np.testing.assert_allclose(nat, res, atol=1e-5)
+
+
+def test_native_float32():
+    _, x = noisy_henon(500)
+    res = ghkss(x, dim=4, min_nmb_neigh=20, min_neigh_size=0.01,
+                native=True)
+    res32 = ghkss(x, dim=4, min_nmb_neigh=20, min_neigh_size=0.01,
+                  native=True, dtype=np.float32)
+    assert res32.dtype == np.float32
+    np.testing.assert_allclose(res32, res, atol=1e-4)
+    res = lazy(x, dim=3, radius=0.05, nmb_it=2, native=True)
+    res32 = lazy(x, dim=3, radius=0.05, nmb_it=2, native=True,
+                 dtype=np.float32)
+    assert res32.dtype == np.float32
+    np.testing.assert_allclose(res32, res, atol=1e-5)
+    with pytest.raises(ValueError):
+        ghkss(x, dim=4, native=True, dtype=int)
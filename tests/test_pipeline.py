@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import functools
+
+import numpy as np
+import pytest
+
+from pytisean.pipeline import Pipeline, Node
+
+# operations called (to check what is recomputed)
+CALLS = []
+
+# Fake command adding the '-a' option value to its input
+ADD = """
+opts = dict((opt[:2], opt[2:]) for opt in opts)
+y = x + float(opts['-a'])
+"""
+
+
+def scale(x, factor=2.):
+    CALLS.append('scale')
+    return np.asarray(x)*factor
+
+
+def shift(x, offset):
+    CALLS.append('shift')
+    return x + offset
+
+
+def total(*xs):
+    CALLS.append('total')
+    return sum(np.sum(x) for x in xs)
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    del CALLS[:]
+
+
+def test_pipeline_memoization():
+    x = np.arange(10.)
+    pipe = Pipeline()
+    scaled = pipe.add(scale, x)
+    assert pipe.run(pipe.add(shift, scaled, 1.)) == pytest.approx(2*x + 1)
+    assert CALLS == ['scale', 'shift']
+    # only the changed downstream node is computed
+    assert pipe.run(pipe.add(shift, scaled, 3.)) == pytest.approx(2*x + 3)
+    assert CALLS == ['scale', 'shift', 'shift']
+    assert pipe.nmb_computed == 3
+    # same content, same nodes
+    res = pipe.run([pipe.add(shift, pipe.add(scale, x.copy()), 1.),
+                    pipe.add(scale, x, factor=3.)])
+    assert res[0] == pytest.approx(2*x + 1)
+    assert res[1] == pytest.approx(3*x)
+    assert CALLS == ['scale', 'shift', 'shift', 'scale']
+    pipe.clear()
+    pipe.run(scaled)
+    assert CALLS[-1] == 'scale'
+
+
+@pytest.mark.parametrize("nmb_proc", [1, 4])
+def test_pipeline_graph(nmb_proc):
+    x = np.arange(10.)
+    pipe = Pipeline()
+    scaled = pipe.add(scale, x)
+    shifts = [pipe.add(shift, scaled, offset) for offset in range(5)]
+    res = pipe.run(pipe.add(total, *shifts), nmb_proc=nmb_proc)
+    assert res == pytest.approx(sum(np.sum(2*x + i) for i in range(5)))
+    assert sorted(CALLS) == ['scale'] + ['shift']*5 + ['total']
+
+
+def test_pipeline_cache_dir(tmp_path):
+    x = np.arange(10.)
+    pipe = Pipeline(cache_dir=str(tmp_path / "cache"))
+    res = pipe.run(pipe.add(shift, pipe.add(scale, x), 1.))
+    # (results reused by an other session)
+    pipe = Pipeline(cache_dir=str(tmp_path / "cache"))
+    assert pipe.run(pipe.add(shift, pipe.add(scale, x), 1.)) \
+        == pytest.approx(res)
+    assert pipe.nmb_computed == 0
+    assert CALLS == ['scale', 'shift']
+
+
+def test_node_keys(tmp_path):
+    x = np.arange(10.)
+
+    def make_scale(factor):
+        def func(x):
+            return x*factor
+        return func
+
+    def key(func, *args, **kwargs):
+        return Node(func, args, kwargs).key
+    # arguments by content
+    assert key(scale, x) == key(scale, x.copy())
+    assert key(scale, x) != key(scale, x + 1)
+    assert key(scale, x, factor=3.) != key(scale, x)
+    assert key(scale, [1, {'a': 2}]) != key(scale, [1, {'a': 3}])
+    # functions by code, defaults and closure values
+    assert key(make_scale(2.), x) == key(make_scale(2.), x)
+    assert key(make_scale(2.), x) != key(make_scale(3.), x)
+    assert key(lambda x: x + 1, x) != key(lambda x: x + 2, x)
+    assert key(functools.partial(shift, offset=1.), x) \
+        != key(functools.partial(shift, offset=2.), x)
+    assert key(np.sum, x) != key(np.mean, x)
+    # files by path and modification
+    path = tmp_path / "x.dat"
+    path.write_text("1\n2\n")
+    before = key(np.loadtxt, str(path))
+    path.write_text("1\n2\n3\n")
+    assert key(np.loadtxt, str(path)) != before
+
+
+def test_node_keys_unidentified():
+    class Analysis(object):
+        def __call__(self, x):
+            return x
+
+    pipe = Pipeline()
+    with pytest.raises(ValueError):
+        pipe.add(Analysis(), np.arange(3.))
+    with pytest.raises(ValueError):
+        pipe.add(scale, object())
+    node = pipe.add_named('identity-v1', Analysis(), np.arange(3.))
+    assert node.key == pipe.add_named('identity-v1', Analysis(),
+                                      np.arange(3.)).key
+    assert pipe.run(node) == pytest.approx([0, 1, 2])
+
+
+def test_pipeline_commands(fake_command):
+    fake_command('fakeadd', ADD)
+    x = np.arange(10.)
+    pipe = Pipeline()
+    first = pipe.add_command('fakeadd', ['-a1'], x)
+    second = pipe.add_command('fakeadd', ['-a10'], first)
+    third = pipe.add_command('fakeadd', ['-a100'], second)
+    assert pipe.run(third) == pytest.approx(x + 111)
+    # (the intermediate commands are streamed, not materialized)
+    assert pipe.nmb_computed == 3
+    assert first.key not in pipe._memo and second.key not in pipe._memo
+    # an intermediate result used elsewhere is materialized
+    pipe = Pipeline()
+    res = pipe.run([third, pipe.add(scale, second)])
+    assert res[0] == pytest.approx(x + 111)
+    assert res[1] == pytest.approx(2*(x + 11))
+    assert second.key in pipe._memo and first.key not in pipe._memo
+    # and a memoized result is not computed again
+    pipe.run(pipe.add_command('fakeadd', ['-a5'], second))
+    assert pipe.nmb_computed == 5
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import numpy as np
+import pytest
+
+from pytisean.prediction import lzo_test, local_linear_forecast, \
+    LocalConstantForecaster
+from pytisean.nativetools import embed
+
+from conftest import henon_serie, requires_tisean
+
+
+def lzo_reference(x, dim, delay, min_nmb_neigh, neigh_init_size,
+                  forecasted_steps, caus_win_size, dist_ref=1,
+                  nmb_error=None, factor=1.2):
+    """Zeroth order forecast errors, one reference point at a time."""
+    x = x.reshape(len(x), -1)
+    emb = embed(x, dim, delay)
+    shift = (dim - 1)*delay
+    nmb_vec = len(x) - shift - forecasted_steps
+    steps = np.arange(1, forecasted_steps + 1)
+    refs = np.arange(0, nmb_vec, dist_ref)[:nmb_error]
+    sq_err = np.zeros((forecasted_steps, x.shape[1]))
+    for ref in refs:
+        cand = np.arange(nmb_vec)
+        cand = cand[np.abs(cand - ref) >= caus_win_size]
+        dist = np.max(np.abs(emb[cand] - emb[ref]), axis=1)
+        eps = neigh_init_size
+        while np.sum(dist < eps) < min_nmb_neigh:
+            eps *= factor
+        neigh = cand[dist < eps]
+        pred = np.mean(x[neigh[:, None] + shift + steps], axis=0)
+        sq_err += (pred - x[ref + shift + steps])**2
+    rel_err = np.sqrt(sq_err/len(refs))/np.std(x, axis=0)
+    return np.column_stack((steps, rel_err))
+
+
+@pytest.mark.parametrize("dim, delay, steps, caus_win_size, dist_ref",
+                         [(2, 1, 1, None, 1),
+                          (3, 2, 4, None, 3),
+                          (2, 1, 3, 10, 1)])
+def test_lzo_test_native(dim, delay, steps, caus_win_size, dist_ref):
+    x = henon_serie(800)
+    res = lzo_test(x, dim=dim, delay=delay, min_nmb_neigh=10,
+                   neigh_init_size=0.01, forecasted_steps=steps,
+                   caus_win_size=caus_win_size, dist_ref=dist_ref,
+                   native=True)
+    ref = lzo_reference(x, dim, delay, 10, 0.01, steps,
+                        steps if caus_win_size is None else caus_win_size,
+                        dist_ref=dist_ref)
+    np.testing.assert_allclose(res, ref)
+
+
+def test_lzo_test_native_components():
+    x = np.column_stack((henon_serie(800), henon_serie(800, a=1.3)))
+    res = lzo_test(x, dim=2, nmb_comp=2, min_nmb_neigh=10,
+                   neigh_init_size=0.01, forecasted_steps=2, native=True)
+    ref = lzo_reference(x, 2, 1, 10, 0.01, 2, 2)
+    assert res.shape == (2, 3)
+    np.testing.assert_allclose(res, ref)
+
+
+def test_lzo_test_native_nmb_error():
+    x = henon_serie(800)
+    res = lzo_test(x, nmb_error=1, min_nmb_neigh=5, neigh_init_size=0.01,
+                   native=True)
+    ref = lzo_reference(x, 2, 1, 5, 0.01, 1, 1, nmb_error=1)
+    np.testing.assert_allclose(res, ref)
+    with pytest.raises(ValueError):
+        lzo_test(x[:3], dim=3, forecasted_steps=2, native=True)
+
+
+@requires_tisean('lzo-test')
+def test_lzo_test_tisean():
+    x = henon_serie(800)
+    res = np.asarray(lzo_test(x, dim=2, min_nmb_neigh=10,
+                              forecasted_steps=3))
+    nat = lzo_test(x, dim=2, min_nmb_neigh=10, forecasted_steps=3,
+                   native=True)
+    np.testing.assert_allclose(nat, res, rtol=0.05)
+
+
+def predict_reference(x, dim, delay, radius, state, k_steps, min_nmb=1,
+                      factor=1.2):
+    """Average future of the neighbors of a state."""
+    shift = (dim - 1)*delay
+    emb = embed(x, dim, delay)[:len(x) - shift - k_steps]
+    dist = np.max(np.abs(emb - state), axis=1)
+    while np.sum(dist < radius) < min_nmb:
+        radius *= factor
+    neigh = np.flatnonzero(dist < radius)
+    return np.mean(x[neigh[:, None] + shift + np.arange(1, k_steps + 1)],
+                   axis=0)
+
+
+def test_forecaster_predict():
+    x = henon_serie(2000)
+    model = LocalConstantForecaster(1, 2, radius=0.01, min_nmb_neigh=5)
+    model.fit(x)
+    state = embed(x, 2)[-1]
+    np.testing.assert_allclose(model.predict(3),
+                               predict_reference(x, 2, 1, 0.01, state, 3,
+                                                 min_nmb=5))
+    state = np.array([0.5, 0.2])
+    np.testing.assert_allclose(model.predict(1, state=state),
+                               predict_reference(x, 2, 1, 0.01, state, 1,
+                                                 min_nmb=5))
+    # (close to the true next value)
+    assert abs(model.predict(1)[0] - henon_serie(2001)[-1]) < 0.05
+
+
+@pytest.mark.parametrize("nmb_add", [1, 13, 600])
+def test_forecaster_append(nmb_add):
+    x = henon_serie(3000)
+    model = LocalConstantForecaster(2, 3, rel_radius=0.02)
+    model.fit(x[:1000])
+    radius = model._radius
+    for start in range(1000, 3000, nmb_add):
+        model.append(x[start:start + nmb_add])
+    assert np.array_equal(model.serie, x)
+    # same as a forecaster fitted on the whole serie
+    ref = LocalConstantForecaster(2, 3, radius=radius).fit(x)
+    for state in embed(x, 3, 2)[::300]:
+        np.testing.assert_allclose(model.predict(2, state=state),
+                                   ref.predict(2, state=state))
+
+
+def test_forecaster_save_load(tmp_path):
+    x = henon_serie(1000)
+    model = LocalConstantForecaster(1, 2, rel_radius=0.02,
+                                    min_nmb_neigh=3).fit(x)
+    model.append(x[:10])
+    path = str(tmp_path / "model.npz")
+    model.save(path)
+    loaded = LocalConstantForecaster.load(path)
+    assert (loaded.delay, loaded.dim) == (1, 2)
+    assert (loaded.radius, loaded.rel_radius) == (None, 0.02)
+    assert np.array_equal(loaded.serie, model.serie)
+    np.testing.assert_allclose(loaded.predict(4), model.predict(4))
+    loaded.append(x[10:20])
+    model.append(x[10:20])
+    np.testing.assert_allclose(loaded.predict(4), model.predict(4))
+
+
+def test_forecaster_refit(tmp_path):
+    x = henon_serie(2000)
+    model = LocalConstantForecaster(1, 2, rel_radius=0.01, min_nmb_neigh=5)
+    model.fit(x)
+    assert model.radius is None
+    # (the radius is rescaled with the new data)
+    model.fit(10*x)
+    assert model.rel_radius == 0.01
+    assert model._radius == pytest.approx(0.1*np.std(x))
+    state = 10*embed(x, 2)[-1]
+    np.testing.assert_allclose(model.predict(2),
+                               predict_reference(10*x, 2, 1,
+                                                 0.1*np.std(x), state, 2,
+                                                 min_nmb=5))
+    # (also after loading)
+    path = str(tmp_path / "model.npz")
+    model.save(path)
+    loaded = LocalConstantForecaster.load(path).fit(x)
+    assert loaded._radius == pytest.approx(0.01*np.std(x))
+    # absolute radii are kept
+    model = LocalConstantForecaster(1, 2, radius=0.01).fit(x).fit(10*x)
+    assert model._radius == 0.01
+
+
+def test_forecaster_errors():
+    with pytest.raises(ValueError):
+        LocalConstantForecaster(1, 2)
+    model = LocalConstantForecaster(1, 2, radius=0.1)
+    with pytest.raises(Exception):
+        model.predict()
+    model.fit(henon_serie(5))
+    with pytest.raises(ValueError):
+        model.predict(4)
+
+
+def local_linear_reference(x, dim, delay, nmb_neigh, regul, time, steps,
+                           caus_win_size=0):
+    """Iterated local linear forecast from one time."""
+    emb = embed(x, dim, delay)
+    shift = (dim - 1)*delay
+    lamb = regul*nmb_neigh*np.var(x)
+    cand = np.arange(len(emb) - 1)
+    cand = cand[np.abs(cand - (time - shift)) >= caus_win_size]
+    hist = x[time - shift:time + 1].astype(float)
+    forecasts = []
+    for _ in range(steps):
+        state = hist[::delay]
+        dist = np.max(np.abs(emb[cand] - state), axis=1)
+        neigh = cand[np.argsort(dist, kind='stable')[:nmb_neigh]]
+        design = np.column_stack((np.ones(nmb_neigh), emb[neigh] - state))
+        lhs = design.T.dot(design) + lamb*np.diag([0.] + [1.]*dim)
+        coefs = np.linalg.solve(lhs, design.T.dot(x[neigh + shift + 1]))
+        forecasts.append(coefs[0])
+        hist = np.append(hist[1:], coefs[0])
+    return np.array(forecasts)
+
+
+@pytest.mark.parametrize("dim, delay", [(2, 1), (3, 2)])
+def test_local_linear_forecast(dim, delay):
+    x = henon_serie(500)
+    queries = [(dim - 1)*delay, 100, 321, 499]
+    forecasts, errors = local_linear_forecast(
+        x, dim=dim, delay=delay, nmb_neigh=15, forecasted_steps=3,
+        queries=queries, nmb_error=40, dist_ref=5)
+    for query, forecast in zip(queries, forecasts):
+        np.testing.assert_allclose(
+            forecast, local_linear_reference(x, dim, delay, 15, 1e-3,
+                                             query, 3))
+    # in-sample errors, with the causality window
+    shift = (dim - 1)*delay
+    refs = np.arange(shift, len(x) - 3, 5)[:40]
+    preds = np.array([local_linear_reference(x, dim, delay, 15, 1e-3,
+                                             ref, 3, caus_win_size=3)
+                      for ref in refs])
+    ref_err = np.sqrt(np.mean((preds - x[refs[:, None] + [1, 2, 3]])**2,
+                              axis=0))/np.std(x)
+    np.testing.assert_allclose(errors, np.column_stack(([1, 2, 3],
+                                                        ref_err)))
+
+
+def test_local_linear_forecast_linear_system():
+    # (a nearly linear system is well forecasted)
+    x = np.empty(300)
+    x[:2] = [1., 0.]
+    for i in range(2, len(x)):
+        x[i] = 1.6*x[i - 1] - 0.9*x[i - 2] + np.sin(0.1*i)*1e-3
+    forecasts, errors = local_linear_forecast(x[:-5], dim=2, nmb_neigh=20,
+                                              forecasted_steps=5,
+                                              regul=0)
+    np.testing.assert_allclose(forecasts[0], x[-5:], atol=1e-2)
+    assert np.all(errors[:, 1] < 0.05)
+
+
+def test_local_linear_forecast_errors():
+    x = henon_serie(100)
+    with pytest.raises(ValueError):
+        local_linear_forecast(x, dim=3, queries=[1])
+    with pytest.raises(ValueError):
+        local_linear_forecast(x, queries=[100])
+    with pytest.raises(ValueError):
+        local_linear_forecast(x[:5], dim=3, forecasted_steps=3)
+
+
+def test_lzo_test_native_float32():
+    x = henon_serie(800)
+    kwargs = dict(dim=2, min_nmb_neigh=10, neigh_init_size=0.01,
+                  forecasted_steps=2, native=True)
+    np.testing.assert_allclose(lzo_test(x, dtype=np.float32, **kwargs),
+                               lzo_test(x, **kwargs), rtol=1e-4)
+
+
+def test_forecasters_float32():
+    x = henon_serie(2000)
+    res, err = local_linear_forecast(x, dim=2, forecasted_steps=3,
+                                     queries=[100, 500, 1999])
+    res32, err32 = local_linear_forecast(x, dim=2, forecasted_steps=3,
+                                         queries=[100, 500, 1999],
+                                         dtype=np.float32)
+    np.testing.assert_allclose(res32, res, atol=1e-4)
+    np.testing.assert_allclose(err32, err, atol=1e-4)
+    # (the forecaster keeps the serie type)
+    model = LocalConstantForecaster(1, 2, rel_radius=0.01,
+                                    min_nmb_neigh=5).fit(x[:1500])
+    model32 = LocalConstantForecaster(1, 2, rel_radius=0.01,
+                                      min_nmb_neigh=5)
+    model32.fit(x[:1500].astype(np.float32))
+    assert model32.serie.dtype == np.float32
+    assert model.serie.dtype == np.float64
+    model.append(x[1500:])
+    model32.append(x[1500:])
+    assert model32.serie.dtype == np.float32
+    np.testing.assert_allclose(model32.predict(2), model.predict(2),
+                               atol=1e-4)
+    model32.fit(x, dtype=np.float32)
+    assert model32.serie.dtype == np.float32
+    assert LocalConstantForecaster(1, 2, radius=1).fit(
+        np.arange(10)).serie.dtype == np.float64
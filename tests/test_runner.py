@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import json
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from pytisean.runner import main, load_spec, expand_jobs, run_job, run_jobs
+
+from conftest import henon_serie
+
+HISTOGRAM = {'function': 'utilities.histogram',
+             'params': {'bins': 10, 'native': True}}
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """Two inputs with the same name, in two directories."""
+    paths = []
+    for name, nmb_pts in [("a", 500), ("b", 600)]:
+        (tmp_path / name).mkdir()
+        path = tmp_path / name / "run1.txt"
+        np.savetxt(str(path), henon_serie(nmb_pts))
+        paths.append(str(path))
+    return paths
+
+
+def spec_for(tmp_path, analyses, **kwargs):
+    spec = {'inputs': [str(tmp_path / "*" / "*.txt")],
+            'analyses': analyses,
+            'output_dir': str(tmp_path / "results")}
+    spec.update(kwargs)
+    return spec
+
+
+def test_load_spec(tmp_path):
+    spec = {'inputs': ['*.txt'], 'analyses': [HISTOGRAM], 'nmb_proc': 2}
+    path = tmp_path / "spec.json"
+    path.write_text(json.dumps(spec))
+    assert load_spec(str(path)) == spec
+    path = tmp_path / "spec.toml"
+    path.write_text('inputs = ["*.txt"]\nnmb_proc = 2\n\n'
+                    '[[analyses]]\nfunction = "utilities.histogram"\n'
+                    'params = {bins = 10, native = true}\n')
+    assert load_spec(str(path)) == spec
+
+
+def test_expand_jobs(tmp_path, inputs):
+    jobs = expand_jobs(spec_for(tmp_path, [
+        HISTOGRAM, {'function': 'mutual', 'name': 'mi'}]))
+    assert len(jobs) == 4
+    assert [job['input'] for job in jobs] == [inputs[0]]*2 + [inputs[1]]*2
+    # (same file names in different directories do not collide)
+    outputs = [job['output'] for job in jobs]
+    results = str(tmp_path / "results")
+    assert outputs == [os.path.join(results, "a", "run1.histogram"),
+                       os.path.join(results, "a", "run1.mi"),
+                       os.path.join(results, "b", "run1.histogram"),
+                       os.path.join(results, "b", "run1.mi")]
+    assert jobs[1]['params'] == {}
+
+
+def test_run_job_skip(tmp_path, inputs):
+    job = expand_jobs(spec_for(tmp_path, [HISTOGRAM]))[0]
+    assert run_job(job)['status'] == 'done'
+    res = np.loadtxt(job['output'] + '.dat')
+    assert res.shape == (10, 2)
+    assert run_job(job)['status'] == 'skipped'
+    assert run_job(job, force=True)['status'] == 'done'
+    # (only the modification time changed: same content hash)
+    os.utime(inputs[0], ns=(0, 0))
+    assert run_job(job)['status'] == 'skipped'
+    # changed parameters, input content or missing output
+    job_20 = dict(job, params={'bins': 20, 'native': True})
+    assert run_job(job_20)['status'] == 'done'
+    assert run_job(job_20)['status'] == 'skipped'
+    np.savetxt(inputs[0], henon_serie(400))
+    assert run_job(job_20)['status'] == 'done'
+    os.remove(job['output'] + '.dat')
+    assert run_job(job_20)['status'] == 'done'
+
+
+def test_run_job_several_outputs(tmp_path, inputs, fake_command):
+    # ('d2' writes '.c2', '.d2' and '.h2' files, but no '.dat' file)
+    fake_command('d2', """
+for ext in ['.c2', '.d2', '.h2']:
+    np.savetxt(out + ext, np.ones((2, 2)))
+sys.exit()""")
+    job = expand_jobs(spec_for(tmp_path, [{'function': 'd2'}]))[0]
+    assert run_job(job)['status'] == 'done'
+    with open(job['output'] + '.job.json', 'r') as f:
+        outputs = json.load(f)['output_files']
+    assert [os.path.splitext(path)[1] for path in outputs] \
+        == ['.c2', '.d2', '.h2']
+    assert run_job(job)['status'] == 'skipped'
+    os.remove(outputs[1])
+    assert run_job(job)['status'] == 'done'
+    assert run_job(job)['status'] == 'skipped'
+
+
+def test_run_job_results(tmp_path, inputs):
+    jobs = expand_jobs(spec_for(tmp_path, [
+        {'function': 'prediction.local_linear_forecast',
+         'params': {'dim': 2, 'forecasted_steps': 2}},
+        {'function': 'not_an_analysis'}]))
+    # (results of functions without 'output_file' are pickled)
+    assert run_job(jobs[0])['status'] == 'done'
+    with open(jobs[0]['output'] + '.pkl', 'rb') as f:
+        forecasts, errors = pickle.load(f)
+    assert forecasts.shape == (1, 2)
+    summary = run_job(jobs[1])
+    assert summary['status'] == 'failed'
+    assert "not_an_analysis" in summary['error']
+
+
+@pytest.mark.parametrize("nmb_proc", [1, 2])
+def test_run_jobs(tmp_path, inputs, nmb_proc):
+    jobs = expand_jobs(spec_for(tmp_path, [HISTOGRAM,
+                                           {'function': 'bad.function'}]))
+    summaries = run_jobs(jobs, nmb_proc=nmb_proc)
+    assert [summ['status'] for summ in summaries] \
+        == ['done', 'failed', 'done', 'failed']
+    summaries = run_jobs(jobs, nmb_proc=nmb_proc)
+    assert [summ['status'] for summ in summaries] \
+        == ['skipped', 'failed', 'skipped', 'failed']
+
+
+def test_main(tmp_path, inputs, capsys):
+    path = tmp_path / "spec.json"
+    cost_model = str(tmp_path / "cost.json")
+    path.write_text(json.dumps(spec_for(tmp_path, [HISTOGRAM],
+                                        cost_model=cost_model)))
+    assert main([str(path)]) == 0
+    assert "2 jobs: 2 done, 0 skipped, 0 failed" in capsys.readouterr().out
+    with open(str(tmp_path / "results" / "summary.json")) as f:
+        summary = json.load(f)
+    assert summary['counts'] == {'done': 2, 'skipped': 0, 'failed': 0}
+    assert os.path.isfile(cost_model)
+    assert main([str(path)]) == 0
+    assert "0 done, 2 skipped" in capsys.readouterr().out
+    assert main([str(path), '-f', '-j', '2']) == 0
+    assert "2 done, 0 skipped" in capsys.readouterr().out
+    # failures give an error code
+    path.write_text(json.dumps(spec_for(tmp_path, [{'function': 'bad'}])))
+    assert main([str(path)]) == 1
+    assert "failed" in capsys.readouterr().out
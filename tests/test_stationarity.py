@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import numpy as np
+import pytest
+
+from pytisean.stationarity import recurr, recurr_to_csr, recurr_runs, rqa, \
+    rqa_windowed, stp
+from pytisean.nativetools import embed
+
+from conftest import henon_serie, requires_tisean
+
+
+def recurr_reference(x, dim, delay, neigh_size):
+    """Brute-force recurrent pairs (i, j), j < i, of the delay vectors."""
+    emb = embed(x, dim, delay)
+    dist = np.max(np.abs(emb[:, None] - emb[None, :]), axis=2)
+    rows, cols = np.nonzero(np.tril(dist < neigh_size, -1))
+    shift = (dim - 1)*delay
+    return np.column_stack((rows, cols)) + shift
+
+
+@pytest.mark.parametrize("dim, delay, tile_size", [(1, 1, 4096),
+                                                   (2, 1, 100),
+                                                   (3, 2, 77)])
+def test_recurr_native(dim, delay, tile_size):
+    x = henon_serie(600)
+    res = recurr(x, dim=dim, delay=delay, neigh_size=0.05, ignored_row=0,
+                 native=True, tile_size=tile_size)
+    assert res.dtype == np.int32
+    ref = recurr_reference(x, dim, delay, 0.05)
+    res = res[np.lexsort((res[:, 1], res[:, 0]))]
+    ref = ref[np.lexsort((ref[:, 1], ref[:, 0]))]
+    assert np.array_equal(res, ref)
+
+
+def test_recurr_native_ignored_row():
+    # (as TISEAN '-x', the first rows are ignored, and indexes shifted)
+    x = henon_serie(600)
+    res = recurr(x, dim=2, neigh_size=0.05, native=True)
+    ref = recurr_reference(x[1:], 2, 1, 0.05)
+    assert set(map(tuple, res)) == set(map(tuple, ref))
+
+
+def test_recurr_native_perc_pts():
+    x = henon_serie(600)
+    full = recurr(x, dim=2, neigh_size=0.05, native=True)
+    part = recurr(x, dim=2, neigh_size=0.05, perc_pts=30, native=True)
+    assert 0.2*len(full) < len(part) < 0.4*len(full)
+    # saved pairs are a subset of the full plot
+    full = set(map(tuple, full))
+    assert all(tuple(pair) in full for pair in part)
+
+
+def test_recurr_native_output_file(tmp_path):
+    x = henon_serie(600)
+    res = recurr(x, dim=2, neigh_size=0.05, native=True, tile_size=64)
+    path = tmp_path / "recurr.dat"
+    assert recurr(x, dim=2, neigh_size=0.05, native=True, tile_size=64,
+                  output_file=str(path)) is None
+    assert np.array_equal(np.loadtxt(path, dtype=int), res)
+
+
+@requires_tisean('recurr')
+def test_recurr_tisean():
+    x = henon_serie(600)
+    res = np.asarray(recurr(x, dim=2, neigh_size=0.05), dtype=int)
+    nat = recurr(x, dim=2, neigh_size=0.05, native=True)
+    assert set(map(tuple, res)) == set(map(tuple, nat))
+
+
+def test_recurr_to_csr():
+    xys = np.array([[3, 1], [1, 0], [3, 0], [4, 2]])
+    indptr, indices = recurr_to_csr(xys)
+    assert np.array_equal(indptr, [0, 0, 1, 1, 3, 4])
+    assert np.array_equal(indices, [0, 0, 1, 2])
+    indptr, _ = recurr_to_csr(xys, nmb_pts=7)
+    assert len(indptr) == 8
+
+
+def runs_lengths(line):
+    """Lengths of the runs of 'True' in a boolean array."""
+    edges = np.diff(np.concatenate(([0], line.astype(int), [0])))
+    return np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+
+
+def rqa_reference(xys, nmb_pts, min_diag=2, min_vert=2):
+    """Brute-force RQA on the dense recurrence matrix."""
+    mat = np.zeros((nmb_pts, nmb_pts), dtype=bool)
+    mat[xys[:, 0], xys[:, 1]] = True
+    mat |= mat.T
+    diag_len = np.concatenate([runs_lengths(np.diagonal(mat, -k))
+                               for k in range(1, nmb_pts)])
+    vert_len = np.concatenate([runs_lengths(col) for col in mat.T])
+    long_diag = diag_len[diag_len >= min_diag]
+    long_vert = vert_len[vert_len >= min_vert]
+    _, counts = np.unique(long_diag, return_counts=True)
+    probas = counts/float(len(long_diag))
+    return {"recurrence_rate": len(xys)/(nmb_pts*(nmb_pts - 1)/2.),
+            "determinism": np.sum(long_diag)/float(len(xys)),
+            "mean_diagonal": np.mean(long_diag),
+            "max_diagonal": np.max(diag_len),
+            "entropy": -np.sum(probas*np.log(probas)),
+            "laminarity": np.sum(long_vert)/float(np.sum(vert_len)),
+            "trapping_time": np.mean(long_vert),
+            "max_vertical": np.max(vert_len)}
+
+
+@pytest.fixture
+def recurrences():
+    x = henon_serie(400)
+    return recurr(x, dim=2, neigh_size=0.1, ignored_row=0, native=True)
+
+
+def test_recurr_runs(recurrences):
+    diag, vert = recurr_runs(recurrences)
+    # each recurrence is in one diagonal line, and in two vertical ones
+    assert np.sum(diag[:, 2]) == len(recurrences)
+    assert np.sum(vert[:, 2]) == 2*len(recurrences)
+    for k, first, length in diag[:20]:
+        for j in range(first, first + length):
+            assert [j + k, j] in recurrences.tolist()
+
+
+@pytest.mark.parametrize("min_diag, min_vert", [(2, 2), (3, 4)])
+def test_rqa(recurrences, min_diag, min_vert):
+    nmb_pts = 400
+    res = rqa(recurrences, nmb_pts=nmb_pts, min_diag=min_diag,
+              min_vert=min_vert)
+    ref = rqa_reference(recurrences, nmb_pts, min_diag, min_vert)
+    for key, val in ref.items():
+        assert res[key] == pytest.approx(val), key
+    # from the runs directly
+    res_runs = rqa(recurr_runs(recurrences), nmb_pts=nmb_pts,
+                   min_diag=min_diag, min_vert=min_vert)
+    assert res_runs["determinism"] == res["determinism"]
+    assert np.array_equal(res_runs["diagonal_hist"], res["diagonal_hist"])
+
+
+def test_rqa_no_recurrences():
+    with pytest.raises(ValueError):
+        rqa(np.empty((0, 2), dtype=int))
+
+
+@pytest.mark.parametrize("window, step", [(50, 10), (120, 37)])
+def test_rqa_windowed(recurrences, window, step):
+    starts, res = rqa_windowed(recurrences, window, step, start=0,
+                               stop=400)
+    assert np.array_equal(starts, np.arange(0, 400 - window + 1, step))
+    for i, start in enumerate(starts):
+        # recurrences inside the window
+        inside = np.all((recurrences >= start)
+                        & (recurrences < start + window), axis=1)
+        ref = rqa(recurrences[inside] - start, nmb_pts=window)
+        for key, val in res.items():
+            np.testing.assert_allclose(val[i], ref[key], err_msg=key)
+
+
+def stp_reference(x, dim, delay, times, levels):
+    """Quantiles of the distances of the pairs separated by each time."""
+    emb = embed(x, dim, delay)
+    res = []
+    for level in levels:
+        for time in times:
+            dist = np.max(np.abs(emb[time:] - emb[:-time]), axis=1)
+            res.append([time, np.quantile(dist, level)])
+    return np.array(res)
+
+
+@pytest.mark.parametrize("dim, delay, time_resolution", [(1, 1, 1),
+                                                         (3, 2, 4)])
+def test_stp_native(dim, delay, time_resolution):
+    x = henon_serie(3000)
+    res = stp(x, dim=dim, delay=delay, time_resolution=time_resolution,
+              time_steps=20, levels_frac=0.1, ignored_row=0, native=True)
+    times = time_resolution*np.arange(1, 21)
+    ref = stp_reference(x, dim, delay, times, 0.1*np.arange(1, 10))
+    assert res.shape == ref.shape
+    assert np.array_equal(res[:, 0], ref[:, 0])
+    # (up to the logarithmic bins resolution)
+    np.testing.assert_allclose(res[:, 1], ref[:, 1], rtol=0.03)
+
+
+def test_stp_native_threads_and_references():
+    x = henon_serie(3000)
+    kwargs = dict(dim=2, time_steps=10, levels_frac=0.25, native=True)
+    res = stp(x, **kwargs)
+    assert np.array_equal(stp(x, nmb_proc=3, **kwargs), res)
+    part = stp(x, nmb_ref_points=1500, **kwargs)
+    np.testing.assert_allclose(part[:, 1], res[:, 1], rtol=0.2)
+
+
+def test_stp_native_too_short():
+    with pytest.raises(ValueError):
+        stp(henon_serie(50), time_steps=100, native=True)
+
+
+def test_native_float32():
+    x = henon_serie(600)
+    res = recurr(x, dim=2, neigh_size=0.05, ignored_row=0, native=True)
+    res32 = recurr(x, dim=2, neigh_size=0.05, ignored_row=0, native=True,
+                   dtype=np.float32)
+    # (only pairs at the neighborhood size can differ)
+    res, res32 = set(map(tuple, res)), set(map(tuple, res32))
+    assert len(res ^ res32) <= 0.001*len(res)
+    x = henon_serie(3000)
+    kwargs = dict(dim=2, time_steps=10, levels_frac=0.25, ignored_row=0,
+                  native=True)
+    np.testing.assert_allclose(stp(x, dtype=np.float32, **kwargs),
+                               stp(x, **kwargs), rtol=1e-3)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from pytisean.store import ResultStore, StoreTarget
+from pytisean.store.store import _json_value
+from pytisean.tiseanwrapper import tisean_pipe
+from pytisean.utilities import histogram
+
+
+def fill(store):
+    """Append results of several types and shapes, return them."""
+    results = []
+    for i in range(7):
+        res = [np.arange(i, dtype=int),
+               np.linspace(0, 1, 6, dtype=np.float32).reshape(2, 3)*i,
+               np.arange(4) % (i + 1) == 0][i % 3]
+        target = store.target('analysis', np.ones(3)*(i % 2),
+                              dim=i, eps=0.1*i, name="run{}".format(i % 2))
+        target.write(res)
+        results.append(res)
+    return results
+
+
+@pytest.mark.parametrize('shard_size', [1, 3, 100])
+@pytest.mark.parametrize('compress', [False, True])
+def test_store_round_trip(tmp_path, shard_size, compress):
+    with ResultStore(str(tmp_path), shard_size=shard_size,
+                     compress=compress) as store:
+        results = fill(store)
+    store = ResultStore(str(tmp_path))
+    assert store.analyses() == ['analysis']
+    stored = store.select('analysis')
+    assert len(stored) == len(results)
+    for i, ((params, res), expected) in enumerate(zip(stored, results)):
+        assert params['dim'] == i
+        assert params['name'] == "run{}".format(i % 2)
+        assert res.dtype == expected.dtype
+        assert res.shape == expected.shape
+        assert np.array_equal(res, expected)
+        if not compress and res.size > 0:
+            assert isinstance(res, np.memmap)
+    assert not any(isinstance(res, np.memmap)
+                   for _, res in store.select('analysis', mmap=False))
+    index = store.index('analysis')
+    assert index['dim'] == list(range(7))
+    assert index['dtype'] == [res.dtype for res in results]
+    assert index['shape'] == [res.shape for res in results]
+    assert len(set(index['input'])) == 2
+
+
+def test_store_select(tmp_path):
+    with ResultStore(str(tmp_path), shard_size=2) as store:
+        results = fill(store)
+        # (buffered results are not selected before being written)
+        store.target('other').write(1.)
+        assert store.select('other') == []
+    assert [res for _, res in store.select('other')] == [1.]
+    assert [par['dim'] for par, _ in store.select('analysis', dim=3)] == [3]
+    assert [par['dim'] for par, _ in
+            store.select('analysis', dim=[1, 4, 5])] == [1, 4, 5]
+    # (floats are compared with a tolerance, and numpy values accepted)
+    assert [par['dim'] for par, _ in
+            store.select('analysis', eps=np.float32(0.3))] == [3]
+    assert [par['dim'] for par, _ in
+            store.select('analysis', name="run1", dim=[1, 2, 3])] == [1, 3]
+    assert [par['dim'] for par, _ in
+            store.select('analysis', input_data=np.zeros(3))] == [0, 2, 4, 6]
+    assert store.select('analysis', unknown=1) == []
+    assert store.select('missing') == []
+    res = store.select('analysis', input_data=np.ones(3), dim=5)[0][1]
+    assert np.array_equal(res, results[5])
+
+
+def test_store_run(tmp_path, henon):
+    with ResultStore(str(tmp_path)) as store:
+        res = store.run(histogram, henon, bins=20, native=True,
+                        chunk_size=100)
+    (params, stored), = store.select('histogram', input_data=henon)
+    assert params == {'bins': 20, 'input': params['input']}
+    assert np.array_equal(stored, res)
+    # results written by the wrappers themselves
+    with ResultStore(str(tmp_path)) as store:
+        target = store.target('hist', henon, bins=10)
+        assert isinstance(target, StoreTarget)
+        res = histogram(henon, bins=10, native=True, output_file=target)
+    (params, stored), = store.select('hist', bins=10)
+    assert np.array_equal(stored, res.reshape(-1, 2))
+
+
+def test_store_target_parts(tmp_path):
+    with ResultStore(str(tmp_path)) as store:
+        store.target('parts', dim=2).write((np.ones(3), np.zeros((2, 2))))
+    stored = store.select('parts')
+    assert [params['part'] for params, _ in stored] == [0, 1]
+    assert np.array_equal(stored[1][1], np.zeros((2, 2)))
+
+
+def test_store_tisean_pipe(tmp_path, fake_command):
+    fake_command('fakedouble', "y = 2*x")
+    x = np.arange(10.)
+    with ResultStore(str(tmp_path / "store")) as store:
+        target = store.target('double', x, factor=2)
+        res, _ = tisean_pipe([('fakedouble', []), ('fakedouble', [])], x,
+                             output_file=target)
+    (params, stored), = store.select('double', input_data=x)
+    assert params['factor'] == 2
+    assert np.array_equal(stored, 4*x)
+    assert np.array_equal(res, stored)
+
+
+def test_store_errors(tmp_path):
+    store = ResultStore(str(tmp_path))
+    with pytest.raises(TypeError):
+        store.target('bad').write(np.array([{}, None], dtype=object))
+    with pytest.raises(TypeError):
+        store.target('bad').write(np.zeros(2, dtype=[('a', int)]))
+    with pytest.raises(TypeError):
+        store.target('bad', func=len)
+    assert _json_value({1: (np.int64(2), np.arange(2.))}) \
+        == {'1': [2, [0., 1.]]}
+
+
+def test_store_pickle(tmp_path):
+    store = ResultStore(str(tmp_path), shard_size=5, compress=True)
+    store.target('buffered').write(1)
+    copy = pickle.loads(pickle.dumps(store))
+    assert (copy.path, copy.shard_size, copy.compress) \
+        == (store.path, 5, True)
+    # (without the buffered results)
+    copy.flush()
+    assert copy.analyses() == []
+    store.flush()
+    assert copy.select('buffered')[0][1] == 1
+    assert sorted(os.path.splitext(name)[1] for name in
+                  os.listdir(str(tmp_path / "buffered"))) == ['.json', '.npz']
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import numpy as np
+import pytest
+
+from pytisean.surrogates import surrogate_test, endtoend_segment
+from pytisean.surrogates.surrogates import _rank_pvalue_bounds, _fft_lengths
+
+# Fake 'surrogates': random permutation of the data (seed from '-I')
+SHUFFLE = """
+opts = dict((opt[:2], opt[2:]) for opt in opts)
+if x.ndim > 1:
+    x = x[:, int(opts['-c']) - 1]
+if '-l' in opts:
+    x = x[:int(opts['-l'])]
+y = np.random.RandomState(int(opts['-I'])).permutation(x)
+"""
+
+
+def autocorrelation(x):
+    x = np.asarray(x) - np.mean(x)
+    return np.sum(x[1:]*x[:-1])/np.sum(x**2)
+
+
+def test_rank_pvalue_bounds():
+    stat_surr = [1., 2., 3., 4.]
+    # 0 smaller, 4 larger, 5 surrogates to come
+    assert _rank_pvalue_bounds(0., stat_surr, 9, "smaller") \
+        == pytest.approx((0.1, 0.6))
+    assert _rank_pvalue_bounds(0., stat_surr, 9, "larger") \
+        == pytest.approx((0.5, 1.))
+    assert _rank_pvalue_bounds(0., stat_surr, 9, "two-sided") \
+        == pytest.approx((0.2, 1.))
+    # all known
+    assert _rank_pvalue_bounds(2.5, stat_surr, 4, "smaller") \
+        == pytest.approx((0.6, 0.6))
+
+
+def test_surrogate_test_rejects(fake_command, henon):
+    fake_command('surrogates', SHUFFLE)
+    pvalue, stat_data, stat_surr = surrogate_test(
+        henon, autocorrelation, nmb_surr_max=19, alternative="smaller")
+    assert stat_data == pytest.approx(autocorrelation(henon))
+    assert len(stat_surr) == 19
+    assert pvalue == pytest.approx(0.05)
+
+
+def test_surrogate_test_stops_early(fake_command):
+    fake_command('surrogates', SHUFFLE)
+    x = np.random.RandomState(0).normal(size=500)
+    pvalue, _, stat_surr = surrogate_test(x, autocorrelation,
+                                          nmb_surr_max=99, batch_size=10)
+    # the null hypothesis can not be rejected after the first batch
+    assert len(stat_surr) == 10
+    assert pvalue > 0.05
+
+
+def test_surrogate_test_file_input(fake_command, henon, tmp_path):
+    fake_command('surrogates', SHUFFLE)
+    path = str(tmp_path / "data.dat")
+    np.savetxt(path, np.column_stack((np.arange(len(henon)), henon)))
+    seen = []
+
+    def statistic(x):
+        assert isinstance(x, np.ndarray)
+        seen.append(x.shape)
+        return autocorrelation(x)
+    _, stat_data, _ = surrogate_test(path, statistic, nmb_surr_max=4,
+                                     col_to_read=2, nmb_data_to_use=1000)
+    assert stat_data == pytest.approx(autocorrelation(henon[:1000]))
+    # data and surrogates read the same way
+    assert seen == [(1000,)]*5
+
+
+def test_surrogate_test_alternative():
+    with pytest.raises(ValueError):
+        surrogate_test(np.zeros(10), np.mean, alternative="bigger")
+
+
+def endtoend_reference(x, length):
+    """Mismatch of every sub-sequence of a given length (brute force)."""
+    x = x.reshape(len(x), -1)
+    res = []
+    for off in range(len(x) - length + 1):
+        seg = x[off:off + length]
+        var = np.var(seg, axis=0)
+        jump = np.sum((seg[-1] - seg[0])**2/var)
+        slip = np.sum(((seg[-1] - seg[-2]) - (seg[1] - seg[0]))**2/var)
+        res.append((jump, slip, jump + slip))
+    return np.array(res)
+
+
+def factorint(n):
+    """Prime factors of an integer."""
+    factors = []
+    i = 2
+    while n > 1:
+        while n % i == 0:
+            factors.append(i)
+            n //= i
+        i += 1
+    return factors
+
+
+def test_fft_lengths():
+    lengths = _fft_lengths(50, 200)
+    ref = [n for n in range(200, 49, -1) if set(factorint(n)) <= {2, 3, 5}]
+    assert lengths == ref
+
+
+@pytest.mark.parametrize("nmb_col", [1, 2])
+def test_endtoend_segment(henon, nmb_col):
+    x = henon[:300]
+    if nmb_col == 2:
+        x = np.column_stack((x, henon[1:301]))
+    segment, mismatch = endtoend_segment(x, min_length=200,
+                                         nmb_col_to_read=nmb_col)
+    assert list(mismatch[:, 0]) == _fft_lengths(200, 300)
+    for length, off, jump, slip, total in mismatch:
+        ref = endtoend_reference(x, int(length))
+        best = np.argmin(ref[:, 2])
+        assert off == best
+        assert [jump, slip, total] == pytest.approx(ref[best])
+    # best sub-sequence, as a view of the data
+    best = np.argmin(mismatch[:, 4])
+    length, off = int(mismatch[best, 0]), int(mismatch[best, 1])
+    assert np.shares_memory(segment, x)
+    assert np.array_equal(segment, x[off:off + length])
+
+
+def test_endtoend_segment_too_short():
+    with pytest.raises(ValueError):
+        endtoend_segment(np.arange(10.), min_length=20)
+
+
+def test_endtoend_segment_float32(henon):
+    x = henon[:300]
+    _, mismatch = endtoend_segment(x, min_length=200)
+    _, mismatch32 = endtoend_segment(x, min_length=200, dtype=np.float32)
+    np.testing.assert_allclose(mismatch32[:, 2:], mismatch[:, 2:],
+                               rtol=1e-4, atol=1e-6)
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import os
+
+import numpy as np
+import pytest
+
+from pytisean.tiseanwrapper import tisean, tisean_pipe, input_extent, \
+    write_input, TiseanResult, text_format, write_output
+from pytisean.tiseanwrapper.tiseanwrapper import TMPDIR
+from pytisean.nativetools import SharedArray
+from pytisean.stationarity import recurr
+from pytisean.dimension import d2
+from pytisean.lineartools import corr
+from pytisean.lyapunov import lyap_k, lyap_r, lyap_spec
+from pytisean.embedding import delay
+
+
+# Fake command adding the '-a' option value to its input
+ADD = """
+opts = dict((opt[:2], opt[2:]) for opt in opts)
+y = x + float(opts['-a'])
+"""
+
+
+@pytest.fixture
+def wide(tmp_path):
+    """(1000, 4) data set, as an array and a '.npy' file."""
+    x = np.arange(4000.).reshape(1000, 4)
+    path = str(tmp_path / "wide.npy")
+    np.save(path, x)
+    return x, path
+
+
+def test_input_extent():
+    assert input_extent() == {"nmb_rows": None, "nmb_cols": None}
+    assert input_extent(100, 2, 3) == {"nmb_rows": 102, "nmb_cols": 3}
+    assert input_extent(col_to_read='1,3') == {"nmb_rows": None,
+                                               "nmb_cols": 3}
+    assert input_extent(col_to_read=2, nmb_col_to_read=2)["nmb_cols"] == 3
+
+
+def test_write_input(wide, tmp_path):
+    x, path = wide
+    out = str(tmp_path / "input.dat")
+    write_input(out, np.load(path, mmap_mode='r'), nmb_rows=10, nmb_cols=2)
+    assert np.array_equal(np.loadtxt(out), x[:10, :2])
+    write_input(out, x[:, 0])
+    assert np.array_equal(np.loadtxt(out), x[:, 0])
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_tisean_binary_input(fake_command, wide, binary):
+    x, path = wide
+    fake_command('fakecmd')
+    data = path if binary else np.load(path, mmap_mode='r')
+    # (only the needed rows and columns are written)
+    res, msg = tisean('fakecmd', [], input_data=data, nmb_rows=50,
+                      nmb_cols=3)
+    assert msg == ""
+    assert np.array_equal(res, x[:50, :3])
+    res, _ = tisean('fakecmd', [], input_data=data)
+    assert np.array_equal(res, x)
+
+
+def test_tisean_npz_input(fake_command, wide, tmp_path):
+    x, _ = wide
+    fake_command('fakecmd')
+    path = str(tmp_path / "wide.npz")
+    np.savez(path, x=x)
+    res, _ = tisean('fakecmd', [], input_data=path, nmb_rows=5)
+    assert np.array_equal(res, x[:5])
+    np.savez(path, x=x, y=x)
+    with pytest.raises(ValueError):
+        tisean('fakecmd', [], input_data=path)
+
+
+def test_wrapper_input_extent(fake_command, wide):
+    x, path = wide
+    fake_command('recurr')
+    # (ignored rows, data to use and the components read)
+    res = recurr(path, compo_nmb=2, col_to_read=2, ignored_row=3,
+                 nmb_data_to_use=20)
+    assert np.array_equal(res, x[:23, :3])
+
+
+def test_tisean_missing_command():
+    before = set(os.listdir(TMPDIR))
+    with pytest.raises(Exception):
+        tisean('not_a_tisean_command', [], input_data=np.ones(10))
+    # (no scratch file is left)
+    assert set(os.listdir(TMPDIR)) == before
+
+
+def test_tisean_pipe(fake_command, tmp_path):
+    fake_command('fakeadd', ADD)
+    fake_command('fakewarn', "sys.stderr.write('careful')\ny = 2*x")
+    x = np.arange(20.)
+    stages = [('fakeadd', ['-a1']), ('fakewarn', []), ('fakeadd', ['-a3'])]
+    res, msgs = tisean_pipe(stages, x)
+    assert np.array_equal(res, 2*(x + 1) + 3)
+    assert msgs == ["", "careful", ""]
+    # from a file, to a file
+    np.savetxt(str(tmp_path / "x.dat"), x)
+    out = str(tmp_path / "out.dat")
+    res, _ = tisean_pipe(stages, str(tmp_path / "x.dat"), output_file=out)
+    assert np.array_equal(res, 2*(x + 1) + 3)
+    assert np.array_equal(np.loadtxt(out), res)
+    # from a shared array, or only the needed rows of an array
+    with SharedArray(x) as shared:
+        res, _ = tisean_pipe(stages[:1], shared)
+        assert np.array_equal(res, x + 1)
+    res, _ = tisean_pipe(stages[:1], x, nmb_rows=5)
+    assert np.array_equal(res, x[:5] + 1)
+
+
+def test_tisean_pipe_missing_command(fake_command):
+    fake_command('fakeadd', ADD)
+    with pytest.raises(Exception):
+        tisean_pipe([('fakeadd', ['-a1']), ('not_a_tisean_command', [])],
+                    np.ones(10))
+
+
+# TISEAN-like output: comments with fields, and blank-separated blocks
+LYAP_OUTPUT = """#Created by lyap_k
+#estimated KY-Dimension= 1.25
+#dim= 2 epsilon: 1e-3
+0 -1.5 100
+1 -1.25 98
+
+#dim= 3 epsilon: 2e-3
+0 -2 90
+1 -1.75 88
+2 -1.5 86
+"""
+
+
+def test_tisean_result():
+    res = TiseanResult(LYAP_OUTPUT)
+    # (parsed once, on first access)
+    assert res._parsed is None
+    assert res.comments == ["Created by lyap_k",
+                            "estimated KY-Dimension= 1.25",
+                            "dim= 2 epsilon: 1e-3",
+                            "dim= 3 epsilon: 2e-3"]
+    parsed = res._parsed
+    assert res.data.shape == (5, 3)
+    assert res._parsed is parsed
+    assert len(res.blocks) == 2
+    assert np.all(res.blocks[0] == [[0, -1.5, 100], [1, -1.25, 98]])
+    assert res.blocks[1].shape == (3, 3)
+    assert res.headers == [{'estimated_ky_dimension': 1.25, 'dim': 2,
+                            'epsilon': 1e-3},
+                           {'dim': 3, 'epsilon': 2e-3}]
+    assert isinstance(res.headers[0]['dim'], int)
+    # (fields of all the comments, the last one kept)
+    assert res.metadata['dim'] == 3
+    assert res.estimated_ky_dimension == 1.25
+    with pytest.raises(AttributeError):
+        res.lyapunov_exponent
+    assert res.block(dim=3) is res.blocks[1]
+    assert res.block(dim=2, epsilon=0.001) is res.blocks[0]
+    with pytest.raises(KeyError):
+        res.block(dim=4)
+    # array-like access
+    assert np.all(np.asarray(res) == res.data)
+    assert np.asarray(res, dtype=np.float32).dtype == np.float32
+    assert np.all(res[:, 1] == [-1.5, -1.25, -2, -1.75, -1.5])
+    assert len(res) == 5
+    assert res.shape == (5, 3)
+
+
+def test_tisean_result_single_column():
+    res = TiseanResult("# no fields here\n1\n2\n\n\n3\n")
+    assert res.comments == ["no fields here"]
+    assert res.metadata == {}
+    assert np.all(res.data == [1, 2, 3])
+    assert [len(block) for block in res.blocks] == [2, 1]
+    assert res.headers == [{}, {}]
+    empty = TiseanResult("#only comments\n")
+    assert empty.data.shape == (0, 0)
+    assert empty.blocks == []
+
+
+def test_tisean_full_output(fake_command):
+    fake_command("fakelyap", "with open(out, 'w') as f:\n"
+                 "    f.write({!r})\nsys.exit()".format(LYAP_OUTPUT))
+    res, msg = tisean('fakelyap', [], input_data=np.arange(10.),
+                      full_output=True)
+    assert isinstance(res, TiseanResult)
+    assert res.estimated_ky_dimension == 1.25
+    assert np.all(res.block(dim=3) == TiseanResult(LYAP_OUTPUT).blocks[1])
+    res, _ = tisean('fakelyap', [], input_data=np.arange(10.))
+    assert isinstance(res, np.ndarray)
+    assert res.shape == (5, 3)
+    # several output files
+    fake_command("fakemulti", """
+for ext in ['.a', '.b']:
+    with open(out + ext, 'w') as f:
+        f.write("#ext: {}\\n".format(len(ext)) + "1 2\\n3 4\\n")
+sys.exit()""")
+    res, _ = tisean('fakemulti', [], input_data=np.arange(10.),
+                    output_file_ext=['.a', '.b'], full_output=True)
+    assert len(res) == 2
+    assert all(isinstance(part, TiseanResult) for part in res)
+    assert res[1].ext == 2
+    assert np.all(res[0].data == [[1, 2], [3, 4]])
+
+
+def test_text_format():
+    assert text_format(int) == '%d'
+    assert text_format(np.uint8) == '%d'
+    assert text_format(bool) == '%d'
+    assert text_format(np.float32) == '%.9g'
+    assert text_format(np.float16) == '%.6g'
+    assert text_format(float) == '%.18e'
+    # (values are read back unchanged)
+    x = np.random.RandomState(0).randn(100)
+    for dtype in [np.float16, np.float32, np.float64]:
+        vals = x.astype(dtype)
+        text = [text_format(dtype) % val for val in vals]
+        assert np.array_equal(np.array(text, dtype=float).astype(dtype),
+                              vals)
+
+
+def test_write_input_dtype(tmp_path):
+    x = np.random.RandomState(0).randn(50, 2)
+    path = str(tmp_path / "x.dat")
+    write_input(path, x, dtype=np.float32)
+    with open(path, 'r') as f:
+        line = f.readline().split('\t')
+    assert [val.strip() for val in line] \
+        == ['%.9g' % val for val in x[0].astype(np.float32)]
+    assert np.array_equal(np.loadtxt(path).astype(np.float32),
+                          x.astype(np.float32))
+    write_input(path, x)
+    assert np.array_equal(np.loadtxt(path), x)
+    write_input(path, np.arange(10), nmb_rows=5)
+    with open(path, 'r') as f:
+        assert f.read().split() == ['0', '1', '2', '3', '4']
+    write_output(path, np.arange(4, dtype=np.int32))
+    with open(path, 'r') as f:
+        assert f.read().split() == ['0', '1', '2', '3']
+
+
+def test_tisean_dtype(fake_command):
+    fake_command('fakecopy')
+    x = np.random.RandomState(0).randn(100)
+    res, _ = tisean('fakecopy', [], input_data=x)
+    assert np.array_equal(res, x)
+    # (written with the float32 precision)
+    res, _ = tisean('fakecopy', [], input_data=x, dtype=np.float32)
+    assert not np.array_equal(res, x)
+    assert np.array_equal(res.astype(np.float32), x.astype(np.float32))
+    with SharedArray(x) as shared:
+        res, _ = tisean('fakecopy', [], input_data=shared,
+                        dtype=np.float32)
+        assert np.array_equal(res.astype(np.float32), x.astype(np.float32))
+        res, _ = tisean('fakecopy', [], input_data=shared)
+        assert np.array_equal(res, x)
+
+
+# Fake command copying its input (on three columns) to all its outputs
+COPY_ALL = """
+y = np.column_stack((x, x, x))
+for ext in ['', '.c2', '.d2', '.h2']:
+    np.savetxt(out + ext, y)
+sys.exit()"""
+
+
+@pytest.mark.parametrize("func, command", [(d2, 'd2'), (corr, 'corr'),
+                                           (lyap_k, 'lyap_k'),
+                                           (lyap_r, 'lyap_r'),
+                                           (lyap_spec, 'lyap_spec'),
+                                           (delay, 'delay')])
+def test_wrappers_dtype(fake_command, func, command):
+    fake_command(command, COPY_ALL)
+    x = np.random.RandomState(0).randn(100)
+    for dtype, expected in [(None, x), (np.float32, x.astype(np.float32))]:
+        res = func(x, dtype=dtype)
+        if isinstance(res, (tuple, list)):
+            res = res[0]
+        res = np.asarray(res)
+        if res.ndim == 2:
+            res = res[:, 0]
+        assert np.array_equal(res.astype(expected.dtype), expected)
+    assert not np.array_equal(res, x)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import os
+
+import numpy as np
+import pytest
+
+from pytisean.utilities import histogram, rebin_histogram, import_data_file
+
+from conftest import henon_serie, requires_tisean
+
+
+def histogram_reference(x, bins, data_range=None):
+    """Normalized histogram, as [bin center, value] rows."""
+    counts, edges = np.histogram(x, bins, range=data_range)
+    return np.column_stack(((edges[1:] + edges[:-1])/2., counts/len(x)))
+
+
+@pytest.mark.parametrize("chunk_size", [100, 999, 2**20])
+def test_histogram_native(chunk_size):
+    x = np.random.RandomState(0).normal(size=5000)
+    res = histogram(x, bins=37, native=True, chunk_size=chunk_size)
+    np.testing.assert_allclose(res, histogram_reference(x, 37))
+    # with a given range (points outside are not counted)
+    res = histogram(x, bins=20, data_range=(-1, 2), native=True,
+                    chunk_size=chunk_size)
+    np.testing.assert_allclose(res, histogram_reference(x, 20, (-1, 2)))
+
+
+def test_histogram_native_columns():
+    rand = np.random.RandomState(1)
+    x = np.column_stack((rand.normal(size=3000), rand.uniform(size=3000),
+                         rand.normal(size=3000)))
+    res = histogram(x, bins=10, col_to_read=[1, 3], native=True,
+                    chunk_size=500)
+    assert res.shape == (2, 10, 2)
+    np.testing.assert_allclose(res[0], histogram_reference(x[:, 0], 10))
+    np.testing.assert_allclose(res[1], histogram_reference(x[:, 2], 10))
+    assert np.array_equal(histogram(x, bins=10, col_to_read='1,3',
+                                    native=True), res)
+
+
+def test_histogram_native_iterator_and_files(tmp_path):
+    x = henon_serie(4000)
+    ref = histogram(x, bins=25, native=True)
+    res = histogram(iter(np.array_split(x, 9)), bins=25,
+                    data_range=(np.min(x), np.max(x)), native=True)
+    np.testing.assert_allclose(res, ref)
+    with pytest.raises(ValueError):
+        histogram(iter([x]), bins=25, native=True)
+    # text and binary files
+    np.savetxt(str(tmp_path / "x.dat"), x)
+    np.save(str(tmp_path / "x.npy"), x)
+    for name in ["x.dat", "x.npy"]:
+        np.testing.assert_allclose(
+            histogram(str(tmp_path / name), bins=25, native=True), ref)
+    # output file
+    path = tmp_path / "hist.dat"
+    histogram(x, bins=25, native=True, output_file=str(path))
+    np.testing.assert_allclose(np.loadtxt(path), ref)
+
+
+def test_histogram_native_constant():
+    res = histogram(np.ones(10), bins=4, native=True)
+    assert np.sum(res[:, 1]) == 1.
+
+
+@pytest.mark.parametrize("bins", [5, 10, 30])
+def test_rebin_histogram(bins):
+    x = np.random.RandomState(2).normal(size=5000)
+    fine = histogram(x, bins=60, native=True)
+    coarse = rebin_histogram(fine, bins)
+    # (exact when 'bins' divides the number of fine bins)
+    np.testing.assert_allclose(coarse, histogram_reference(x, bins),
+                               atol=1e-12)
+    assert np.sum(rebin_histogram(fine, 7)[:, 1]) == pytest.approx(1.)
+    two = np.array([fine, fine])
+    assert rebin_histogram(two, bins).shape == (2, bins, 2)
+
+
+@requires_tisean('histogram')
+def test_histogram_tisean():
+    x = henon_serie(4000)
+    res = np.asarray(histogram(x, bins=25))
+    np.testing.assert_allclose(histogram(x, bins=25, native=True), res,
+                               rtol=1e-4, atol=1e-6)
+
+
+DATA_FILE = """# heading line 1
+# heading line 2
+1 10 100
+2 20 200
+# a comment
+
+3 30 300
+4 40 400
+5 50 500
+"""
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "data.dat"
+    path.write_text(DATA_FILE)
+    return str(path)
+
+
+@pytest.mark.parametrize("cache", [True, False])
+def test_import_data_file(data_file, cache):
+    full = np.loadtxt(data_file)
+    for _ in range(2):
+        heading, data = import_data_file(data_file, cache=cache)
+        assert heading == "# heading line 1\n# heading line 2\n"
+        assert np.array_equal(data, full)
+    assert os.path.isfile(data_file + ".pytisean.npy") == cache
+    _, data = import_data_file(data_file, col_to_read=2, cache=cache)
+    assert np.array_equal(data, full[:, 1])
+    for cols in [[1, 3], '1,3', [3, 1], [1, 2]]:
+        _, data = import_data_file(data_file, col_to_read=cols, cache=cache)
+        ref = full[:, np.array(cols.split(',') if isinstance(cols, str)
+                               else cols, dtype=int) - 1]
+        assert np.array_equal(data, ref)
+    # ignored rows are file lines (comments and empty lines included)
+    _, data = import_data_file(data_file, ignored_row=4, cache=cache)
+    assert np.array_equal(data, full[2:])
+    _, data = import_data_file(data_file, ignored_row=7, cache=cache)
+    assert np.array_equal(data, full[3:])
+
+
+def test_import_data_file_cache(data_file):
+    _, data = import_data_file(data_file)
+    # (read-only, and memory-mapped from the cache on the first load)
+    assert not data.flags.writeable
+    assert isinstance(data.base, np.memmap) or isinstance(data, np.memmap)
+    with pytest.raises(ValueError):
+        data[0, 0] = 0
+    _, data = import_data_file(data_file, col_to_read=[3, 1])
+    assert not data.flags.writeable
+    # the cache is not used once the file changed
+    with open(data_file, 'a') as f:
+        f.write("6 60 600 \n")
+    _, data = import_data_file(data_file)
+    assert np.array_equal(data[-1], [6, 60, 600])
+
+
+def test_import_data_file_missing(tmp_path):
+    with pytest.raises(ValueError):
+        import_data_file(str(tmp_path / "missing.dat"))
+
+
+def test_histogram_float32():
+    x = henon_serie(5000)
+    res = histogram(x, bins=20, native=True)
+    res32 = histogram(x, bins=20, native=True, dtype=np.float32)
+    # (bin positions are computed in float64)
+    np.testing.assert_allclose(res32[:, 0], res[:, 0], rtol=1e-6)
+    assert np.abs(res32[:, 1] - res[:, 1]).sum() <= 2./len(x)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#!/usr/env python3
+
+import numpy as np
+import pytest
+
+from pytisean.windows import sliding_windows
+
+from conftest import henon_serie
+
+# (windows overlapping, contiguous, and apart)
+WINDOWS = [(200, 37), (150, 150), (100, 230)]
+
+
+def mutual_reference(x, max_delay, box_nmb, data_range):
+    """Mutual information of a serie, from its joint histograms."""
+    low, high = data_range
+    res = []
+    for tau in range(max_delay + 1):
+        joint, _, _ = np.histogram2d(x[:len(x) - tau], x[tau:], box_nmb,
+                                     range=[data_range, data_range])
+        joint /= joint.sum()
+        prod = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+        nz = joint > 0
+        res.append([tau, np.sum(joint[nz]*np.log(joint[nz]/prod[nz]))])
+    return np.array(res)
+
+
+def c2_reference(x, delay, max_dim, theiler_wind, eps):
+    """Fraction of the pairs of delay vectors closer than each epsilon."""
+    nmb_vec = len(x) - (max_dim - 1)*delay
+    i, j = np.triu_indices(nmb_vec, theiler_wind + 1)
+    dist = np.zeros(len(i))
+    res = []
+    for k in range(max_dim):
+        dist = np.maximum(dist, np.abs(x[i + k*delay] - x[j + k*delay]))
+        res.append(np.mean(dist[:, None] < eps, axis=0))
+    return np.array(res)
+
+
+@pytest.mark.parametrize("window, step", WINDOWS)
+def test_sliding_histogram(window, step):
+    x = henon_serie(1000)
+    data_range = (np.min(x), np.max(x))
+    nmb = 0
+    for start, res in sliding_windows('histogram', x, window, step,
+                                      bins=20):
+        counts, _ = np.histogram(x[start:start + window], 20,
+                                 range=data_range)
+        np.testing.assert_allclose(res[:, 1], counts/float(window))
+        nmb += 1
+    assert nmb == len(range(0, 1000 - window + 1, step))
+
+
+@pytest.mark.parametrize("window, step", WINDOWS)
+def test_sliding_mutual(window, step):
+    x = henon_serie(1000)
+    data_range = (np.min(x), np.max(x))
+    for start, res in sliding_windows('mutual', x, window, step,
+                                      max_delay=7, box_nmb=8):
+        ref = mutual_reference(x[start:start + window], 7, 8, data_range)
+        np.testing.assert_allclose(res, ref, atol=1e-12)
+
+
+@pytest.mark.parametrize("window, step", WINDOWS)
+def test_sliding_d2(window, step):
+    # (length scales apart from the distances, to avoid ties)
+    x = np.random.RandomState(0).uniform(size=800)
+    for start, (eps, c2, d2) in sliding_windows(
+            'd2', x, window, step, delay=2, max_dim=3, theiler_wind=4,
+            min_len_scale=1e-3, max_len_scale=1.5, nmb_eps=30):
+        assert c2.shape == d2.shape == (3, 30)
+        ref = c2_reference(x[start:start + window], 2, 3, 4, eps)
+        np.testing.assert_allclose(c2, ref, atol=1e-12)
+
+
+def test_sliding_function():
+    x = henon_serie(500)
+    res = list(sliding_windows(np.std, x, 100, 50, ddof=1))
+    assert [start for start, _ in res] == list(range(0, 401, 50))
+    for start, std in res:
+        assert std == pytest.approx(np.std(x[start:start + 100], ddof=1))
+
+
+def test_sliding_errors():
+    x = henon_serie(500)
+    with pytest.raises(ValueError):
+        list(sliding_windows('histogram', x, 0, 10))
+    with pytest.raises(ValueError):
+        list(sliding_windows('unknown', x, 100, 10))
+    with pytest.raises(ValueError):
+        list(sliding_windows('histogram', np.ones((500, 2)), 100, 10,
+                             col_to_read=[1, 2]))
+
+
+def test_sliding_float32():
+    x = henon_serie(1000)
+    for (_, res), (_, res32) in zip(
+            sliding_windows('mutual', x, 500, 250, max_delay=5),
+            sliding_windows('mutual', x, 500, 250, max_delay=5,
+                            dtype=np.float32)):
+        np.testing.assert_allclose(res32, res, atol=1e-6)